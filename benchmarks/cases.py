@@ -0,0 +1,356 @@
+"""Benchmark cases, every case returns {name: result} with result from measure()"""
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CASES = []
+
+
+def case(func):
+    CASES.append(func)
+    return func
+
+
+def measure(value, unit, higher_is_better=True, budget=None):
+    """Result of one benchmark, run.py fails when value exceeds budget"""
+    result = {'value': round(value, 4), 'unit': unit, 'higher_is_better': higher_is_better}
+    if budget is not None:
+        result['budget'] = budget
+    return result
+
+
+def best_time(func, repeat):
+    """Shortest wall time of repeat calls of func"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def firmware_like(size, seed):
+    """Bytes compressing roughly like ESP32 firmware (~1.6:1 with zlib level 9)"""
+    rnd = random.Random(seed)
+    words = [rnd.getrandbits(32).to_bytes(4, 'little') for _ in range(256)]
+    out = bytearray()
+    while len(out) < size:
+        if rnd.random() < 0.45:
+            out += rnd.getrandbits(64).to_bytes(8, 'little')
+        else:
+            out += words[rnd.randrange(len(words))] + words[rnd.randrange(len(words))]
+    return bytes(out[:size])
+
+
+def make_package(firmware_size=0x20000, spiffs_size=0x40000, seed=1):
+    """Synthetic FujiNet package (zip bytes) with the usual five images"""
+    rnd = random.Random(seed)
+    spiffs_used = spiffs_size // 8
+    files = [
+        ('bootloader.bin', 0x1000, b'\xe9\x03\x02\x20' + firmware_like(0x4E00, seed)),
+        ('partitions.bin', 0x8000, bytes(rnd.getrandbits(8) for _ in range(0xC00))),
+        ('boot_app0.bin', 0xE000, b'\xff' * 0x2000),
+        ('firmware.bin', 0x10000, b'\xe9\x05\x02\x20' + firmware_like(firmware_size - 4, seed + 1)),
+        ('spiffs.bin', 0x300000, firmware_like(spiffs_used, seed + 2) + b'\xff' * (spiffs_size - spiffs_used)),
+    ]
+    release = {
+        'version': 'bench',
+        'version_date': '2000-01-01 00:00:00',
+        'git_commit': '0000000',
+        'files': [{'filename': name, 'offset': hex(offset)} for name, offset, _ in files],
+    }
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('release.json', json.dumps(release))
+        for name, _, data in files:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+@contextlib.contextmanager
+def http_server(payload):
+    """Local stand-in for the firmware server, serves payload at every path"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}/package.zip".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def download_with_remote_file(url):
+    """Download like the GUI does, through RemoteFileThread"""
+    import wx
+    from esphomeflasher.remoteFile import RemoteFile, RemoteFileThread
+
+    app = wx.App(False)
+    handler = wx.EvtHandler()
+    remote_file = RemoteFile(url, handler)
+    thread = RemoteFileThread(remote_file)
+    thread.start()
+    thread.join()
+    app.Destroy()
+    if remote_file.status != RemoteFile.STATUS_OK:
+        raise RuntimeError("Download failed")
+
+
+# must not be loaded to parse the command line
+HEAVY_MODULES = ('esptool', 'serial', 'requests', 'zipfile', 'wx')
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from esphomeflasher.__main__ import parse_args
+parse_args(['esphomeflasher', 'firmware.zip'])
+elapsed = time.perf_counter() - start
+print(json.dumps({'import': elapsed, 'heavy': [m for m in %r if m in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+@case
+def startup(options):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    imports = []
+    heavy = []
+    for _ in range(options.repeat + 1):
+        # every run is a new interpreter, the first one also compiles bytecode
+        out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        report = json.loads(out)
+        imports.append(report['import'])
+        heavy = report['heavy']
+    help_time = best_time(lambda: subprocess.run([sys.executable, '-m', 'esphomeflasher', '-h'], env=env,
+                                                 check=True, stdout=subprocess.DEVNULL), options.repeat)
+    if heavy:
+        print("   heavy modules loaded at startup: {}".format(", ".join(heavy)))
+    return {
+        'startup.import': measure(min(imports[1:]) * 1000, 'ms', False, options.import_budget),
+        'startup.heavy_modules': measure(len(heavy), 'modules', False, 0),
+        'startup.cli_help': measure(help_time * 1000, 'ms', False),
+    }
+
+
+@case
+def download(options):
+    from esphomeflasher import download as download_module
+
+    payload = firmware_like(options.download_size, 7)
+    results = {}
+    with http_server(payload) as url, contextlib.redirect_stdout(io.StringIO()):
+        elapsed = best_time(lambda: download_module.download(url), options.repeat)
+        results['download'] = measure(len(payload) / elapsed / 1e6, 'MB/s')
+        try:
+            import wx  # noqa: F401
+        except ImportError:
+            # RemoteFileThread needs wx
+            results['download.remote_file'] = None
+        else:
+            elapsed = best_time(lambda: download_with_remote_file(url), options.repeat)
+            results['download.remote_file'] = measure(len(payload) / elapsed / 1e6, 'MB/s')
+    return results
+
+
+@case
+def zip_extract(options):
+    from esphomeflasher.common import open_binary_from_zip
+
+    data = make_package(options.firmware_size)
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    names = [info.filename for info in zf.infolist()]
+    size = sum(info.file_size for info in zf.infolist())
+
+    def extract():
+        for name in names:
+            open_binary_from_zip(zf, name)
+
+    return {'zip_extract': measure(size / best_time(extract, options.repeat) / 1e6, 'MB/s')}
+
+
+@case
+def compress(options):
+    from esphomeflasher.package import load_package
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        package = load_package(io.BytesIO(make_package(options.firmware_size)))
+    images = [argfile.read() for _, argfile in package.addr_filename()]
+    size = sum(len(image) for image in images)
+
+    def compress_all():
+        for image in images:
+            # same level as esptool.write_flash
+            zlib.compress(image, 9)
+
+    return {'compress': measure(size / best_time(compress_all, options.repeat) / 1e6, 'MB/s')}
+
+
+@case
+def stream_cache(options):
+    import tempfile
+
+    import esptool
+
+    from esphomeflasher import diskCache, flashWriter
+    from esphomeflasher.common import MockEsptoolArgs
+    from esphomeflasher.diskCache import CompressedCache
+    from esphomeflasher.package import load_package
+
+    # stored members, every image goes through the write path compression
+    source = zipfile.ZipFile(io.BytesIO(make_package(options.firmware_size)))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        for info in source.infolist():
+            zf.writestr(info.filename, source.read(info))
+    with contextlib.redirect_stdout(io.StringIO()):
+        package = load_package(io.BytesIO(buf.getvalue()))
+    # class attributes and methods only, no serial port
+    esp = esptool.ESP32StubLoader.__new__(esptool.ESP32StubLoader)
+    args = MockEsptoolArgs('4MB', package.addr_filename(), package.flash_mode, package.flash_freq)
+    orig_cache = diskCache._compressed_cache
+    # the stream preparation of the write path, at esptool's level
+    writer = flashWriter.FlashWriter(esp, args, str(flashWriter.COMPRESS_LEVEL))
+
+    def prepare_all():
+        for address, argfile in args.addr_filename:
+            writer.prepare(address, argfile, flashWriter.image_size(argfile), {'offset': address})
+
+    with tempfile.TemporaryDirectory() as path, contextlib.redirect_stdout(io.StringIO()):
+        try:
+            diskCache._compressed_cache = CompressedCache(path, 64 * 1024 * 1024)
+            cold = best_time(lambda: (diskCache._compressed_cache.clear(), prepare_all()), options.repeat)
+            warm = best_time(prepare_all, options.repeat)
+        finally:
+            diskCache._compressed_cache = orig_cache
+    return {
+        'stream.cold': measure(package.size / cold / 1e6, 'MB/s'),
+        'stream.cached': measure(package.size / warm / 1e6, 'MB/s'),
+    }
+
+
+def console_lines(count):
+    """esptool progress and colored ESPHome style log lines"""
+    lines = []
+    for i in range(count):
+        if i % 3 == 0:
+            lines.append("Writing at 0x{:08x}... ({} %)\r".format(0x10000 + i * 0x4000, i % 100))
+        else:
+            lines.append("\033[0;32m[I][wifi:{}]: Connected to network\033[0m\n".format(i))
+    return lines
+
+
+@case
+def console_buffer(options):
+    from esphomeflasher.console import ConsoleBuffer
+
+    lines = console_lines(options.console_lines)
+    size = sum(len(line) for line in lines)
+
+    def write_all():
+        buffer = ConsoleBuffer()
+        for i, line in enumerate(lines):
+            buffer.write(line)
+            if i % 100 == 0:
+                # GUI timer picks up a batch
+                buffer.take()
+        buffer.take()
+
+    return {'console.buffer': measure(size / best_time(write_all, options.repeat) / 1e3, 'KB/s')}
+
+
+@case
+def console(options):
+    try:
+        import wx
+        from esphomeflasher.gui import RedirectText
+    except ImportError:
+        return {'console': None}
+
+    lines = console_lines(options.console_lines)
+    size = sum(len(line) for line in lines)
+    app = wx.App(False)
+    frame = wx.Frame(None)
+    ctrl = wx.TextCtrl(frame, style=wx.TE_MULTILINE | wx.TE_READONLY | wx.TE_RICH)
+    out = RedirectText(ctrl)
+
+    def write_all():
+        out.clear()
+        for line in lines:
+            out.write(line)
+        # includes rendering into the control
+        out.render()
+
+    elapsed = best_time(write_all, options.repeat)
+    out.stop()
+    frame.Destroy()
+    app.Destroy()
+    return {'console': measure(size / elapsed / 1e3, 'KB/s')}
+
+
+@case
+def gui_startup(options):
+    try:
+        import wx
+        from esphomeflasher.gui import MainFrame
+    except ImportError:
+        return {'gui.time_to_interactive': None}
+
+    app = wx.App(False)
+    results = []
+    for _ in range(options.repeat):
+        # version check and platform list run in the background and may fail offline
+        with contextlib.redirect_stdout(io.StringIO()):
+            frame = MainFrame(None, "bench")
+            while frame.time_to_interactive is None:
+                app.Yield()
+        results.append(frame.time_to_interactive)
+        frame.Close()
+    app.Destroy()
+    return {'gui.time_to_interactive': measure(min(results) * 1000, 'ms', False, options.gui_budget)}
+
+
+@case
+def flash(options):
+    try:
+        import pty  # noqa: F401
+    except ImportError:
+        return {'flash@{}'.format(baud): None for baud in options.bauds}
+    from esphomeflasher.__main__ import flash_package, parse_args
+    from esphomeflasher.emulator import EspEmulator
+    from esphomeflasher.package import load_package
+
+    results = {}
+    data = make_package(options.firmware_size)
+    for baud in options.bauds:
+        args = parse_args(['esphomeflasher', '--upload-baud-rate', str(baud), 'bench.zip'])
+        with EspEmulator(line_rate=True) as emulator:
+            with contextlib.redirect_stdout(io.StringIO()):
+                package = load_package(io.BytesIO(data))
+                start = time.perf_counter()
+                stub_chip = flash_package(emulator.port, package, args)
+                elapsed = time.perf_counter() - start
+                stub_chip._port.close()
+        results['flash@{}'.format(baud)] = measure(elapsed, 's', higher_is_better=False)
+    return results
@@ -0,0 +1,168 @@
+"""Offline throughput benchmarks of the download, package, console and flashing paths
+
+    python benchmarks/run.py                    # run, compare with baseline.json
+    python benchmarks/run.py --save-baseline    # run and store as new baseline
+    python benchmarks/run.py --only flash --bauds 115200,921600
+
+Flashing runs against the pty emulator (esphomeflasher.emulator) with
+simulated line rate, the download against a local HTTP server. Numbers
+depend on the machine, so the baseline records the host, Python and
+esptool versions. Against a baseline of another environment results are
+only listed. Exits with status 1 if a result is worse than the baseline
+of this environment by more than --tolerance, or above a fixed budget
+such as --import-budget.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.cases import CASES  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='benchmarks/run.py')
+    parser.add_argument('--only', action='append', default=None,
+                        help="Run only this case, can be repeated ({})".format(
+                            ", ".join(func.__name__ for func in CASES)))
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the best one counts")
+    parser.add_argument('--bauds', default='115200,460800,921600',
+                        help="Comma separated baud rates of the flash case")
+    parser.add_argument('--firmware-size', type=lambda x: int(x, 0), default=0x20000)
+    parser.add_argument('--download-size', type=lambda x: int(x, 0), default=16 * 1024 * 1024)
+    parser.add_argument('--console-lines', type=int, default=5000)
+    parser.add_argument('--import-budget', type=float, default=60.0,
+                        help="Fail when importing the CLI takes longer (ms, default 60)")
+    parser.add_argument('--gui-budget', type=float, default=500.0,
+                        help="Fail when the GUI takes longer to become interactive (ms, default 500)")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Store results as new baseline instead of comparing")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed relative regression before failing (default 0.25)")
+    args = parser.parse_args(argv)
+    args.bauds = [int(baud) for baud in args.bauds.split(',') if baud]
+    return args
+
+
+def run_cases(args):
+    results = {}
+    for func in CASES:
+        if args.only and func.__name__ not in args.only:
+            continue
+        print("Running {}...".format(func.__name__), flush=True)
+        start = time.perf_counter()
+        for name, result in func(args).items():
+            results[name] = result
+            if result is None:
+                print(" - {:<20} skipped".format(name))
+            else:
+                print(" - {:<20} {:12.3f} {}".format(name, result['value'], result['unit']))
+        print("   ({:.1f}s)".format(time.perf_counter() - start))
+    return results
+
+
+def environment():
+    """What benchmark results depend on besides the code"""
+    import esptool
+
+    return {
+        'host': platform.node(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'esptool': esptool.__version__,
+    }
+
+
+def environment_changes(current, baseline):
+    """Environment keys which differ from the baseline's, all of them for baselines without environment"""
+    return [key for key in sorted(current) if baseline.get(key) != current[key]]
+
+
+def compare(results, baseline, tolerance):
+    """Print results next to baseline, returns the names which regressed, none without tolerance"""
+    regressions = []
+    print()
+    print("{:<22} {:>12} {:>12} {:>8}".format("case", "baseline", "current", "change"))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if result is None:
+            continue
+        if base is None:
+            print("{:<22} {:>12} {:12.3f}".format(name, "-", result['value']))
+            continue
+        change = result['value'] / base['value'] - 1 if base['value'] else 0.0
+        worse = -change if result['higher_is_better'] else change
+        flag = ""
+        if tolerance is not None and worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<22} {:12.3f} {:12.3f} {:+7.1%}{}".format(name, base['value'], result['value'], change, flag))
+    return regressions
+
+
+def over_budget(results):
+    """Names of results above their fixed budget, independent of the baseline"""
+    failed = []
+    for name, result in sorted(results.items()):
+        if result is not None and 'budget' in result and result['value'] > result['budget']:
+            print("{} is over budget: {:.3f} {} > {} {}".format(
+                name, result['value'], result['unit'], result['budget'], result['unit']))
+            failed.append(name)
+    return failed
+
+
+def main(argv=None):
+    from esphomeflasher.const import __version__
+
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report = {
+        'version': __version__,
+        'timestamp': time.time(),
+        'environment': environment(),
+        'results': run_cases(args),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    failed = over_budget(report['results'])
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+        return 1 if failed else 0
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --save-baseline".format(args.baseline))
+        return 1 if failed else 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    changes = environment_changes(report['environment'], baseline.get('environment', {}))
+    regressions = compare(report['results'], baseline['results'], None if changes else args.tolerance)
+    if changes:
+        print()
+        print("Baseline is of another environment ({}), regressions are not checked.".format(", ".join(
+            "{} {} -> {}".format(key, baseline.get('environment', {}).get(key), report['environment'][key])
+            for key in changes)))
+        print("Record a baseline here with --save-baseline.")
+        return 1 if failed else 0
+    if regressions:
+        print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+        return 1
+    if failed:
+        return 1
+    print("No regressions.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
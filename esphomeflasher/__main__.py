@@ -1,39 +1,93 @@
 from __future__ import print_function
 
 import argparse
-from datetime import datetime
+import os
 import sys
 import time
-import zipfile
-import json
+from typing import TYPE_CHECKING, Union
 
-from esphomeflasher.common import open_downloadable_binary, open_binary_from_zip
-from esphomeflasher.common import fujinet_version_info, is_url
+from esphomeflasher import const
+from esphomeflasher.autoBaud import AUTO_BAUD, change_baud, lower_rates, negotiate_baud, parse_baud_rate
+from esphomeflasher.common import ESP32ChipInfo, EsphomeflasherError, chip_run_stub, close_chip, detect_chip, \
+    hard_reset, is_url, read_chip_info, check_flash_size, MockEsptoolArgs
+from esphomeflasher.const import ESP32_DEFAULT_FIRMWARE
+from esphomeflasher.helpers import configure_ssl_certificates, list_serial_ports, rebase_url, thread_output
+from esphomeflasher.metrics import FlashMetrics, save_metrics_json
 
-import esptool
-import serial
+if TYPE_CHECKING:
+    from esphomeflasher.package import FirmwarePackage, PendingPackage
 
-from esphomeflasher import const
-from esphomeflasher.common import ESP32ChipInfo, EsphomeflasherError, chip_run_stub, \
-    configure_write_flash_args, detect_chip, detect_flash_size, read_chip_info, \
-    read_firmware_info, check_flash_size, MockEsptoolArgs
-from esphomeflasher.const import ESP32_DEFAULT_BOOTLOADER_FORMAT, ESP32_DEFAULT_OTA_DATA, \
-    ESP32_DEFAULT_PARTITIONS, ESP32_DEFAULT_FIRMWARE, ESP32_DEFAULT_SPIFFS, \
-    FUJINET_VERSION_INFO, FUJINET_RELEASE_INFO
-from esphomeflasher.helpers import list_serial_ports
+# esptool, serial, requests, zipfile and wx are imported by the functions which
+# need them, "esphomeflasher -h" does not load any of them
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(prog='esphomeflasher {}'.format(const.__version__))
     parser.add_argument('-p', '--port',
                         help="Select the USB/COM port for uploading.")
-    parser.add_argument('--upload-baud-rate', type=int, default=460800,
-                       help="Baud rate to upload with (not for logging)")
+    parser.add_argument('--upload-baud-rate', type=parse_baud_rate, default=460800,
+                       help="Baud rate to upload with (not for logging), "
+                            "'auto' picks the fastest reliable rate")
     parser.add_argument('--no-erase',
-                        help="Do not erase flash before flashing",
+                        help="Do not erase flash regions before flashing",
+                        action='store_true')
+    parser.add_argument('--erase-unused',
+                        help="Also erase all flash outside the package regions (e.g. clean NVS)",
+                        action='store_true')
+    parser.add_argument('--sparse',
+                        help="Do not write sectors which are all 0xFF (flash is erased before writing)",
+                        action='store_true')
+    parser.add_argument('--no-merge',
+                        help="Write every file of the package separately, do not merge adjacent files",
+                        action='store_true')
+    parser.add_argument('--verify',
+                        help="Compare the flash MD5 of every file with the package after writing, "
+                             "overlapped with the next port in --farm mode",
+                        action='store_true')
+    parser.add_argument('--diff',
+                        help="Only erase and write flash blocks which differ from the package",
                         action='store_true')
     parser.add_argument('--show-logs', help="Only show logs", action='store_true')
+    parser.add_argument('--log-file',
+                        help="Save logs to this file, rotated and gzip compressed when it grows too large")
+    parser.add_argument('--log-max-size', type=int, default=10,
+                        help="Size in MB at which the log file is rotated (default 10)")
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help="Number of rotated log files to keep (default 5)")
+    parser.add_argument('--raw-capture',
+                        help="Record the raw serial byte stream to this file")
+    parser.add_argument('--replay',
+                        help="Show logs from a --raw-capture file instead of a serial port")
+    parser.add_argument('--log-rate', type=int, default=100,
+                        help="Maximum number of log lines per second shown after a burst of 500 lines, "
+                             "0 for as many as the console keeps up with (log files always get all lines)")
+    parser.add_argument('--farm', action='store_true',
+                        help="Flash the package to several serial ports at once")
+    parser.add_argument('--farm-port', action='append', default=None,
+                        help="Serial port for --farm, can be repeated (default: all detected ports)")
+    parser.add_argument('--farm-workers', type=int, default=None,
+                        help="Number of ports flashed in parallel (default: all ports)")
+    parser.add_argument('--sha256',
+                        help="Expected SHA-256 of the package, a cached copy is used when available")
+    parser.add_argument('--cache-dir',
+                        help="Directory of the persistent firmware cache")
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help="Size limit of the firmware cache in MB, shared by packages, partial downloads "
+                             "and compressed images, 0 disables the cache")
+    parser.add_argument('--compression', choices=const.FLASH_COMPRESSION_CHOICES, default='auto',
+                        help="How images are sent: 'auto' (default) picks per image from the measured "
+                             "link speed, 'none' or a zlib level 1-9 forces it")
+    parser.add_argument('--precompress', action='store_true',
+                        help="Compress the images in worker processes as soon as the package is loaded, "
+                             "compressed images are cached for the next flash")
+    parser.add_argument('--base-url',
+                        help="Get packages of the official server from this base URL instead, "
+                             "e.g. a LAN mirror (default ${})".format(const.FUJINET_BASE_URL_ENV))
+    parser.add_argument('--metrics-json',
+                        help="Write per-phase timings of the flash run to this JSON file")
     parser.add_argument('package', help="The package (zip file or URL) which contains files to flash.",
                         default=ESP32_DEFAULT_FIRMWARE)
+    # Python API only, called with the FlashMetrics of every flashed port
+    parser.set_defaults(on_metrics=None)
 
     return parser.parse_args(argv[1:])
 
@@ -53,31 +107,50 @@ def select_port(args):
     print(u"Auto-detected serial port: {}".format(ports[0][0]))
     return ports[0][0]
 
+def select_farm_ports(args):
+    if args.farm_port:
+        return args.farm_port
+    ports = [port for port, desc in list_serial_ports()]
+    if not ports:
+        raise EsphomeflasherError("No serial port found!")
+    print(u"Auto-detected serial ports: {}".format(", ".join(ports)))
+    return ports
+
 def select_baud(args):
     if args.upload_baud_rate is not None:
         print(u"Using '{}' as baud rate.".format(args.upload_baud_rate))
         return args.upload_baud_rate
 
-def show_logs(serial_port):
+def show_logs(serial_port, args=None):
+    """Print device output until the port closes, optionally saving it to disk"""
+    from esphomeflasher.monitor import CaptureWriter, RotatingLog, SerialMonitor
+
+    log = capture = None
+    if args is not None and args.log_file:
+        log = RotatingLog(args.log_file, args.log_max_size * 1024 * 1024, args.log_backups)
+        print("Saving logs to {}".format(args.log_file))
+    if args is not None and args.raw_capture:
+        capture = CaptureWriter(args.raw_capture)
+        print("Saving raw serial data to {}".format(args.raw_capture))
+    monitor = SerialMonitor(serial_port, log, capture,
+                            args.log_rate if args is not None else 100)
     print("Showing logs:")
     with serial_port:
-        while True:
-            try:
-                raw = serial_port.readline()
-            except serial.SerialException:
-                print("Serial port closed!")
-                return
-            text = raw.decode(errors='ignore')
-            line = text.replace('\r', '').replace('\n', '')
-            time = datetime.now().time().strftime('[%H:%M:%S] ')
-            message = time + line
-            try:
-                print(message)
-            except UnicodeEncodeError:
-                print(message.encode('ascii', 'backslashreplace'))
+        monitor.start()
+        monitor.run()
+    if monitor.error is not None:
+        print("Serial port closed!")
 
 def run_esphomeflasher(argv):
     """run esphomeflasher with command line arguments"""
+    if len(argv) > 1 and argv[1] == 'mirror':
+        from esphomeflasher.mirror import run_mirror
+
+        return run_mirror(argv[2:])
+    if len(argv) > 1 and argv[1] in ('backup', 'restore'):
+        from esphomeflasher.backup import run_backup, run_restore
+
+        return (run_backup if argv[1] == 'backup' else run_restore)(argv[2:])
     # parse arguments
     args = parse_args(argv)
     # run flasher
@@ -90,7 +163,29 @@ def run_esphomeflasher_kwargs(**kwargs):
         'port': None,
         'upload_baud_rate': 460800,
         'no_erase': False,
+        'erase_unused': False,
+        'diff': False,
+        'no_merge': False,
+        'verify': False,
+        'sparse': False,
         'show_logs': False,
+        'log_file': None,
+        'log_max_size': 10,
+        'log_backups': 5,
+        'raw_capture': None,
+        'replay': None,
+        'log_rate': 100,
+        'farm': False,
+        'farm_port': None,
+        'farm_workers': None,
+        'sha256': None,
+        'cache_dir': None,
+        'cache_size': None,
+        'compression': 'auto',
+        'precompress': False,
+        'base_url': None,
+        'metrics_json': None,
+        'on_metrics': None,
     }
     args_dct.update(kwargs)
     args = argparse.Namespace(**args_dct)
@@ -99,117 +194,262 @@ def run_esphomeflasher_kwargs(**kwargs):
 
 def run_esphomeflasher_args(args):
     """run esphomeflasher with Namespace args object"""
+    if args.base_url:
+        os.environ[const.FUJINET_BASE_URL_ENV] = args.base_url
+    if is_url(args.package):
+        args.package = rebase_url(args.package)
+    if args.cache_dir is not None or args.cache_size is not None:
+        from esphomeflasher.diskCache import configure_cache
+        configure_cache(args.cache_dir, None if args.cache_size is None else args.cache_size * 1024 * 1024)
+
+    if args.farm:
+        return run_flash_farm(args)
+
+    if args.replay:
+        from esphomeflasher.monitor import ReplayPort
+        show_logs(ReplayPort(args.replay), args)
+        return
+
     port = select_port(args)
     baud = select_baud(args)
 
     if args.show_logs:
-        serial_port = serial.Serial(port, baud)
-        show_logs(serial_port)
+        import serial
+        serial_port = serial.Serial(port, 115200 if baud == AUTO_BAUD else baud)
+        show_logs(serial_port, args)
         return
 
     print("Starting firmware upgrade...")
     if is_url(args.package):
         print("Getting firmware: {}".format(args.package))
 
-    # open local file or download remote file
-    package = open_downloadable_binary(args.package)
-
-    addr_filename = []
-    filecount = 0
-    firmware = None
-    # package is zip file
-    with zipfile.ZipFile(package, 'r') as zf:
-        release_info = json.load(open_binary_from_zip(zf, FUJINET_RELEASE_INFO))
-        # Get all the partition files ready
-        for file_entry in release_info.get('files', []):
-            file_name = file_entry.get('filename')
-            file_offset = file_entry.get('offset')
-            if file_name is None or file_offset is None:
-                raise EsphomeflasherError("Invalid release info. Missing mandatory file attributes!")
-            file_obj = open_binary_from_zip(zf, file_name)
-            offset = int(file_offset, 16)
-            addr_filename.append((offset, file_obj))
-            if file_name.split(".", 1)[0].lower() == 'firmware':
-                firmware = file_obj
-            if file_name.split(".", 1)[0].lower() == 'spiffs':
-                spiffs_start = offset
-            filecount += 1
-            print("File {}: {}, Offset: 0x{:04X}".format(filecount, file_name, offset))
-    # Display firmware details
-    print("FujiNet Version: {}".format(release_info.get('version', "")))
-    print("Version Date: {}".format(release_info.get('version_date', "")))
-    print("Git Commit: {}".format(release_info.get('git_commit', "")))
-
-    # Verify "firmware" magic # and grab flash mode/frequency
-    if firmware:
-        flash_mode, flash_freq = read_firmware_info(firmware)
-    else:
-        raise EsphomeflasherError("Invalid release info. Missing firmware file!")
-
-    chip = detect_chip(port, force_esp32=True)
-    info = read_chip_info(chip)
-
-    print()
-    print("Chip Info:")
-    print(" - Chip Family: {}".format(info.family))
-    print(" - Chip Model: {}".format(info.model))
-    if isinstance(info, ESP32ChipInfo):
-        print(" - Number of Cores: {}".format(info.num_cores))
-        print(" - Max CPU Frequency: {}".format(info.cpu_frequency))
-        print(" - Has Bluetooth: {}".format('YES' if info.has_bluetooth else 'NO'))
-        print(" - Has Embedded Flash: {}".format('YES' if info.has_embedded_flash else 'NO'))
-        print(" - Has Factory-Calibrated ADC: {}".format(
-            'YES' if info.has_factory_calibrated_adc else 'NO'))
-    else:
-        print(" - Chip ID: {:08X}".format(info.chip_id))
-
-    print(" - MAC Address: {}".format(info.mac))
-
-    stub_chip = chip_run_stub(chip)
-
-    if args.upload_baud_rate != 115200:
-        try:
-            stub_chip.change_baud(args.upload_baud_rate)
-        except esptool.FatalError as err:
-            raise EsphomeflasherError("Error changing ESP upload baud rate: {}".format(err))
-
-    flash_size = check_flash_size(stub_chip, spiffs_start)
-    if not flash_size:
-        raise EsphomeflasherError("Firmware larger than chip flash, stopping!")
-
-    mock_args = MockEsptoolArgs(flash_size, addr_filename, flash_mode, flash_freq)
-
-    print(" - Flash Mode: {}".format(mock_args.flash_mode))
-    print(" - Flash Frequency: {}Hz".format(mock_args.flash_freq.upper()))
+    from esphomeflasher.package import PendingPackage
 
+    metrics = FlashMetrics(port)
     try:
-        stub_chip.flash_set_parameters(esptool.flash_size_bytes(flash_size))
-    except esptool.FatalError as err:
-        raise EsphomeflasherError("Error setting flash parameters: {}".format(err))
+        with thread_output():
+            # download and parse the package while the chip is connected
+            package = PendingPackage(args.package, args.sha256)
+            stub_chip = flash_package(port, package, args, metrics)
+    finally:
+        if args.metrics_json:
+            save_metrics_json(args.metrics_json, [metrics])
 
-    if not args.no_erase:
-        try:
-            esptool.erase_flash(stub_chip, mock_args)
-        except esptool.FatalError as err:
-            raise EsphomeflasherError("Error while erasing flash: {}".format(err))
+    time.sleep(0.05)
+    stub_chip._port.flushInput()
 
-    try:
-        esptool.write_flash(stub_chip, mock_args)
-    except esptool.FatalError as err:
-        raise EsphomeflasherError("Error while writing flash: {}".format(err))
+    show_logs(stub_chip._port, args)
 
-    print("Hard Resetting...")
-    stub_chip.hard_reset()
+def run_flash_farm(args):
+    """flash one package to several ports in parallel"""
+    from esphomeflasher.farm import FlashFarm
+    from esphomeflasher.package import PendingPackage
 
-    print("Done! Flashing is complete!")
-    print()
+    ports = select_farm_ports(args)
 
-    time.sleep(0.05)
-    stub_chip._port.flushInput()
+    print("Starting firmware upgrade of {} device(s)...".format(len(ports)))
+    if is_url(args.package):
+        print("Getting firmware: {}".format(args.package))
 
-    show_logs(stub_chip._port)
+    with thread_output():
+        # loaded once, while the workers connect their chips
+        package = PendingPackage(args.package, args.sha256)
+        # verify and reset of a port run in the background while the next port is flashed
+        farm = FlashFarm(package, ports,
+                         lambda port, pkg, metrics: flash_package(port, pkg, args, metrics, deferred=True),
+                         max_workers=args.farm_workers)
+        results = farm.run()
+    if args.metrics_json:
+        save_metrics_json(args.metrics_json, [result.metrics for result in results])
+    if not all(result.success for result in results):
+        raise EsphomeflasherError("Flashing failed on {} of {} port(s)".format(
+            sum(1 for result in results if not result.success), len(results)))
+    return results
+
+def connect_chip(port, args, metrics: FlashMetrics):
+    """detect chip on port, print its details and bring it to stub mode at upload baud rate"""
+    import esptool
+
+    with metrics.phase('chip detect'):
+        chip = detect_chip(port, force_esp32=True)
+    try:
+        with metrics.phase('chip info'):
+            info = read_chip_info(chip)
+        metrics.set('mac', info.mac)
+
+        print()
+        print("Chip Info:")
+        print(" - Chip Family: {}".format(info.family))
+        print(" - Chip Model: {}".format(info.model))
+        if isinstance(info, ESP32ChipInfo):
+            print(" - Number of Cores: {}".format(info.num_cores))
+            print(" - Max CPU Frequency: {}".format(info.cpu_frequency))
+            print(" - Has Bluetooth: {}".format('YES' if info.has_bluetooth else 'NO'))
+            print(" - Has Embedded Flash: {}".format('YES' if info.has_embedded_flash else 'NO'))
+            print(" - Has Factory-Calibrated ADC: {}".format(
+                'YES' if info.has_factory_calibrated_adc else 'NO'))
+        else:
+            print(" - Chip ID: {:08X}".format(info.chip_id))
+
+        print(" - MAC Address: {}".format(info.mac))
+
+        with metrics.phase('stub run'):
+            stub_chip = chip_run_stub(chip)
+
+        with metrics.phase('baud change'):
+            if args.upload_baud_rate == AUTO_BAUD:
+                negotiate_baud(stub_chip, port)
+            elif args.upload_baud_rate != 115200:
+                try:
+                    stub_chip.change_baud(args.upload_baud_rate)
+                except esptool.FatalError as err:
+                    raise EsphomeflasherError("Error changing ESP upload baud rate: {}".format(err))
+        metrics.set('baud', stub_chip._port.baudrate)
+    except BaseException:
+        close_chip(chip)
+        raise
+    return stub_chip
+
+def write_flash(stub_chip, mock_args, metrics: FlashMetrics, compression='auto'):
+    """Write images file by file, continuing at a lower baud rate if a file fails"""
+    import esptool
+
+    from esphomeflasher.flashWriter import FlashWriter, image_size
+
+    writer = FlashWriter(stub_chip, mock_args, compression, metrics)
+    for address, argfile in mock_args.addr_filename:
+        with metrics.phase('write 0x{:X}'.format(address), image_size(argfile)):
+            while True:
+                try:
+                    writer.write(address, argfile)
+                    break
+                except esptool.FatalError as err:
+                    baud = stub_chip._port.baudrate
+                    rates = lower_rates(baud)
+                    if not rates:
+                        raise EsphomeflasherError("Error while writing flash: {}".format(err))
+                    print("Error while writing flash at {} baud: {}".format(baud, err))
+                    print("Retrying at {} baud...".format(rates[0]))
+                    stub_chip.flush_input()
+                    change_baud(stub_chip, rates[0])
+                    metrics.set('baud', rates[0])
+                    argfile.seek(0)
+    writer.finish()
+
+def flash_package(port, package: Union['FirmwarePackage', 'PendingPackage'], args,
+                  metrics: Union[None, FlashMetrics] = None, deferred: bool = False):
+    """flash package to chip on port, returns the stub chip
+
+    A PendingPackage keeps loading while the chip is connected, writing starts
+    as soon as both are ready. Phase timings are recorded in metrics and
+    passed to args.on_metrics, if set. With deferred, returns once the
+    images are written, with a function doing the rest (verify and reset)
+    and returning the stub chip, so the caller can run it in the background.
+    The serial port is closed if flashing fails, otherwise the caller owns it.
+    """
+    import esptool
+
+    from esphomeflasher.flashPlan import diff_regions, erase_planned, sparse_regions, verify_regions
+    from esphomeflasher.flashWriter import COMPRESS_LEVEL, image_size, precompress
+    from esphomeflasher.package import PendingPackage
+
+    if metrics is None:
+        metrics = FlashMetrics(port)
+    stub_chip = connect_chip(port, args, metrics)
+    try:
+        if isinstance(package, PendingPackage):
+            package = package.result()
+        if package.metrics is not None:
+            metrics.merge(package.metrics)
+        package.print_info()
+        merge = not args.no_merge
+        if args.precompress and args.compression != 'none':
+            # runs while the flash is checked and erased
+            precompress(package.layout.writes if merge else package.images,
+                        level=COMPRESS_LEVEL if args.compression == 'auto' else int(args.compression))
+
+        with metrics.phase('flash size check'):
+            flash_size = check_flash_size(stub_chip, package.spiffs_start)
+        if not flash_size:
+            raise EsphomeflasherError("Firmware larger than chip flash, stopping!")
+        metrics.set('flash_size', flash_size)
+        package.layout.check_fit(esptool.flash_size_bytes(flash_size))
+
+        mock_args = MockEsptoolArgs(flash_size, package.addr_filename(merge), package.flash_mode, package.flash_freq)
+
+        print(" - Flash Mode: {}".format(mock_args.flash_mode))
+        print(" - Flash Frequency: {}Hz".format(mock_args.flash_freq.upper()))
+
+        try:
+            stub_chip.flash_set_parameters(esptool.flash_size_bytes(flash_size))
+        except esptool.FatalError as err:
+            raise EsphomeflasherError("Error setting flash parameters: {}".format(err))
+
+        if args.diff:
+            # only blocks which differ from flash contents are erased and written
+            with metrics.phase('diff', package.size):
+                mock_args.addr_filename = diff_regions(stub_chip, mock_args)
+        elif not args.no_erase:
+            with metrics.phase('erase'):
+                erase_planned(stub_chip, [(image.offset, image.size) for image in package.images],
+                              esptool.flash_size_bytes(flash_size), args.erase_unused, metrics)
+
+        skipped = 0
+        if args.sparse:
+            if args.diff or args.no_erase:
+                print("Sparse write needs erased flash, ignored with --diff or --no-erase")
+            else:
+                # erased regions read as 0xFF already, empty sectors are not sent
+                mock_args.addr_filename, skipped = sparse_regions(stub_chip, mock_args)
+                metrics.set('sparse_skipped', skipped)
+
+        if mock_args.addr_filename:
+            write_start = time.time()
+            write_flash(stub_chip, mock_args, metrics, args.compression)
+            write_time = time.time() - write_start
+            written = sum(image_size(argfile) for _, argfile in mock_args.addr_filename)
+            print("Wrote {} bytes in {:.1f}s".format(written, write_time))
+            if skipped:
+                # extrapolated from the measured write rate
+                print("Sparse write: skipped {} bytes of erased padding, saved ~{:.1f}s".format(
+                    skipped, write_time * skipped / written))
+    except BaseException:
+        # the port is only handed over when flashing succeeds
+        close_chip(stub_chip)
+        raise
+
+    def finish():
+        try:
+            if args.verify:
+                # every image region as a whole, after all writes, against the digests of the release
+                regions = package.region_digests(stub_chip, mock_args)
+                with metrics.phase('verify', sum(size for _, size, _, _ in regions)):
+                    verify_regions(stub_chip, regions)
+
+            print("Hard Resetting...")
+            with metrics.phase('reset'):
+                hard_reset(stub_chip)
+
+            print("Done! Flashing is complete!")
+            print()
+            print(metrics.summary_text())
+            print()
+            if args.on_metrics is not None:
+                args.on_metrics(metrics)
+        except BaseException:
+            close_chip(stub_chip)
+            raise
+        return stub_chip
+
+    return finish if deferred else finish()
 
 def main():
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+
+        # --precompress worker processes of the executable
+        multiprocessing.freeze_support()
+    configure_ssl_certificates()
     try:
         if len(sys.argv) <= 1:
             from esphomeflasher import gui
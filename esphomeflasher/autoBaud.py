@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Union
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.helpers import prevent_print, user_cache_dir
+
+AUTO_BAUD = 'auto'
+AUTO_BAUD_RATES = [921600, 460800, 230400, 115200]
+# short transfer checked by the stub's MD5 digest
+PROBE_SIZE = 0x4000
+
+
+def parse_baud_rate(value):
+    """argparse type for --upload-baud-rate, a number or 'auto'"""
+    if str(value).lower() == AUTO_BAUD:
+        return AUTO_BAUD
+    return int(value)
+
+
+def port_key(port: str) -> str:
+    """VID:PID@port identifying the USB serial adapter on port"""
+    from serial.tools.list_ports import comports
+    for info in comports():
+        if info.device == port and info.vid is not None:
+            return "{:04X}:{:04X}@{}".format(info.vid, info.pid, port)
+    return port
+
+
+class BaudMemory:
+    """Probe failures per baud rate, USB adapter and port, kept in a json file
+
+    A rate is skipped once it has failed FAIL_LIMIT times in a row, so one
+    glitch does not slow a port down for good. Skipped rates are probed
+    again after REPROBE_INTERVAL seconds.
+    """
+
+    FAIL_LIMIT = 2
+    REPROBE_INTERVAL = 7 * 24 * 3600
+
+    def __init__(self, path: Union[None, str] = None):
+        self.path = path or os.path.join(user_cache_dir(), 'baudrates.json')
+        self.lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # files of older versions hold the last good rate only
+        return {key: entry if isinstance(entry, dict) else {'baud': entry} for key, entry in entries.items()}
+
+    def _save(self, entries: Dict[str, Dict]):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Cannot store baud rate: {}".format(e))
+
+    def skipped(self, key: str, baud: int, now: float = None) -> bool:
+        with self.lock:
+            count, last = self._load().get(key, {}).get('failures', {}).get(str(baud), (0, 0))
+        now = time.time() if now is None else now
+        return count >= self.FAIL_LIMIT and now - last < self.REPROBE_INTERVAL
+
+    def failed(self, key: str, baud: int, now: float = None):
+        with self.lock:
+            entries = self._load()
+            failures = entries.setdefault(key, {}).setdefault('failures', {})
+            count, _ = failures.get(str(baud), (0, 0))
+            failures[str(baud)] = [count + 1, time.time() if now is None else now]
+            self._save(entries)
+
+    def succeeded(self, key: str, baud: int):
+        with self.lock:
+            entries = self._load()
+            entry = entries.setdefault(key, {})
+            entry['baud'] = baud
+            entry.get('failures', {}).pop(str(baud), None)
+            self._save(entries)
+
+
+memory = BaudMemory()
+
+
+def lower_rates(baud: int, rates: List[int] = None) -> List[int]:
+    return [rate for rate in (rates or AUTO_BAUD_RATES) if rate < baud]
+
+
+def change_baud(stub_chip, baud: int, attempts: int = 3):
+    """change_baud which survives a few garbled responses on a bad link"""
+    import esptool
+
+    for attempt in range(attempts):
+        try:
+            prevent_print(stub_chip.change_baud, baud)
+            return
+        except esptool.FatalError as err:
+            if attempt == attempts - 1:
+                raise EsphomeflasherError("Error changing ESP upload baud rate: {}".format(err))
+            time.sleep(0.05)
+            stub_chip.flush_input()
+
+
+def probe_baud(stub_chip, baud: int) -> bool:
+    """Switch to baud and check the link with a short checksummed read"""
+    import esptool
+
+    try:
+        change_baud(stub_chip, baud)
+        for _ in range(2):
+            prevent_print(stub_chip.read_flash, 0, PROBE_SIZE)
+        return True
+    except (esptool.FatalError, EsphomeflasherError, StopIteration) as err:
+        print("Baud rate {} is not reliable: {}".format(baud, err))
+        time.sleep(0.05)
+        stub_chip.flush_input()
+        return False
+
+
+def negotiate_baud(stub_chip, port: str, rates: List[int] = None) -> int:
+    """Fastest baud rate which passes the probe, failures remembered per adapter and port
+
+    Rates which failed repeatedly are only tried when all others fail.
+    """
+    rates = sorted(rates or AUTO_BAUD_RATES, reverse=True)
+    key = port_key(port)
+    skipped = [baud for baud in rates if memory.skipped(key, baud)]
+    for baud in [baud for baud in rates if baud not in skipped] + skipped:
+        if probe_baud(stub_chip, baud):
+            print("Auto baud rate: {} ({})".format(baud, key))
+            memory.succeeded(key, baud)
+            return baud
+        memory.failed(key, baud)
+    raise EsphomeflasherError("No reliable baud rate found for {}".format(port))
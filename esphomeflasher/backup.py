@@ -0,0 +1,301 @@
+"""Flash backup before an upgrade, and rollback
+
+    esphomeflasher backup [--port PORT] [--package PACKAGE] [--dir DIR]
+    esphomeflasher restore [BACKUP] [--port PORT] [--force]
+
+A backup is a zip file named after the MAC address of the chip, with
+backup.json describing the backed up areas and one deflated member per
+region which is not erased. Restore erases the areas, writes the regions
+through FlashWriter (the deflate streams are sent as they are) and checks
+them by MAC address and flash MD5. Given a directory, restore picks the
+newest backup of the connected chip.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Tuple
+
+from esphomeflasher.autoBaud import AUTO_BAUD, change_baud, lower_rates, parse_baud_rate
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.flashPlan import FLASH_BLOCK_SIZE, flash_md5, merge_runs
+
+BACKUP_INFO = 'backup.json'
+BACKUP_FORMAT = 1
+# erased blocks are found by their MD5, computed by the stub without transferring them
+SCAN_BLOCK_SIZE = FLASH_BLOCK_SIZE
+# one read_flash command, a failed read is retried at a lower baud rate
+READ_BLOCK_SIZE = 0x40000
+
+
+def parse_backup_args(argv):
+    parser = argparse.ArgumentParser(prog='esphomeflasher backup')
+    parser.add_argument('-p', '--port', help="Select the USB/COM port for uploading.")
+    parser.add_argument('--upload-baud-rate', type=parse_baud_rate, default=AUTO_BAUD,
+                        help="Baud rate to read the flash with, 'auto' for the fastest reliable one "
+                             "(default auto)")
+    parser.add_argument('--package',
+                        help="Only back up the regions of the files in this package's release.json "
+                             "(zip file or URL)")
+    parser.add_argument('--sha256', help="Expected SHA-256 of the package")
+    parser.add_argument('--dir', default='.', help="Directory of the backup files (default current directory)")
+    parser.add_argument('-o', '--output', help="Backup file name (default backup-<MAC>-<date>.zip in --dir)")
+    return parser.parse_args(argv)
+
+
+def parse_restore_args(argv):
+    parser = argparse.ArgumentParser(prog='esphomeflasher restore')
+    parser.add_argument('backup', nargs='?', default='.',
+                        help="Backup file, or directory with the backups of the chip (default current directory)")
+    parser.add_argument('-p', '--port', help="Select the USB/COM port for uploading.")
+    parser.add_argument('--upload-baud-rate', type=parse_baud_rate, default=AUTO_BAUD,
+                        help="Baud rate to write the flash with, 'auto' for the fastest reliable one "
+                             "(default auto)")
+    parser.add_argument('--compression', choices=['auto', 'none'], default='auto',
+                        help="Recompress regions for the link ('auto') or send them uncompressed")
+    parser.add_argument('--force', action='store_true',
+                        help="Restore a backup of another chip")
+    return parser.parse_args(argv)
+
+
+def mac_key(mac: str) -> str:
+    return mac.replace(':', '').upper()
+
+
+def backup_filename(mac: str, when: float = None) -> str:
+    """backup-<MAC>-<date>.zip, names of one chip sort by date"""
+    return "backup-{}-{}.zip".format(mac_key(mac), time.strftime('%Y%m%d-%H%M%S', time.localtime(when)))
+
+
+def find_backup(directory: str, mac: str) -> str:
+    """Newest backup of the chip with mac in directory"""
+    paths = sorted(glob.glob(os.path.join(directory, "backup-{}-*.zip".format(mac_key(mac)))))
+    if not paths:
+        raise EsphomeflasherError("No backup of {} in {}".format(mac, directory))
+    return paths[-1]
+
+
+@lru_cache(maxsize=None)
+def erased_md5(size: int) -> str:
+    return hashlib.md5(b'\xff' * size).hexdigest()
+
+
+def used_runs(stub_chip, areas, block_size=SCAN_BLOCK_SIZE) -> List[Tuple[int, int]]:
+    """(start, end) ranges of the areas whose blocks are not entirely 0xFF"""
+    runs = []
+    for start, end in areas:
+        for offset in range(start, end, block_size):
+            size = min(block_size, end - offset)
+            if flash_md5(stub_chip, offset, size) != erased_md5(size):
+                runs.append((offset, offset + size))
+    return merge_runs(runs)
+
+
+def read_region(stub_chip, offset: int, size: int, metrics=None) -> bytes:
+    """Read size bytes at offset in READ_BLOCK_SIZE commands, continuing at a lower baud rate if one fails"""
+    import esptool
+
+    data = bytearray()
+    while len(data) < size:
+        address = offset + len(data)
+        try:
+            data += stub_chip.read_flash(address, min(READ_BLOCK_SIZE, size - len(data)))
+        except esptool.FatalError as err:
+            baud = stub_chip._port.baudrate
+            rates = lower_rates(baud)
+            if not rates:
+                raise EsphomeflasherError("Error while reading flash at 0x{:X}: {}".format(address, err))
+            print("Error while reading flash at {} baud: {}".format(baud, err))
+            print("Retrying at {} baud...".format(rates[0]))
+            stub_chip.flush_input()
+            change_baud(stub_chip, rates[0])
+            if metrics is not None:
+                metrics.set('baud', rates[0])
+    return bytes(data)
+
+
+def backup_flash(stub_chip, path: str, areas, info: dict, metrics=None) -> dict:
+    """Back up the (start, end) areas of flash to the zip file path, returns its backup info
+
+    Regions are compressed in a thread while the next one is read.
+    """
+    from esphomeflasher.flashWriter import COMPRESS_LEVEL
+
+    start_time = time.time()
+    total = sum(end - start for start, end in areas)
+    print("Scanning {} KB of flash for erased blocks...".format(total // 1024))
+    runs = used_runs(stub_chip, areas)
+    used = sum(end - start for start, end in runs)
+    print("{} region(s), {} KB used, {} KB erased".format(len(runs), used // 1024, (total - used) // 1024))
+
+    files = []
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, \
+                zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup') as writer:
+            pending = []
+            for start, end in runs:
+                print("Reading 0x{:08X}-0x{:08X}...".format(start, end))
+                data = read_region(stub_chip, start, end - start, metrics)
+                filename = "0x{:08X}.bin".format(start)
+                files.append({'filename': filename, 'offset': hex(start), 'size': len(data),
+                              'md5': hashlib.md5(data).hexdigest()})
+                pending.append(writer.submit(zf.writestr, filename, data))
+            for future in pending:
+                future.result()
+            info = dict(info, format=BACKUP_FORMAT, created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                        areas=[{'offset': hex(start), 'size': end - start} for start, end in areas],
+                        files=files)
+            zf.writestr(BACKUP_INFO, json.dumps(info, indent=2))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    print("Backed up {} bytes to {} ({} bytes) in {:.1f}s".format(
+        used, path, os.path.getsize(path), time.time() - start_time))
+    return info
+
+
+def load_backup(path: str):
+    """(backup info, FirmwareImage of every region) of a backup file"""
+    from esphomeflasher.package import MemoryFile, map_package, zip_image
+
+    buffer = map_package(path)
+    try:
+        zf = zipfile.ZipFile(MemoryFile(buffer), 'r')
+    except zipfile.BadZipFile as err:
+        raise EsphomeflasherError("Invalid backup {}: {}".format(path, err))
+    with zf:
+        try:
+            info = json.loads(zf.read(BACKUP_INFO))
+        except (KeyError, ValueError) as err:
+            raise EsphomeflasherError("Invalid backup {}, cannot read {}: {}".format(path, BACKUP_INFO, err))
+        if info.get('format') != BACKUP_FORMAT:
+            raise EsphomeflasherError("Unsupported backup format {} of {}".format(info.get('format'), path))
+        images = []
+        for entry in info.get('files', []):
+            image = zip_image(zf, buffer, entry['filename'], int(entry['offset'], 16))
+            if image.md5 != entry['md5']:
+                raise EsphomeflasherError("Invalid backup, {} is corrupted".format(entry['filename']))
+            images.append(image)
+    return info, images
+
+
+def run_backup(argv):
+    import esptool
+
+    from esphomeflasher.__main__ import connect_chip, select_port
+    from esphomeflasher.common import close_chip, detect_flash_size, hard_reset
+    from esphomeflasher.flashPlan import plan_erase
+    from esphomeflasher.helpers import thread_output
+    from esphomeflasher.metrics import FlashMetrics
+
+    args = parse_backup_args(argv)
+    with thread_output():
+        package = None
+        if args.package:
+            from esphomeflasher.package import PendingPackage
+
+            # loaded while the chip is connected
+            package = PendingPackage(args.package, args.sha256)
+        port = select_port(args)
+        metrics = FlashMetrics(port)
+        stub_chip = connect_chip(port, args, metrics)
+        try:
+            mac = metrics.values['mac']
+            flash_size = detect_flash_size(stub_chip)
+            flash_bytes = esptool.flash_size_bytes(flash_size)
+            try:
+                stub_chip.flash_set_parameters(flash_bytes)
+            except esptool.FatalError as err:
+                raise EsphomeflasherError("Error setting flash parameters: {}".format(err))
+            if package is not None:
+                package = package.result()
+                areas = plan_erase([(image.offset, image.size) for image in package.images], flash_bytes)
+            else:
+                areas = [(0, flash_bytes)]
+
+            path = args.output or os.path.join(args.dir, backup_filename(mac))
+            info = {'mac': mac, 'flash_size': flash_size,
+                    'package': package.version if package is not None else None}
+            with metrics.phase('backup', sum(end - start for start, end in areas)):
+                backup_flash(stub_chip, path, areas, info, metrics)
+
+            print("Hard Resetting...")
+            with metrics.phase('reset'):
+                hard_reset(stub_chip)
+            print()
+            print(metrics.summary_text())
+        finally:
+            close_chip(stub_chip)
+    return 0
+
+
+def run_restore(argv):
+    import esptool
+
+    from esphomeflasher.__main__ import connect_chip, select_port, write_flash
+    from esphomeflasher.common import MockEsptoolArgs, close_chip, detect_flash_size, hard_reset
+    from esphomeflasher.flashPlan import erase_planned, verify_regions
+    from esphomeflasher.helpers import thread_output
+    from esphomeflasher.metrics import FlashMetrics
+
+    args = parse_restore_args(argv)
+    with thread_output():
+        port = select_port(args)
+        metrics = FlashMetrics(port)
+        stub_chip = connect_chip(port, args, metrics)
+        try:
+            mac = metrics.values['mac']
+            path = find_backup(args.backup, mac) if os.path.isdir(args.backup) else args.backup
+            info, images = load_backup(path)
+            print("Restoring {} of {} ({})".format(path, info.get('mac'), info.get('created')))
+            if mac_key(info.get('mac', '')) != mac_key(mac):
+                if not args.force:
+                    raise EsphomeflasherError("Backup {} is of {}, not of the connected chip {} (use --force "
+                                              "to restore it anyway)".format(path, info.get('mac'), mac))
+                print("Restoring the backup of {} to {}".format(info.get('mac'), mac))
+
+            flash_size = detect_flash_size(stub_chip)
+            flash_bytes = esptool.flash_size_bytes(flash_size)
+            areas = [(int(area['offset'], 16), area['size']) for area in info.get('areas', [])]
+            if any(offset + size > flash_bytes for offset, size in areas):
+                raise EsphomeflasherError("Backup of {} does not fit in {} of flash".format(
+                    info.get('flash_size'), flash_size))
+            try:
+                stub_chip.flash_set_parameters(flash_bytes)
+            except esptool.FatalError as err:
+                raise EsphomeflasherError("Error setting flash parameters: {}".format(err))
+
+            # erased blocks were not backed up, the whole areas are erased
+            with metrics.phase('erase'):
+                erase_planned(stub_chip, areas, flash_bytes, metrics=metrics)
+            # 'keep' leaves the bootloader header as it was read
+            mock_args = MockEsptoolArgs('keep', [(image.offset, image.open()) for image in images],
+                                        'keep', 'keep')
+            write_start = time.time()
+            write_flash(stub_chip, mock_args, metrics, args.compression)
+            written = sum(image.size for image in images)
+            print("Wrote {} bytes in {:.1f}s".format(written, time.time() - write_start))
+            with metrics.phase('verify', written):
+                verify_regions(stub_chip, [(image.offset, image.size, image.md5, image.filename)
+                                           for image in images])
+
+            print("Hard Resetting...")
+            with metrics.phase('reset'):
+                hard_reset(stub_chip)
+            print("Done! Restore is complete!")
+            print()
+            print(metrics.summary_text())
+        finally:
+            close_chip(stub_chip)
+    return 0
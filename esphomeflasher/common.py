@@ -1,17 +1,7 @@
 import io
 import struct
-import json
-import esptool
-
-try:
-    # For MacOS so it finds the certificates
-    import os
-    import sys
-    os.environ['SSL_CERT_FILE'] = os.path.join(sys._MEIPASS, 'certifi', 'cacert.pem')
-except:
-    pass
+from urllib.parse import urlsplit
 
-from esphomeflasher.const import HTTP_REGEX
 from esphomeflasher.const import ESP32_DEFAULT_FIRMWARE
 from esphomeflasher.const import FUJINET_VERSION_URL
 from esphomeflasher.helpers import prevent_print
@@ -86,6 +76,8 @@ class ESP8266ChipInfo(ChipInfo):
 
 
 def read_chip_property(func, *args, **kwargs):
+    import esptool
+
     try:
         return prevent_print(func, *args, **kwargs)
     except esptool.FatalError as err:
@@ -93,6 +85,8 @@ def read_chip_property(func, *args, **kwargs):
 
 
 def read_chip_info(chip):
+    import esptool
+
     mac = ':'.join('{:02X}'.format(x) for x in read_chip_property(chip.read_mac))
     if isinstance(chip, esptool.ESP32ROM):
         model = read_chip_property(chip.get_chip_description)
@@ -112,6 +106,8 @@ def read_chip_info(chip):
 
 
 def chip_run_stub(chip):
+    import esptool
+
     try:
         return chip.run_stub()
     except esptool.FatalError as err:
@@ -119,10 +115,14 @@ def chip_run_stub(chip):
 
 
 def detect_flash_size(stub_chip):
+    import esptool
+
     flash_id = read_chip_property(stub_chip.flash_id)
     return esptool.DETECTED_FLASH_SIZES.get(flash_id >> 16, '4MB')
 
 def check_flash_size(stub_chip, offset):
+    import esptool
+
     spiffs_offset = round(offset / 1024)
     flash_id = read_chip_property(stub_chip.flash_id)
     counter = 1
@@ -138,6 +138,8 @@ def check_flash_size(stub_chip, offset):
         f += 1
 
 def read_firmware_info(firmware):
+    import esptool
+
     header = firmware.read(4)
     firmware.seek(0)
 
@@ -154,30 +156,51 @@ def read_firmware_info(firmware):
 
 def is_url(path):
     if isinstance(path, str):
-        return HTTP_REGEX.match(path) is not None
+        # not HTTP_REGEX, a LAN mirror may be addressed by IP address or plain host name
+        parts = urlsplit(path)
+        return parts.scheme in ('http', 'https') and bool(parts.netloc)
     else:
         return False
 
 
-def open_downloadable_binary(path):
+def download_firmware(url, sha256=None):
+    """Download (resumable) into the package cache, returns the Download"""
+    import requests
+    from esphomeflasher.download import ChecksumError, download_resumable
+
+    try:
+        result = download_resumable(url, sha256)
+    except requests.exceptions.Timeout as err:
+        raise EsphomeflasherError(
+            "Timeout while retrieving firmware file '{}': {}".format(url, err))
+    except requests.exceptions.RequestException as err:
+        raise EsphomeflasherError(
+            "Error while retrieving firmware file '{}': {}".format(url, err))
+    except ChecksumError as err:
+        raise EsphomeflasherError("Firmware file '{}' is corrupted: {}".format(url, err))
+    print("Downloaded {}".format(result.stats_text))
+    return result
+
+
+def open_downloadable_binary(path, sha256=None):
+    """Open local file, file object or URL
+
+    Remote files with known sha256 are served from the persistent package
+    cache when possible, downloaded files are verified and stored there.
+    """
     if hasattr(path, 'seek'):
         path.seek(0)
         return path
 
     if is_url(path):
-        import requests
+        from esphomeflasher.diskCache import get_cache
 
-        try:
-            response = requests.get(path)
-            response.raise_for_status()
-        except requests.exceptions.Timeout as err:
-            raise EsphomeflasherError(
-                "Timeout while retrieving firmware file '{}': {}".format(path, err))
-        except requests.exceptions.RequestException as err:
-            raise EsphomeflasherError(
-                "Error while retrieving firmware file '{}': {}".format(path, err))
-
-        binary = io.BytesIO(response.content)
+        data = get_cache().get(sha256) if sha256 else None
+        if data is not None:
+            print("Using cached firmware {}".format(sha256))
+            return io.BytesIO(data)
+
+        binary = io.BytesIO(download_firmware(path, sha256).data)
         return binary
 
     try:
@@ -207,6 +230,8 @@ def configure_write_flash_args(info, firmware_path, flash_size,
     return 0
 
 def detect_chip(port, force_esp8266=False, force_esp32=False):
+    import esptool
+
     if force_esp8266 or force_esp32:
         klass = esptool.ESP32ROM if force_esp32 else esptool.ESP8266ROM
         chip = klass(port)
@@ -217,8 +242,29 @@ def detect_chip(port, force_esp8266=False, force_esp32=False):
             raise EsphomeflasherError("ESP Chip Auto-Detection failed: {}".format(err))
 
     try:
-        chip.connect()
+        try:
+            chip.connect()
+        except OSError as err:
+            # no DTR/RTS lines (e.g. a pty), the chip has to be in download mode already
+            print("Cannot reset ESP into download mode ({}), connecting without reset".format(err))
+            chip.connect('no_reset')
     except esptool.FatalError as err:
+        close_chip(chip)
         raise EsphomeflasherError("Error connecting to ESP: {}".format(err))
 
     return chip
+
+
+def close_chip(chip):
+    """Close the serial port of chip, if it is still open"""
+    try:
+        chip._port.close()
+    except (AttributeError, OSError):
+        pass
+
+
+def hard_reset(chip):
+    try:
+        chip.hard_reset()
+    except OSError as err:
+        print("Cannot reset ESP ({}), please reset it manually".format(err))
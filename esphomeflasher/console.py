@@ -0,0 +1,178 @@
+import re
+import threading
+from collections import namedtuple
+
+# CSI sequences (SGR when the final byte is 'm') and OSC sequences
+ESCAPE_RE = re.compile(r'\033(?:\[([0-9;:?]*)[ -/]*([@-~])|\][^\007\033]*(?:\007|\033\\))')
+# an escape sequence which may still be completed by the next write
+PARTIAL_ESCAPE_RE = re.compile(r'\033(?:\[[0-9;:?]*[ -/]*|\][^\007\033]*\033?)?$')
+MAX_ESCAPE_LENGTH = 64
+
+CONSOLE_MAX_LINES = 5000
+
+COLOR_NAMES = ['black', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white']
+
+Style = namedtuple('Style', 'bold italic underline foreground background secret')
+DEFAULT_STYLE = Style(False, False, False, None, None, False)
+
+# SGR parameter -> (field, value), None resets all attributes
+SGR_TABLE = {
+    0: None,
+    1: ('bold', True),
+    3: ('italic', True),
+    4: ('underline', True),
+    5: ('secret', True),
+    6: ('secret', False),
+    22: ('bold', False),
+    23: ('italic', False),
+    24: ('underline', False),
+    39: ('foreground', None),
+    49: ('background', None),
+}
+# foreground, background and underline color with arguments
+EXTENDED_COLOR_CODES = (38, 48, 58)
+for _i, _name in enumerate(COLOR_NAMES):
+    SGR_TABLE[30 + _i] = ('foreground', _name)
+    SGR_TABLE[40 + _i] = ('background', _name)
+
+
+def apply_sgr(style: Style, params: str) -> Style:
+    """Style after the SGR sequence ESC [ params m"""
+    params = params.replace(':', ';').split(';')
+    i = 0
+    while i < len(params):
+        param = params[i]
+        i += 1
+        try:
+            code = int(param) if param else 0
+        except ValueError:
+            continue
+        if code in EXTENDED_COLOR_CODES:
+            # 256 color and RGB colors are not rendered, skip their arguments (5;n or 2;r;g;b)
+            mode = params[i] if i < len(params) else ''
+            i += {'5': 2, '2': 4}.get(mode, 1)
+            continue
+        entry = SGR_TABLE.get(code, False)
+        if entry is None:
+            style = DEFAULT_STYLE
+        elif entry:
+            style = style._replace(**{entry[0]: entry[1]})
+    return style
+
+
+class ConsoleBuffer:
+    """Thread-safe console sink which collects output until it is rendered
+
+    write() may be called from any thread, it parses escape sequences and
+    carriage returns into a batch of operations. The GUI calls take()
+    periodically and applies them to its text control:
+
+     - ('append', style, text)
+     - ('remove', n): remove the last n characters, i.e. the current line
+       after a carriage return, without reading back the control
+
+    take() also returns how many of the oldest lines to drop, so the
+    control keeps at most max_lines (plus some slack) of scrollback.
+    """
+
+    def __init__(self, max_lines: int = CONSOLE_MAX_LINES):
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.style = DEFAULT_STYLE
+            self._escape = ''
+            self._ops = []
+            # position in _ops where the current line starts: (op index, text offset)
+            self._line_mark = (0, 0)
+            # length of the current line already rendered, and pending in _ops
+            self._line_rendered = 0
+            self._line_pending = 0
+            self._carriage_return = False
+            self._lines = 0
+
+    def _append(self, text):
+        if self._carriage_return:
+            self._carriage_return = False
+            if text[0] != '\n':
+                self._clear_line()
+        ops = self._ops
+        if ops and ops[-1][0] == 'append' and ops[-1][1] == self.style:
+            ops[-1][2] += text
+        else:
+            ops.append(['append', self.style, text])
+        newline = text.rfind('\n')
+        if newline < 0:
+            self._line_pending += len(text)
+            return
+        self._lines += text.count('\n')
+        self._line_mark = (len(ops) - 1, len(ops[-1][2]) - len(text) + newline + 1)
+        self._line_rendered = 0
+        self._line_pending = len(text) - newline - 1
+
+    def _clear_line(self):
+        ops = self._ops
+        index, offset = self._line_mark
+        if index < len(ops):
+            del ops[index + 1:]
+            ops[index][2] = ops[index][2][:offset]
+            if not ops[index][2]:
+                del ops[index]
+        if self._line_rendered:
+            ops.append(['remove', self._line_rendered])
+            self._line_rendered = 0
+        if ops and ops[-1][0] == 'append':
+            self._line_mark = (len(ops) - 1, len(ops[-1][2]))
+        else:
+            self._line_mark = (len(ops), 0)
+        self._line_pending = 0
+
+    def _write_plain(self, text):
+        # '\r' moves to the start of the line, the next text overwrites it
+        parts = text.split('\r')
+        for i, part in enumerate(parts):
+            if i:
+                self._carriage_return = True
+            if part:
+                self._append(part)
+
+    def write(self, string: str):
+        with self.lock:
+            text = self._escape + string
+            self._escape = ''
+            if '\033' not in text:
+                self._write_plain(text)
+                return len(string)
+            pos = 0
+            for match in ESCAPE_RE.finditer(text):
+                if match.start() > pos:
+                    self._write_plain(text[pos:match.start()])
+                pos = match.end()
+                if match.group(2) == 'm':
+                    self.style = apply_sgr(self.style, match.group(1))
+            rest = text[pos:]
+            partial = PARTIAL_ESCAPE_RE.search(rest)
+            if partial is not None and len(rest) - partial.start() < MAX_ESCAPE_LENGTH:
+                # keep an incomplete sequence for the next write
+                self._escape = rest[partial.start():]
+                rest = rest[:partial.start()]
+            if rest:
+                self._write_plain(rest)
+        return len(string)
+
+    def take(self):
+        """(ops, lines to drop from the top) since the last call"""
+        with self.lock:
+            ops = self._ops
+            self._ops = []
+            self._line_mark = (0, 0)
+            self._line_rendered += self._line_pending
+            self._line_pending = 0
+            trim = 0
+            if self._lines > self.max_lines + self.max_lines // 10:
+                # trim in chunks, not on every line
+                trim = self._lines - self.max_lines
+                self._lines = self.max_lines
+        return ops, trim
@@ -24,3 +24,14 @@ ESP32_DEFAULT_FIRMWARE_URL = FUJINET_FIRMWARE_BASE_URL + ESP32_DEFAULT_FIRMWARE
 
 # https://stackoverflow.com/a/3809435/8924614
 HTTP_REGEX = re.compile(r'https?://(www\.)?[-a-zA-Z0-9@:%._+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_+.~#?&/=]*)')
+
+# Persistent firmware package cache, shared by GUI and CLI
+FUJINET_CACHE_DIR_ENV = "FUJINET_FLASHER_CACHE_DIR"
+FUJINET_CACHE_SIZE_ENV = "FUJINET_FLASHER_CACHE_SIZE"
+FUJINET_CACHE_DEFAULT_SIZE = 256  # MB
+
+# Base URL of catalogs and packages, e.g. a LAN mirror made with "esphomeflasher mirror"
+FUJINET_BASE_URL_ENV = "FUJINET_FLASHER_BASE_URL"
+
+# --compression values, 'auto' lets the writer choose per image
+FLASH_COMPRESSION_CHOICES = ['auto', 'none'] + [str(level) for level in range(1, 10)]
@@ -0,0 +1,398 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Tuple, Union
+
+from esphomeflasher.const import FUJINET_CACHE_DIR_ENV, FUJINET_CACHE_SIZE_ENV, FUJINET_CACHE_DEFAULT_SIZE
+from esphomeflasher.helpers import user_cache_dir
+
+
+class LruCache:
+    """Directory of cache files ending with SUFFIX, evicted least recently used first
+
+    The file modification time is used as last access time. Files are
+    written atomically, so several flasher processes can share one cache
+    directory. Caches linked with share_budget() are evicted together and
+    all their files count against one max_size.
+    """
+
+    SUFFIX = ''
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.enabled = max_size > 0
+        self.lock = threading.Lock()
+        self.shared = []
+
+    def share_budget(self, other: 'LruCache'):
+        """Count the files of other against max_size too, and the other way round"""
+        self.shared.append(other)
+        other.shared.append(self)
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in self._entries():
+                self._remove(path)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _store(self, path: str, *parts) -> bool:
+        """Write a new entry from parts and evict old ones, False if it could not be written"""
+        with self.lock:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                if os.path.exists(path):
+                    self._touch(path)
+                    return True
+                fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for part in parts:
+                            f.write(part)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    self._remove(tmp_path)
+                    raise
+            except OSError as e:
+                print("Cannot store {} in cache: {}".format(os.path.basename(path), e))
+                return False
+            self._evict()
+        return True
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _usage(self, now: float):
+        """(path, size, mtime, evictable) of every file counted against max_size"""
+        return [entry + (True,) for entry in self._entries()]
+
+    def _evict(self):
+        """Remove least recently used entries until the caches sharing the budget fit max_size"""
+        now = time.time()
+        entries = self._usage(now)
+        for cache in self.shared:
+            entries += cache._usage(now)
+        entries.sort(key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for path, size, _, evictable in entries:
+            if total <= self.max_size:
+                break
+            if evictable and self._remove(path):
+                total -= size
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class FirmwareCache(LruCache):
+    """Persistent content-addressed cache of firmware packages
+
+    Packages are stored as <sha256>.zip and their checksum is verified on
+    every read. Partial downloads count against max_size as well, they are
+    only evicted once they were not written for PART_IDLE seconds.
+    """
+
+    SUFFIX = '.zip'
+    PART_SUFFIXES = ('.part', '.part.json')
+    PART_IDLE = 3600
+
+    def __init__(self, path: Union[None, str] = None, max_size: Union[None, int] = None):
+        if path is None:
+            path = os.environ.get(FUJINET_CACHE_DIR_ENV) or os.path.join(user_cache_dir(), 'packages')
+        if max_size is None:
+            max_size = int(os.environ.get(FUJINET_CACHE_SIZE_ENV, FUJINET_CACHE_DEFAULT_SIZE)) * 1024 * 1024
+        super().__init__(path, max_size)
+
+    def entry_path(self, sha256: str) -> str:
+        return os.path.join(self.path, sha256.lower() + self.SUFFIX)
+
+    def part_path(self, key: str) -> str:
+        """Partial download of a package, kept until it completes"""
+        return os.path.join(self.path, key.lower() + self.SUFFIX + '.part')
+
+    def _usage(self, now: float):
+        usage = super()._usage(now)
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return usage
+        for name in names:
+            if not any(name.endswith(self.SUFFIX + suffix) for suffix in self.PART_SUFFIXES):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            usage.append((path, st.st_size, st.st_mtime, now - st.st_mtime > self.PART_IDLE))
+        return usage
+
+    def get(self, sha256: str) -> Union[None, bytes]:
+        """Cached data with given checksum or None, corrupted entries are removed"""
+        if not self.enabled or not sha256:
+            return None
+        path = self.entry_path(sha256)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != sha256.lower():
+            print("Cached package {} is corrupted, removed from cache".format(sha256))
+            self._remove(path)
+            return None
+        self._touch(path)
+        return data
+
+    def map(self, sha256: str, verify: bool = True) -> Union[None, mmap.mmap]:
+        """Cached package memory-mapped read-only, pages are shared and nothing is copied"""
+        if not self.enabled or not sha256:
+            return None
+        path = self.entry_path(sha256)
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if verify and hashlib.sha256(mapped).hexdigest() != sha256.lower():
+            mapped.close()
+            print("Cached package {} is corrupted, removed from cache".format(sha256))
+            self._remove(path)
+            return None
+        self._touch(path)
+        return mapped
+
+    def put(self, data: bytes, sha256: Union[None, str] = None, verify: bool = True) -> str:
+        """Store data, returns its checksum
+
+        sha256 is verified unless verify is False, which is meant for data
+        hashed already while it was downloaded.
+        """
+        if sha256 is not None and not verify:
+            checksum = sha256.lower()
+        else:
+            checksum = hashlib.sha256(data).hexdigest()
+            if sha256 is not None and checksum != sha256.lower():
+                raise ValueError("Checksum mismatch: expected {}, got {}".format(sha256, checksum))
+        if not self.enabled or len(data) > self.max_size:
+            return checksum
+        self._store(self.entry_path(checksum), data)
+        return checksum
+
+
+    def adopt(self, path: str, sha256: str) -> bool:
+        """Move a verified file (a finished download) into the cache as the entry of sha256
+
+        Nothing is copied, False if the cache does not take it and the file
+        is left where it is.
+        """
+        if not self.enabled:
+            return False
+        try:
+            if os.path.getsize(path) > self.max_size:
+                return False
+        except OSError:
+            return False
+        entry = self.entry_path(sha256)
+        with self.lock:
+            try:
+                self._touch(path)
+                os.replace(path, entry)
+            except OSError as e:
+                print("Cannot store {} in cache: {}".format(os.path.basename(entry), e))
+                return False
+            self._evict()
+        return True
+
+
+class CompressedCache(LruCache):
+    """zlib streams of flash images as the write path sends them, so a release is deflated only once
+
+    Entries are <image sha256>-<level>-<block size>.zz, the image being the
+    exact bytes written to flash. The block size is the write size of the
+    loader the stream is split for. A header holds the image size and MD5
+    (checked by the chip after writing) and the CRC of the stream, which is
+    verified when the entry is mapped.
+    """
+
+    SUFFIX = '.zz'
+    MAGIC = b'FNZ1'
+    # magic, image size, CRC-32 of the stream, image MD5
+    HEADER = struct.Struct('<4sII16s')
+
+    def __init__(self, path: Union[None, str] = None, max_size: Union[None, int] = None):
+        """By default a subdirectory of the package cache, sharing its size budget"""
+        package_cache = get_cache()
+        shared = path is None and max_size is None
+        if path is None:
+            path = os.path.join(package_cache.path, 'compressed')
+        if max_size is None:
+            max_size = package_cache.max_size
+        super().__init__(path, max_size)
+        if shared:
+            self.share_budget(package_cache)
+
+    def entry_path(self, sha256: str, level: int, block_size: int) -> str:
+        return os.path.join(self.path, '{}-{}-{:x}{}'.format(sha256.lower(), level, block_size, self.SUFFIX))
+
+    def has(self, sha256: str, level: int, block_size: int) -> bool:
+        return self.enabled and os.path.exists(self.entry_path(sha256, level, block_size))
+
+    def get(self, sha256: str, level: int, block_size: int) -> Union[None, Tuple[memoryview, int, str]]:
+        """(memory-mapped stream, image size, image md5) or None, corrupted entries are removed"""
+        if not self.enabled or not sha256:
+            return None
+        path = self.entry_path(sha256, level, block_size)
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        view = memoryview(mapped)
+        try:
+            magic, size, crc, md5 = self.HEADER.unpack_from(view)
+        except struct.error:
+            magic = None
+        stream = view[self.HEADER.size:]
+        if magic != self.MAGIC or zlib.crc32(stream) != crc:
+            print("Cached stream {} is corrupted, removed from cache".format(os.path.basename(path)))
+            stream.release()
+            view.release()
+            mapped.close()
+            self._remove(path)
+            return None
+        self._touch(path)
+        return stream, size, md5.hex()
+
+    def put(self, sha256: str, level: int, block_size: int, stream, size: int, md5: str):
+        if not self.enabled or len(stream) > self.max_size:
+            return
+        header = self.HEADER.pack(self.MAGIC, size, zlib.crc32(stream), bytes.fromhex(md5))
+        self._store(self.entry_path(sha256, level, block_size), header, stream)
+
+
+class CatalogCache:
+    """Last response of catalog URLs (platforms.json, releases) for conditional requests
+
+    Every URL is stored as <sha1 of url>.body with a .json file next to it
+    holding the url, size and the ETag / Last-Modified validators.
+    """
+
+    def __init__(self, path: Union[None, str] = None):
+        if path is None:
+            path = os.path.join(user_cache_dir(), 'catalog')
+        self.path = path
+        self.lock = threading.Lock()
+
+    def entry_path(self, url: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url: str) -> Union[None, Tuple[bytes, Dict[str, str]]]:
+        """(body, metadata) of the last response or None"""
+        path = self.entry_path(url)
+        try:
+            with open(path + '.json', 'r') as f:
+                meta = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or meta.get('size') != len(data):
+            return None
+        return data, meta
+
+    def put(self, url: str, data: bytes, meta: Dict[str, str]):
+        """Store body and validators, responses without validators are not kept"""
+        path = self.entry_path(url)
+        meta = dict(meta, url=url, size=len(data))
+        if not meta.get('etag') and not meta.get('last_modified'):
+            return
+        with self.lock:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                self._write(path + '.body', data)
+                self._write(path + '.json', json.dumps(meta).encode('utf-8'))
+            except OSError as e:
+                print("Cannot store {} in cache: {}".format(url, e))
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            LruCache._remove(tmp_path)
+            raise
+
+
+_cache: Union[None, FirmwareCache] = None
+_catalog_cache: Union[None, CatalogCache] = None
+_compressed_cache: Union[None, CompressedCache] = None
+
+
+def get_cache() -> FirmwareCache:
+    global _cache
+    if _cache is None:
+        _cache = FirmwareCache()
+    return _cache
+
+
+def configure_cache(path: Union[None, str] = None, max_size: Union[None, int] = None) -> FirmwareCache:
+    """Replace the shared cache, max_size in bytes, 0 disables caching"""
+    global _cache, _compressed_cache
+    _cache = FirmwareCache(path, max_size)
+    # follows the package cache and shares its budget
+    _compressed_cache = None
+    return _cache
+
+
+def get_catalog_cache() -> CatalogCache:
+    global _catalog_cache
+    if _catalog_cache is None:
+        _catalog_cache = CatalogCache()
+    return _catalog_cache
+
+
+def get_compressed_cache() -> CompressedCache:
+    global _compressed_cache
+    if _compressed_cache is None:
+        _compressed_cache = CompressedCache()
+    return _compressed_cache
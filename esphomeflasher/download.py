@@ -0,0 +1,290 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Mapping, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.diskCache import get_cache, get_catalog_cache
+
+CHUNK_SIZE = 64 * 1024
+# connections kept alive per host, enough for the parallel catalog and package fetches
+POOL_SIZE = 8
+# resumable downloads: attempts after a dropped connection, backoff doubles up to the maximum
+DOWNLOAD_RETRIES = 5
+RETRY_DELAY = 1.0
+RETRY_DELAY_MAX = 30.0
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+_session: Union[None, requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Shared session, all requests to the firmware server reuse its pooled connections"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+class DownloadAborted(EsphomeflasherError):
+    pass
+
+
+class ChecksumError(EsphomeflasherError):
+    pass
+
+
+class Download:
+    """Completed download, data and its SHA-256 computed while receiving
+
+    data of a resumable download is the memory-mapped package cache entry
+    when the cache took it.
+    """
+
+    def __init__(self, url: str, data: Union[bytearray, mmap.mmap], sha256: str, elapsed: float,
+                 status: int = 200, headers: Union[None, Mapping[str, str]] = None):
+        self.url = url
+        self.data = data
+        self.sha256 = sha256
+        self.elapsed = elapsed
+        self.status = status
+        self.headers = headers or {}
+        # True when the server answered 304 and data comes from the catalog cache
+        self.not_modified = False
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def bytes_per_sec(self):
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def stats_text(self):
+        return "{} bytes in {:.2f}s ({:.1f} KB/s)".format(self.size, self.elapsed, self.bytes_per_sec / 1024)
+
+
+def download(url: str, sha256: Union[None, str] = None, cancel: Union[None, threading.Event] = None,
+             progress: Union[None, Callable[[int, int], None]] = None, timeout: float = 10.0,
+             headers: Union[None, Dict[str, str]] = None) -> Download:
+    """Stream url into a preallocated buffer, hashing chunks as they arrive
+
+    Raises requests exceptions on transfer errors, DownloadAborted when cancel
+    is set and ChecksumError when sha256 is given and does not match.
+    """
+    start = time.time()
+    digest = hashlib.sha256()
+    with get_session().get(url, stream=True, timeout=timeout, headers=headers) as resp:
+        resp.raise_for_status()
+        status = resp.status_code
+        response_headers = resp.headers
+        # Content-Length is the encoded size, only trust it for identity encoding
+        total = 0 if resp.headers.get('Content-Encoding') else int(resp.headers.get('Content-Length') or 0)
+        data = bytearray(total)
+        pos = 0
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            if cancel is not None and cancel.is_set():
+                raise DownloadAborted("Download aborted")
+            if not chunk:
+                continue
+            # in place within preallocated size, grows only if server sent more
+            data[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+            digest.update(chunk)
+            if progress is not None:
+                progress(pos, total)
+        if pos < len(data):
+            del data[pos:]
+    result = Download(url, data, digest.hexdigest(), time.time() - start, status, response_headers)
+    if sha256 is not None and result.sha256 != sha256.lower():
+        raise ChecksumError("Checksum mismatch for {}: expected {}, got {}".format(url, sha256, result.sha256))
+    return result
+
+
+def download_catalog(url: str, cancel: Union[None, threading.Event] = None, timeout: float = 10.0) -> Download:
+    """Download a catalog file (platforms.json, releases) with a conditional request
+
+    The last response is kept in the catalog cache with its ETag and
+    Last-Modified headers, an unchanged file costs a 304 instead of a
+    transfer and is returned from the cache with not_modified set.
+    """
+    cache = get_catalog_cache()
+    cached = cache.get(url)
+    headers = {}
+    if cached is not None:
+        meta = cached[1]
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    result = download(url, cancel=cancel, timeout=timeout, headers=headers)
+    if result.status == 304 and cached is not None:
+        data = cached[0]
+        not_modified = Download(url, bytearray(data), hashlib.sha256(data).hexdigest(), result.elapsed,
+                                result.status, result.headers)
+        not_modified.not_modified = True
+        return not_modified
+    cache.put(url, result.data, {
+        'etag': result.headers.get('ETag'),
+        'last_modified': result.headers.get('Last-Modified'),
+    })
+    return result
+
+
+def _load_part_info(path: str, url: str) -> Dict[str, str]:
+    try:
+        with open(path, 'r') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return info if info.get('url') == url else {}
+
+
+def _hash_file(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def _remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def download_resumable(url: str, sha256: Union[None, str] = None, cancel: Union[None, threading.Event] = None,
+                       progress: Union[None, Callable[[int, int], None]] = None, timeout: float = 10.0,
+                       retries: int = DOWNLOAD_RETRIES) -> Download:
+    """Download url through a .part file in the package cache directory
+
+    A dropped connection is retried with exponential backoff, continuing
+    with a Range request where the part file ends. If-Range with the ETag
+    (or Last-Modified) of the first response makes the server send the
+    whole file again if it changed meanwhile. A part file left by an
+    earlier run is continued the same way. SHA-256 is computed while
+    receiving and checked over the assembled file, a mismatch discards it.
+    The verified part file is moved into the package cache and data is
+    memory-mapped from there, it is only read into memory if the cache
+    does not take it.
+    """
+    cache = get_cache()
+    part_path = cache.part_path(sha256 or hashlib.sha1(url.encode('utf-8')).hexdigest())
+    info_path = part_path + '.json'
+    os.makedirs(cache.path, exist_ok=True)
+    info = _load_part_info(info_path, url)
+    if not info:
+        _remove_files(part_path)
+    start = time.time()
+    attempt = 0
+    # of the part file, continued while receiving
+    digest = None
+    hashed = 0
+    while True:
+        if cancel is not None and cancel.is_set():
+            raise DownloadAborted("Download aborted")
+        try:
+            offset = os.path.getsize(part_path)
+        except OSError:
+            offset = 0
+        headers = {}
+        validator = info.get('etag') or info.get('last_modified')
+        if offset and validator:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+        try:
+            with get_session().get(url, stream=True, timeout=timeout, headers=headers) as resp:
+                if resp.status_code == 416:
+                    # part file is not a prefix of the current file
+                    _remove_files(part_path, info_path)
+                    info = {}
+                    continue
+                resp.raise_for_status()
+                match = CONTENT_RANGE_RE.match(resp.headers.get('Content-Range', ''))
+                if resp.status_code == 206 and match and int(match.group(1)) == offset:
+                    mode = 'ab'
+                    total = int(match.group(2)) if match.group(2) != '*' else 0
+                else:
+                    if offset:
+                        print("Server sent the whole file, restarting download")
+                    mode = 'wb'
+                    offset = 0
+                    total = 0 if resp.headers.get('Content-Encoding') else int(resp.headers.get('Content-Length') or 0)
+                    info = {
+                        'url': url,
+                        'etag': resp.headers.get('ETag'),
+                        'last_modified': resp.headers.get('Last-Modified'),
+                    }
+                    with open(info_path, 'w') as f:
+                        json.dump(info, f)
+                if offset:
+                    print("Resuming download at {} of {} bytes".format(offset, total or '?'))
+                if mode == 'wb':
+                    digest = hashlib.sha256()
+                elif digest is None or hashed != offset:
+                    # part file of an earlier run
+                    digest = _hash_file(part_path)
+                hashed = offset
+                pos = offset
+                with open(part_path, mode) as f:
+                    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadAborted("Download aborted")
+                        if not chunk:
+                            continue
+                        f.write(chunk)
+                        digest.update(chunk)
+                        hashed += len(chunk)
+                        pos += len(chunk)
+                        if progress is not None:
+                            progress(pos, total)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if total and pos < total:
+                    raise requests.ConnectionError("Connection closed after {} of {} bytes".format(pos, total))
+                break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                requests.HTTPError) as err:
+            response = getattr(err, 'response', None)
+            if isinstance(err, requests.HTTPError) and response is not None and response.status_code < 500:
+                raise
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = min(RETRY_DELAY * 2 ** (attempt - 1), RETRY_DELAY_MAX)
+            print("Download interrupted ({}), retry {}/{} in {:.0f}s".format(err, attempt, retries, delay))
+            if cancel is not None:
+                if cancel.wait(delay):
+                    raise DownloadAborted("Download aborted")
+            else:
+                time.sleep(delay)
+    checksum = digest.hexdigest()
+    _remove_files(info_path)
+    if sha256 is not None and checksum != sha256.lower():
+        _remove_files(part_path)
+        raise ChecksumError("Checksum mismatch for {}: expected {}, got {}".format(url, sha256, checksum))
+    data = cache.map(checksum, verify=False) if cache.adopt(part_path, checksum) else None
+    if data is None:
+        # not cached (cache disabled, package too large or empty)
+        path = part_path if os.path.exists(part_path) else cache.entry_path(checksum)
+        with open(path, 'rb') as f:
+            data = bytearray(f.read())
+        _remove_files(part_path)
+    return Download(url, data, checksum, time.time() - start)
@@ -0,0 +1,474 @@
+"""Emulated ESP32 serial bootloader on a pseudo-terminal (Linux/macOS)
+
+Answers the ROM and stub loader protocol spoken by esptool, with flash kept
+in memory, so the whole flashing path can run without hardware:
+
+    python -m esphomeflasher.emulator --flash-size 4MB
+    esphomeflasher --port /dev/pts/N firmware.zip
+
+A pty has no DTR/RTS lines, the emulated chip is always in download mode.
+"""
+import argparse
+import hashlib
+import os
+import random
+import select
+import struct
+import threading
+import time
+import zlib
+from typing import Union
+
+import esptool
+
+SLIP_END = 0xC0
+SLIP_ESC = 0xDB
+SLIP_ESC_END = 0xDC
+SLIP_ESC_ESC = 0xDD
+
+# reply status codes
+ROM_INVALID_COMMAND = 0x05
+ROM_BAD_CHECKSUM = 0x07
+STUB_BAD_CHECKSUM = 0xC1
+STUB_NOT_IN_FLASH_MODE = 0xC6
+STUB_INFLATE_ERROR = 0xC7
+STUB_CMD_NOT_IMPLEMENTED = 0xFF
+
+SPI_CMD_USR = 1 << 18
+SPIFLASH_RDID = 0x9F
+
+FLASH_SIZES = {
+    '1MB': 0x100000,
+    '2MB': 0x200000,
+    '4MB': 0x400000,
+    '8MB': 0x800000,
+    '16MB': 0x1000000,
+}
+
+
+def slip_encode(packet: bytes) -> bytes:
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+class SlipDecoder:
+    """Incremental SLIP decoder, feed() returns the packets completed by data"""
+
+    def __init__(self):
+        self.packet = None
+        self.escape = False
+
+    def feed(self, data: bytes):
+        packets = []
+        for b in data:
+            if self.packet is None:
+                if b == SLIP_END:
+                    self.packet = bytearray()
+            elif self.escape:
+                self.escape = False
+                self.packet.append({SLIP_ESC_END: SLIP_END, SLIP_ESC_ESC: SLIP_ESC}.get(b, b))
+            elif b == SLIP_ESC:
+                self.escape = True
+            elif b == SLIP_END:
+                if self.packet:
+                    packets.append(bytes(self.packet))
+                    self.packet = None
+                # else: back to back delimiters, keep waiting for content
+            else:
+                self.packet.append(b)
+        return packets
+
+
+def checksum(data: bytes) -> int:
+    value = esptool.ESPLoader.ESP_CHECKSUM_MAGIC
+    for b in data:
+        value ^= b
+    return value
+
+
+class EmulatedFlash:
+    """NOR flash in memory, writes can only clear bits, erase sets them back to 0xFF"""
+
+    SECTOR_SIZE = 0x1000
+
+    def __init__(self, size: int):
+        self.size = size
+        self.data = bytearray(b'\xff' * size)
+        self.bytes_written = 0
+        self.bytes_erased = 0
+
+    def check(self, offset, size):
+        if offset < 0 or size < 0 or offset + size > self.size:
+            raise ValueError("0x{:X}+0x{:X} is outside of flash".format(offset, size))
+
+    def erase(self, offset: int, size: int):
+        start = offset - offset % self.SECTOR_SIZE
+        end = offset + size + (-(offset + size)) % self.SECTOR_SIZE
+        end = min(end, self.size)
+        self.check(start, end - start)
+        self.data[start:end] = b'\xff' * (end - start)
+        self.bytes_erased += end - start
+
+    def write(self, offset: int, data: bytes):
+        self.check(offset, len(data))
+        current = int.from_bytes(self.data[offset:offset + len(data)], 'little')
+        value = current & int.from_bytes(data, 'little')
+        self.data[offset:offset + len(data)] = value.to_bytes(len(data), 'little')
+        self.bytes_written += len(data)
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.check(offset, size)
+        return bytes(self.data[offset:offset + size])
+
+
+class EspEmulator:
+    """ESP32 ROM and stub loader answering on the slave side of a pty
+
+    latency is added before every reply, error_rate is the probability of
+    every sent or received byte to be corrupted once the baud rate is above
+    error_baud. With line_rate the transfer time at the current baud rate is
+    simulated, otherwise the pty runs as fast as the host can read.
+    """
+
+    def __init__(self, flash_size: str = '4MB', flash_id: Union[None, int] = None,
+                 mac: str = '24:0A:C4:00:00:01', latency: float = 0.0, error_rate: float = 0.0,
+                 error_baud: int = 0, line_rate: bool = False, seed: Union[None, int] = None,
+                 md5_rate: float = 0.0):
+        self.flash = EmulatedFlash(FLASH_SIZES[flash_size])
+        if flash_id is None:
+            # Winbond JEDEC id, capacity byte is log2 of the size
+            flash_id = ((self.flash.size.bit_length() - 1) << 16) | 0x40EF
+        self.flash_id = flash_id
+        self.mac = bytes(int(x, 16) for x in mac.split(':'))
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_baud = error_baud
+        self.line_rate = line_rate
+        # bytes per second the chip hashes flash at, 0 for instant
+        self.md5_rate = md5_rate
+        self.random = random.Random(seed)
+        self.baud = esptool.ESPLoader.ESP_ROM_BAUD
+        self.stub = False
+        self.registers = {}
+        self.commands = 0
+        self.errors_injected = 0
+        self._write_offset = 0
+        self._write_remaining = 0
+        self._inflate = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._decoder = SlipDecoder()
+        self._pending = []
+        self.port = None
+        self.reset()
+
+    def reset(self):
+        """Power on state: ROM loader at 115200 baud"""
+        self.baud = esptool.ESPLoader.ESP_ROM_BAUD
+        self.stub = False
+        self._inflate = None
+        rom = esptool.ESP32ROM
+        efuse = rom.EFUSE_RD_REG_BASE
+        self.registers = {
+            esptool.ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR: rom.CHIP_DETECT_MAGIC_VALUE,
+            efuse + 4 * 1: int.from_bytes(self.mac[2:6], 'big'),
+            efuse + 4 * 2: int.from_bytes(self.mac[0:2], 'big'),
+            # revision 1, 240MHz rated, ESP32-D0WD
+            efuse + 4 * 3: (1 << 15) | (1 << 13) | (1 << 9),
+        }
+
+    @property
+    def status_length(self):
+        return 2 if self.stub else 4
+
+    def start(self) -> str:
+        """Open the pty and serve it on a thread, returns the port name"""
+        import pty
+        import tty
+
+        self._master, self._slave = pty.openpty()
+        # raw mode until the host opens the port, no echo of early traffic
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name='esp-emulator', daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    # serial line
+
+    def _noisy(self):
+        return self.error_rate > 0 and self.baud > self.error_baud
+
+    def _corrupt(self, data: bytes) -> bytes:
+        if not self._noisy():
+            return data
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self.random.random() < self.error_rate:
+                data[i] ^= 1 << self.random.randrange(8)
+                self.errors_injected += 1
+        return bytes(data)
+
+    def _transfer_delay(self, nbytes):
+        if self.line_rate:
+            # 8N1, ten bits per byte
+            time.sleep(nbytes * 10 / self.baud)
+
+    def _send_raw(self, packet: bytes):
+        frame = self._corrupt(slip_encode(packet))
+        self._transfer_delay(len(frame))
+        view = memoryview(frame)
+        while view:
+            written = os.write(self._master, view)
+            view = view[written:]
+
+    def _receive(self, timeout=None):
+        """Next SLIP packet from the host, None on timeout or stop"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._pending:
+            if self._stop.is_set():
+                return None
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            readable, _, _ = select.select([self._master], [], [], wait)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 0x10000)
+            except OSError:
+                # host closed the port
+                time.sleep(0.05)
+                continue
+            self._transfer_delay(len(data))
+            self._pending.extend(self._decoder.feed(self._corrupt(data)))
+        return self._pending.pop(0)
+
+    def _reply(self, op, value=0, data=b'', error=0):
+        if self.latency:
+            time.sleep(self.latency)
+        status = bytes([1 if error else 0, error]) + b'\0' * (self.status_length - 2)
+        body = data + status
+        self._send_raw(struct.pack('<BBHI', 1, op, len(body), value) + body)
+
+    def _serve(self):
+        while not self._stop.is_set():
+            packet = self._receive()
+            if packet is None:
+                continue
+            if len(packet) < 8 or packet[0] != 0:
+                # garbled or not a command
+                continue
+            _, op, size, chk = struct.unpack('<BBHI', packet[:8])
+            data = packet[8:]
+            if len(data) != size:
+                self._reply(op, error=ROM_INVALID_COMMAND)
+                continue
+            self.commands += 1
+            self.handle(op, data, chk)
+
+    # commands
+
+    def handle(self, op, data, chk):
+        loader = esptool.ESPLoader
+        handler = {
+            loader.ESP_SYNC: self.cmd_sync,
+            loader.ESP_READ_REG: self.cmd_read_reg,
+            loader.ESP_WRITE_REG: self.cmd_write_reg,
+            loader.ESP_MEM_BEGIN: self.cmd_ok,
+            loader.ESP_MEM_DATA: self.cmd_ok,
+            loader.ESP_MEM_END: self.cmd_mem_end,
+            loader.ESP_SPI_ATTACH: self.cmd_ok,
+            loader.ESP_SPI_SET_PARAMS: self.cmd_ok,
+            loader.ESP_CHANGE_BAUDRATE: self.cmd_change_baud,
+            loader.ESP_FLASH_BEGIN: self.cmd_flash_begin,
+            loader.ESP_FLASH_DATA: self.cmd_flash_data,
+            loader.ESP_FLASH_END: self.cmd_ok,
+            loader.ESP_FLASH_DEFL_BEGIN: self.cmd_flash_begin,
+            loader.ESP_FLASH_DEFL_DATA: self.cmd_flash_data,
+            loader.ESP_FLASH_DEFL_END: self.cmd_flash_end,
+            loader.ESP_SPI_FLASH_MD5: self.cmd_md5,
+        }.get(op)
+        if handler is None and self.stub:
+            handler = {
+                loader.ESP_ERASE_FLASH: self.cmd_erase_flash,
+                loader.ESP_ERASE_REGION: self.cmd_erase_region,
+                loader.ESP_READ_FLASH: self.cmd_read_flash,
+            }.get(op)
+        if handler is None:
+            self._reply(op, error=STUB_CMD_NOT_IMPLEMENTED if self.stub else ROM_INVALID_COMMAND)
+            return
+        try:
+            handler(op, data, chk)
+        except (ValueError, struct.error):
+            self._reply(op, error=ROM_INVALID_COMMAND)
+
+    def cmd_ok(self, op, data, chk):
+        self._reply(op)
+
+    def cmd_sync(self, op, data, chk):
+        # the ROM answers a sync with several replies
+        for _ in range(1 if self.stub else 8):
+            self._reply(op, 0x20120707 if not self.stub else 0)
+
+    def cmd_read_reg(self, op, data, chk):
+        addr, = struct.unpack('<I', data[:4])
+        self._reply(op, self.registers.get(addr, 0))
+
+    def cmd_write_reg(self, op, data, chk):
+        spi = esptool.ESP32ROM.SPI_REG_BASE
+        for pos in range(0, len(data) - 15, 16):
+            addr, value, mask, _ = struct.unpack('<IIII', data[pos:pos + 16])
+            self.registers[addr] = value
+            if addr == spi and value & SPI_CMD_USR:
+                self.spi_command(self.registers.get(spi + esptool.ESP32ROM.SPI_USR2_OFFS, 0) & 0xFF)
+        self._reply(op)
+
+    def spi_command(self, command):
+        spi = esptool.ESP32ROM.SPI_REG_BASE
+        if command == SPIFLASH_RDID:
+            self.registers[spi + esptool.ESP32ROM.SPI_W0_OFFS] = self.flash_id & 0xFFFFFF
+        # command completes immediately
+        self.registers[spi] = 0
+
+    def cmd_mem_end(self, op, data, chk):
+        self._reply(op)
+        if not self.stub:
+            # uploaded code is assumed to be the flasher stub
+            self.stub = True
+            self._send_raw(b'OHAI')
+
+    def cmd_change_baud(self, op, data, chk):
+        baud, _ = struct.unpack('<II', data[:8])
+        self._reply(op)
+        self.baud = baud
+
+    def cmd_flash_begin(self, op, data, chk):
+        size, _, _, offset = struct.unpack('<IIII', data[:16])
+        self.flash.erase(offset, size)
+        self._write_offset = offset
+        self._write_remaining = size
+        compressed = op == esptool.ESPLoader.ESP_FLASH_DEFL_BEGIN
+        self._inflate = zlib.decompressobj() if compressed else False
+        self._reply(op)
+
+    def cmd_flash_data(self, op, data, chk):
+        size, _, _, _ = struct.unpack('<IIII', data[:16])
+        block = data[16:16 + size]
+        if checksum(block) != chk:
+            self._reply(op, error=STUB_BAD_CHECKSUM if self.stub else ROM_BAD_CHECKSUM)
+            return
+        if self._inflate is None:
+            self._reply(op, error=STUB_NOT_IN_FLASH_MODE)
+            return
+        if self._inflate:
+            try:
+                block = self._inflate.decompress(block)
+            except zlib.error:
+                self._reply(op, error=STUB_INFLATE_ERROR)
+                return
+        elif self.stub:
+            # the stub drops the padding of the last block
+            block = block[:self._write_remaining]
+            self._write_remaining -= len(block)
+        self.flash.write(self._write_offset, block)
+        self._write_offset += len(block)
+        self._reply(op)
+
+    def cmd_flash_end(self, op, data, chk):
+        self._inflate = None
+        self._reply(op)
+
+    def cmd_md5(self, op, data, chk):
+        offset, size, _, _ = struct.unpack('<IIII', data[:16])
+        digest = hashlib.md5(self.flash.read(offset, size))
+        if self.md5_rate:
+            time.sleep(size / self.md5_rate)
+        # the stub sends the raw digest, the ROM a hex string
+        self._reply(op, data=digest.digest() if self.stub else digest.hexdigest().encode())
+
+    def cmd_erase_flash(self, op, data, chk):
+        self.flash.erase(0, self.flash.size)
+        self._reply(op)
+
+    def cmd_erase_region(self, op, data, chk):
+        offset, size = struct.unpack('<II', data[:8])
+        self.flash.erase(offset, size)
+        self._reply(op)
+
+    def cmd_read_flash(self, op, data, chk):
+        offset, size, packet_size, _ = struct.unpack('<IIII', data[:16])
+        contents = self.flash.read(offset, size)
+        self._reply(op)
+        for pos in range(0, size, packet_size):
+            self._send_raw(contents[pos:pos + packet_size])
+            # the host acknowledges every packet with the number of bytes received
+            if self._receive(timeout=2.0) is None:
+                return
+        self._send_raw(hashlib.md5(contents).digest())
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='esphomeflasher.emulator',
+                                     description="Emulated ESP32 bootloader on a pseudo-terminal")
+    parser.add_argument('--flash-size', choices=list(FLASH_SIZES), default='4MB')
+    parser.add_argument('--flash-id', type=lambda x: int(x, 0), default=None,
+                        help="JEDEC flash id as read by esptool (default: Winbond id matching --flash-size)")
+    parser.add_argument('--mac', default='24:0A:C4:00:00:01')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Delay before every reply in milliseconds")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Probability of a corrupted byte on the line")
+    parser.add_argument('--error-baud', type=int, default=0,
+                        help="Only corrupt bytes above this baud rate")
+    parser.add_argument('--line-rate', action='store_true',
+                        help="Simulate transfer time at the current baud rate")
+    parser.add_argument('--md5-rate', type=float, default=0.0,
+                        help="Simulate the chip hashing flash at this many KB/s (default instant)")
+    parser.add_argument('--flash-file',
+                        help="Load flash contents from this file and save them on exit")
+    args = parser.parse_args()
+
+    emulator = EspEmulator(args.flash_size, args.flash_id, args.mac, args.latency / 1000,
+                           args.error_rate, args.error_baud, args.line_rate, md5_rate=args.md5_rate * 1024)
+    if args.flash_file and os.path.exists(args.flash_file):
+        with open(args.flash_file, 'rb') as f:
+            contents = f.read(emulator.flash.size)
+        emulator.flash.data[:len(contents)] = contents
+
+    with emulator:
+        print("Emulated ESP32 on {}".format(emulator.port), flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print("{} commands, {} bytes written, {} bytes erased, {} byte errors injected".format(
+        emulator.commands, emulator.flash.bytes_written, emulator.flash.bytes_erased,
+        emulator.errors_injected))
+    if args.flash_file:
+        with open(args.flash_file, 'wb') as f:
+            f.write(emulator.flash.data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Union
+
+from esphomeflasher.common import EsphomeflasherError, close_chip
+from esphomeflasher.helpers import PrefixedOutput, ThreadOutput, thread_output
+from esphomeflasher.metrics import FlashMetrics
+
+
+class FarmResult:
+    """Outcome of flashing one serial port"""
+
+    def __init__(self, port: str):
+        self.port = port
+        self.success = False
+        self.error = ""
+        self.elapsed = 0.0
+        self.metrics = FlashMetrics(port)
+
+    def as_dict(self):
+        return {
+            'port': self.port,
+            'success': self.success,
+            'error': self.error,
+            'elapsed': self.elapsed,
+            'metrics': self.metrics.as_dict(),
+        }
+
+
+class FlashFarm:
+    """Flash one package to many serial ports at once
+
+    The package (FirmwarePackage or PendingPackage) is loaded once by the caller
+    and shared read-only, every worker gets its own file objects and its own
+    chip connection. flash_port is called with (port, package, metrics).
+    If it returns a function, the port is finished by calling it in another
+    thread (e.g. verify and reset) and the worker moves on to the next port.
+    The chip returned by flash_port or the finish function is closed once
+    the port is done. Output of each worker is prefixed with the port name.
+    """
+
+    def __init__(self, package, ports: List[str], flash_port: Callable,
+                 max_workers: Union[None, int] = None, on_result: Union[None, Callable] = None):
+        if not ports:
+            raise EsphomeflasherError("No serial port to flash!")
+        self.package = package
+        self.ports = list(ports)
+        self.flash_port = flash_port
+        self.max_workers = max_workers or len(self.ports)
+        self.on_result = on_result
+        self.results: List[FarmResult] = []
+        self._lock = threading.Lock()
+
+    def _call(self, result: FarmResult, func, *args):
+        """Run func, recording its failure in result, returns its return value"""
+        try:
+            return func(*args)
+        except EsphomeflasherError as err:
+            result.error = str(err) or "Flashing failed"
+        except Exception as err:
+            result.error = "Unexpected error: {}".format(err)
+        return None
+
+    def _finish_port(self, result: FarmResult, finish, chip, prefixed: PrefixedOutput, output: ThreadOutput,
+                     start: float) -> FarmResult:
+        output.set_target(prefixed)
+        try:
+            if finish is not None:
+                chip = self._call(result, finish)
+            result.success = not result.error
+            result.elapsed = time.time() - start
+            print("OK ({:.1f}s)".format(result.elapsed) if result.success
+                  else "FAILED: {}".format(result.error))
+            prefixed.flush()
+        finally:
+            output.set_target(None)
+            if chip is not None:
+                # a later run (e.g. the next GUI farm run) opens the port again
+                close_chip(chip)
+        if self.on_result is not None:
+            self.on_result(result)
+        return result
+
+    def _run_port(self, port: str, output: ThreadOutput, finishers: ThreadPoolExecutor) -> Future:
+        result = FarmResult(port)
+        prefixed = PrefixedOutput(output.default, "[{}] ".format(port), self._lock)
+        output.set_target(prefixed)
+        start = time.time()
+        try:
+            finish = self._call(result, self.flash_port, port, self.package, result.metrics)
+        finally:
+            output.set_target(None)
+        if callable(finish) and not result.error:
+            return finishers.submit(self._finish_port, result, finish, None, prefixed, output, start)
+        future = Future()
+        future.set_result(self._finish_port(result, None, finish, prefixed, output, start))
+        return future
+
+    def run(self) -> List[FarmResult]:
+        with thread_output() as output:
+            print("Flashing {} port(s) with {} worker(s)...".format(len(self.ports), self.max_workers))
+            # finishing is mostly waiting for a chip, it is not limited to max_workers
+            with ThreadPoolExecutor(max_workers=len(self.ports), thread_name_prefix='finish') as finishers, \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._run_port, port, output, finishers) for port in self.ports]
+                self.results = [f.result().result() for f in futures]
+        self.print_summary()
+        return self.results
+
+    def print_summary(self):
+        print()
+        print("Flash farm summary:")
+        for result in self.results:
+            print(" - {}: {}".format(result.port, "OK ({:.1f}s)".format(result.elapsed) if result.success
+                                     else "FAILED ({})".format(result.error)))
+        ok = sum(1 for result in self.results if result.success)
+        print("{} of {} port(s) flashed successfully.".format(ok, len(self.results)))
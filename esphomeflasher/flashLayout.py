@@ -0,0 +1,210 @@
+import hashlib
+import io
+import threading
+import zlib
+from typing import List
+
+import esptool
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.flashPlan import FLASH_SECTOR_SIZE, align_up
+from esphomeflasher.flashWriter import COMPRESS_LEVEL
+
+# its header is patched for every chip, it is never merged
+BOOTLOADER_OFFSET = esptool.ESP32ROM.BOOTLOADER_FLASH_OFFSET
+# deflated images up to this size are recompressed to merge them with the next image
+RECOMPRESS_MAX = 64 * 1024
+
+
+class ChainFile(io.RawIOBase):
+    """Read-only file over images placed at their offsets, bytes between them read as 0xFF"""
+
+    def __init__(self, images, offset: int, size: int, name: str = ""):
+        self._images = images
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+        self._files = {}
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _file(self, image, pos):
+        f = self._files.get(id(image))
+        if f is None:
+            f = self._files[id(image)] = image.open()
+        if f.tell() != pos:
+            f.seek(pos)
+        return f
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        out = bytearray()
+        while len(out) < size:
+            address = self._offset + self._pos
+            image = next((image for image in self._images if image.offset + image.size > address), None)
+            if image is None:
+                break
+            if address < image.offset:
+                data = b'\xff' * min(image.offset - address, size - len(out))
+            else:
+                data = self._file(image, address - image.offset).read(
+                    min(image.offset + image.size - address, size - len(out)))
+                if not data:
+                    break
+            out += data
+            self._pos += len(data)
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class MergedImage:
+    """Adjacent package images written as one image, the space between them filled with 0xFF
+
+    Reads stream from the package images, nothing is joined in memory.
+    Digests are computed once, so the compressed stream is cached per
+    release like the one of a single image. When the last image has a zip
+    deflate stream, the images before it are compressed and that stream is
+    appended as it is (deflate_parts), the whole write is passed through.
+    """
+
+    def __init__(self, images):
+        self.images = images
+        self.offset = images[0].offset
+        self.size = images[-1].offset + images[-1].size - self.offset
+        self.filename = "+".join(image.filename for image in images)
+        # never sent as a zip member
+        self.raw_deflate = None
+        self.deflate_parts = None
+        self.md5 = ""
+        self.sha256 = ""
+        self.adler32 = 1
+
+    @property
+    def kind(self):
+        return 'merged'
+
+    @property
+    def data(self):
+        return self.open().read()
+
+    def open(self):
+        f = ChainFile(self.images, self.offset, self.size, self.filename)
+        f.image = self
+        return f
+
+    def scan(self):
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        adler = 1
+        f = self.open()
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+            adler = zlib.adler32(chunk, adler)
+        self.md5 = md5.hexdigest()
+        self.sha256 = sha256.hexdigest()
+        self.adler32 = adler
+        last = self.images[-1]
+        if is_passthrough(last):
+            # sync flush ends the prefix on a byte boundary without a final block
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+            f.seek(0)
+            prefix = compressor.compress(f.read(last.offset - self.offset)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.deflate_parts = [prefix] + last.deflate_parts
+
+
+def is_passthrough(image) -> bool:
+    """Image with a deflate stream which is sent to the chip without recompressing"""
+    return getattr(image, 'deflate_parts', None) is not None and not image.size % 4
+
+
+def ends_group(image) -> bool:
+    """Deflated image too large to recompress for merging it with the next one"""
+    return is_passthrough(image) and image.size > RECOMPRESS_MAX
+
+
+class FlashLayout:
+    """Placement of the package images in flash, validated when the package is loaded
+
+    Offsets must be sector aligned, images must not overlap. Images are
+    grouped into writes: an image is merged with the next one when no
+    whole sector lies between them, the sectors they share are erased for
+    both anyway. Gaps of whole sectors (NVS, the second OTA slot) are
+    never written. The bootloader is always written on its own. A deflated
+    image larger than RECOMPRESS_MAX ends its group: its zip stream is
+    passed through with the images before it compressed in front of it,
+    nothing can follow its final deflate block. Smaller deflated images
+    (boot_app0, partitions) are recompressed when something follows them.
+    """
+
+    def __init__(self, images):
+        self.images = sorted(images, key=lambda image: image.offset)
+        self._lock = threading.Lock()
+        self._writes = None
+        previous = None
+        for image in self.images:
+            if image.offset < 0 or image.offset % FLASH_SECTOR_SIZE:
+                raise EsphomeflasherError("Invalid release info, {} offset 0x{:X} is not sector aligned".format(
+                    image.filename, image.offset))
+            if previous is not None and image.offset < previous.offset + previous.size:
+                raise EsphomeflasherError("Invalid release info, {} at 0x{:X} overlaps {} (0x{:X}-0x{:X})".format(
+                    image.filename, image.offset, previous.filename, previous.offset,
+                    previous.offset + previous.size))
+            previous = image
+
+    def check_fit(self, flash_size: int):
+        """Raise if an image does not fit in flash_size bytes"""
+        for image in self.images:
+            if image.offset + image.size > flash_size:
+                raise EsphomeflasherError("{} (0x{:X}-0x{:X}) does not fit in {} KB of flash".format(
+                    image.filename, image.offset, image.offset + image.size, flash_size // 1024))
+
+    def groups(self) -> List[List]:
+        """Images written together, in flash order"""
+        groups = []
+        for image in self.images:
+            if not image.size:
+                continue
+            if groups and image.offset != BOOTLOADER_OFFSET and groups[-1][0].offset != BOOTLOADER_OFFSET \
+                    and not ends_group(groups[-1][-1]):
+                last = groups[-1][-1]
+                if align_up(last.offset + last.size, FLASH_SECTOR_SIZE) >= image.offset:
+                    groups[-1].append(image)
+                    continue
+            groups.append([image])
+        return groups
+
+    @property
+    def writes(self):
+        """Package images and MergedImages to write, digests of merged ones computed on first use"""
+        with self._lock:
+            if self._writes is None:
+                writes = []
+                for group in self.groups():
+                    if len(group) == 1:
+                        writes.append(group[0])
+                        continue
+                    merged = MergedImage(group)
+                    merged.scan()
+                    writes.append(merged)
+                self._writes = writes
+            return self._writes
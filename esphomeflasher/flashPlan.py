@@ -0,0 +1,340 @@
+import hashlib
+import io
+import time
+
+import esptool
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.helpers import prevent_print
+
+FLASH_SECTOR_SIZE = 0x1000
+FLASH_BLOCK_SIZE = 0x10000
+DIFF_BLOCK_SIZE = 0x10000
+ERASED_SECTOR = b'\xff' * FLASH_SECTOR_SIZE
+# --sparse writes erased holes up to this size instead of splitting the write
+SPARSE_BRIDGE = 2 * FLASH_SECTOR_SIZE
+
+
+def prepare_image(esp, offset, data, args):
+    """Image bytes exactly as esptool.write_flash puts them into flash"""
+    image = esptool.pad_to(data, 4)
+    return prevent_print(esptool._update_image_flash_params, esp, offset, args, image)
+
+
+def flash_md5(stub_chip, offset, size):
+    try:
+        return stub_chip.flash_md5sum(offset, size)
+    except esptool.FatalError as err:
+        raise EsphomeflasherError("Error reading flash checksum at 0x{:X}: {}".format(offset, err))
+
+
+def merge_runs(runs, gap=0):
+    """Join (start, end) ranges which touch, overlap or are at most gap apart, input sorted by start"""
+    merged = []
+    for start, end in runs:
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class SectionFile(io.RawIOBase):
+    """Read-only window of size bytes at start of a seekable file, which it owns"""
+
+    def __init__(self, f, start: int, size: int, name: str = ""):
+        self._file = f
+        self._start = start
+        self._size = size
+        self._pos = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        if self._file.tell() != self._start + self._pos:
+            self._file.seek(self._start + self._pos)
+        data = self._file.read(size)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class ImageSource:
+    """Bytes of one addr_filename entry as esptool writes them, read block by block
+
+    Only the bootloader, whose header is patched, is held in memory.
+    Sections of buffer backed files (mapped package members) are slices of
+    the buffer, sections of deflated members reopen the member and inflate
+    up to their start. Nothing is copied.
+    """
+
+    def __init__(self, esp, offset: int, argfile, args):
+        self.offset = offset
+        self._argfile = argfile
+        self._view = None
+        if offset == esp.BOOTLOADER_FLASH_OFFSET:
+            self._view = memoryview(prepare_image(esp, offset, argfile.read(), args))
+        elif hasattr(argfile, 'getbuffer'):
+            self._view = memoryview(argfile.getbuffer()).cast('B')
+        elif getattr(argfile, 'image', None) is None:
+            # a plain file which cannot be reopened
+            self._view = memoryview(argfile.read())
+        argfile.seek(0)
+        if self._view is not None:
+            self.size = len(self._view)
+        else:
+            self.size = argfile.seek(0, io.SEEK_END)
+            argfile.seek(0)
+
+    @property
+    def padded_size(self):
+        """Size in flash, esptool pads images to 4 bytes with 0xFF"""
+        return align_up(self.size, 4)
+
+    def blocks(self, block_size: int):
+        """(start, block) over the image, the last block padded like in flash"""
+        argfile = self._argfile
+        for start in range(0, self.size, block_size):
+            if self._view is not None:
+                block = self._view[start:start + block_size]
+            else:
+                block = argfile.read(block_size)
+            if len(block) % 4:
+                block = bytes(block) + b'\xff' * (4 - len(block) % 4)
+            yield start, block
+        argfile.seek(0)
+
+    def section(self, start: int, end: int):
+        """Independent file of bytes start to end of the image"""
+        from esphomeflasher.package import MemoryFile
+
+        end = min(end, self.size)
+        name = "{}@0x{:X}".format(getattr(self._argfile, 'name', ''), start)
+        if self._view is not None:
+            return MemoryFile(self._view[start:end], name)
+        return SectionFile(self._argfile.image.open(), start, end - start, name)
+
+
+def diff_regions(stub_chip, args, block_size=DIFF_BLOCK_SIZE):
+    """Compare images in args.addr_filename with flash contents
+
+    The stub computes MD5 digests of each image, and of every block_size block
+    of images which differ. Returns a new addr_filename list with only the
+    changed blocks, adjacent changed blocks are merged into one write. Images
+    are hashed block by block in one pass, changed blocks are sections of
+    the images, not copies.
+    """
+    addr_filename = []
+    total = 0
+    changed = 0
+    for offset, argfile in args.addr_filename:
+        source = ImageSource(stub_chip, offset, argfile, args)
+        size = source.padded_size
+        total += size
+        md5 = hashlib.md5()
+        digests = []
+        for start, block in source.blocks(block_size):
+            md5.update(block)
+            digests.append((start, len(block), hashlib.md5(block).hexdigest()))
+        if flash_md5(stub_chip, offset, size) == md5.hexdigest():
+            print("0x{:08X}: {} bytes unchanged".format(offset, size))
+            continue
+        runs = []
+        for start, length, digest in digests:
+            if flash_md5(stub_chip, offset + start, length) != digest:
+                runs.append((start, start + length))
+        for start, end in merge_runs(runs):
+            addr_filename.append((offset + start, source.section(start, end)))
+            changed += end - start
+        print("0x{:08X}: {} of {} bytes changed".format(offset, sum(e - s for s, e in runs), size))
+    print("Differential flash: writing {} of {} bytes".format(changed, total))
+    return addr_filename
+
+
+def verify_regions(stub_chip, regions):
+    """Compare the flash MD5 of (offset, size, md5, name) regions with their host digests
+
+    Raises listing the regions which differ.
+    """
+    start_time = time.time()
+    failed = []
+    for offset, size, md5, name in regions:
+        if flash_md5(stub_chip, offset, size) != md5:
+            print("0x{:08X}: {} does not match flash contents".format(offset, name))
+            failed.append(name)
+    if failed:
+        raise EsphomeflasherError("Verification failed: {}".format(", ".join(failed)))
+    print("Verified {} region(s), {} bytes in {:.1f}s".format(
+        len(regions), sum(size for _, size, _, _ in regions), time.time() - start_time))
+
+
+def align_down(value, alignment):
+    return value - value % alignment
+
+
+def align_up(value, alignment):
+    return align_down(value + alignment - 1, alignment)
+
+
+def plan_erase(regions, flash_size=None):
+    """Sector aligned, merged (start, end) ranges covering (offset, size) regions"""
+    ranges = []
+    for offset, size in sorted(regions):
+        if size <= 0:
+            continue
+        end = align_up(offset + size, FLASH_SECTOR_SIZE)
+        if flash_size is not None and end > flash_size:
+            raise EsphomeflasherError("Region 0x{:X}-0x{:X} does not fit in flash".format(offset, offset + size))
+        ranges.append((align_down(offset, FLASH_SECTOR_SIZE), end))
+    return merge_runs(ranges)
+
+
+def invert_ranges(ranges, flash_size):
+    """Ranges of flash not covered by ranges"""
+    inverted = []
+    pos = 0
+    for start, end in ranges:
+        if start > pos:
+            inverted.append((pos, start))
+        pos = max(pos, end)
+    if pos < flash_size:
+        inverted.append((pos, flash_size))
+    return inverted
+
+
+def erase_units(ranges):
+    """Number of 64 KiB block and 4 KiB sector erases needed for ranges
+
+    The stub erases whole blocks where a range is block aligned and falls
+    back to sectors for the unaligned head and tail.
+    """
+    blocks = 0
+    sectors = 0
+    for start, end in ranges:
+        block_start = align_up(start, FLASH_BLOCK_SIZE)
+        block_end = align_down(end, FLASH_BLOCK_SIZE)
+        if block_start < block_end:
+            blocks += (block_end - block_start) // FLASH_BLOCK_SIZE
+            sectors += (block_start - start + end - block_end) // FLASH_SECTOR_SIZE
+        else:
+            sectors += (end - start) // FLASH_SECTOR_SIZE
+    return blocks, sectors
+
+
+def erase_ranges(stub_chip, ranges):
+    """Erase ranges with one erase_region command each, returns elapsed seconds"""
+    start_time = time.time()
+    for start, end in ranges:
+        try:
+            stub_chip.erase_region(start, end - start)
+        except esptool.FatalError as err:
+            raise EsphomeflasherError("Error while erasing flash at 0x{:X}: {}".format(start, err))
+    return time.time() - start_time
+
+
+def erase_chip(stub_chip):
+    """Erase the whole flash with one chip erase command, returns elapsed seconds"""
+    start_time = time.time()
+    try:
+        stub_chip.erase_flash()
+    except esptool.FatalError as err:
+        raise EsphomeflasherError("Error while erasing flash: {}".format(err))
+    return time.time() - start_time
+
+
+def erase_planned(stub_chip, regions, flash_size, erase_unused=False, metrics=None):
+    """Erase only flash regions which get written, erase_unused also wipes everything else
+
+    A plan covering the whole flash is done with a chip erase. The result
+    is recorded in metrics as 'erase'.
+    """
+    ranges = plan_erase(regions, flash_size)
+    if erase_unused:
+        ranges = merge_runs(sorted(ranges + invert_ranges(ranges, flash_size)))
+    size = sum(end - start for start, end in ranges)
+    chip_erase = ranges == [(0, flash_size)]
+    if chip_erase:
+        print("Erasing flash (this may take a while)...")
+        elapsed = erase_chip(stub_chip)
+    else:
+        blocks, sectors = erase_units(ranges)
+        print("Erasing {} region(s), {} KB ({} blocks, {} sectors)...".format(
+            len(ranges), size // 1024, blocks, sectors))
+        elapsed = erase_ranges(stub_chip, ranges)
+    print("Erase completed in {:.1f}s".format(elapsed))
+    saved = 0.0
+    if 0 < size < flash_size:
+        # extrapolated from the measured erase rate
+        saved = elapsed * (flash_size - size) / size
+        print("Skipped {} KB of unused flash, saved ~{:.1f}s over full chip erase".format(
+            (flash_size - size) // 1024, saved))
+    if metrics is not None:
+        metrics.set('erase', {
+            'ranges': len(ranges),
+            'bytes': size,
+            'chip_erase': chip_erase,
+            'elapsed': round(elapsed, 3),
+            'saved_estimate': round(saved, 3),
+        })
+    return elapsed
+
+
+def sparse_extents(image, sector_size=FLASH_SECTOR_SIZE, bridge=SPARSE_BRIDGE):
+    """(start, end) ranges of image sectors which are not entirely 0xFF
+
+    Erased holes up to bridge bytes are written anyway, each separate
+    write costs more round trips than writing a few erased sectors.
+    """
+    erased = ERASED_SECTOR if sector_size == FLASH_SECTOR_SIZE else b'\xff' * sector_size
+    extents = []
+    for start in range(0, len(image), sector_size):
+        chunk = image[start:start + sector_size]
+        if chunk == erased[:len(chunk)]:
+            continue
+        extents.append((start, start + len(chunk)))
+    return merge_runs(extents, bridge)
+
+
+def sparse_regions(esp, args):
+    """Split images in args.addr_filename into non-empty extents
+
+    Only valid when the target regions have been erased before, skipped
+    sectors are left in erased state. Images are scanned block by block,
+    extents are sections of the images, not copies. Returns the new
+    addr_filename list and the number of bytes skipped.
+    """
+    addr_filename = []
+    skipped = 0
+    for offset, argfile in args.addr_filename:
+        source = ImageSource(esp, offset, argfile, args)
+        extents = []
+        for start, block in source.blocks(DIFF_BLOCK_SIZE):
+            extents += [(start + s, start + e) for s, e in sparse_extents(block)]
+        # holes across block boundaries are bridged like inside a block
+        extents = merge_runs(extents, SPARSE_BRIDGE)
+        for start, end in extents:
+            addr_filename.append((offset + start, source.section(start, end)))
+        skipped += source.padded_size - sum(end - start for start, end in extents)
+    return addr_filename, skipped
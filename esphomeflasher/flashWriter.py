@@ -0,0 +1,445 @@
+import copy
+import hashlib
+import io
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, Tuple, Union
+
+import esptool
+
+from esphomeflasher.diskCache import get_compressed_cache
+from esphomeflasher.flashPlan import prepare_image
+
+# uncompressed bytes compressed at a time, the whole image is never held uncompressed
+COMPRESS_CHUNK = 64 * 1024
+# same level as esptool.write_flash
+COMPRESS_LEVEL = 9
+# the flasher always runs the ESP32 stub
+STUB_WRITE_SIZE = esptool.ESP32StubLoader.FLASH_WRITE_SIZE
+BOOTLOADER_OFFSET = esptool.ESP32ROM.BOOTLOADER_FLASH_OFFSET
+# zlib stream header (deflate, 32K window, default level) around a raw zip deflate stream
+ZLIB_HEADER = b'\x78\x9c'
+# levels the writer chooses from when compression is 'auto'
+AUTO_LEVELS = (1, 6, 9)
+# an image's compression is estimated on this many samples spread over it
+SAMPLE_SIZE = 16 * 1024
+SAMPLE_COUNT = 4
+# share of the baud rate carrying data: 8N1 framing, SLIP escaping, command headers
+LINK_EFFICIENCY = 0.85
+# shorter writes are mostly latency, the link rate is measured over at least this many bytes
+LINK_MIN_BYTES = 64 * 1024
+
+
+def image_size(argfile) -> int:
+    """Length of an addr_filename file, without reading it"""
+    pos = argfile.tell()
+    size = argfile.seek(0, io.SEEK_END)
+    argfile.seek(pos)
+    return size
+
+
+def split_blocks(parts, block_size):
+    """Blocks of block_size bytes over a sequence of buffers, without joining them first"""
+    pending = bytearray()
+    for part in parts:
+        view = memoryview(part)
+        pos = 0
+        if pending:
+            pos = block_size - len(pending)
+            pending += view[:pos]
+            if len(pending) < block_size:
+                continue
+            yield bytes(pending)
+            pending = bytearray()
+        while len(view) - pos >= block_size:
+            yield view[pos:pos + block_size].tobytes()
+            pos += block_size
+        pending += view[pos:]
+    if pending:
+        yield bytes(pending)
+
+
+def can_pass_through(image, address, bootloader_offset) -> bool:
+    """Deflated package (or merged) image which esptool would not modify
+
+    Not at the bootloader offset (flash parameters are patched there) and
+    already padded to 4 bytes.
+    """
+    if image is None or image.deflate_parts is None or not image.md5:
+        return False
+    return address == image.offset and address != bootloader_offset and not image.size % 4
+
+
+def passthrough_stream(esp, address, argfile):
+    """(zlib stream parts, size, md5) when the zip member can be sent without recompressing"""
+    image = getattr(argfile, 'image', None)
+    if not can_pass_through(image, address, esp.BOOTLOADER_FLASH_OFFSET):
+        return None
+    parts = [ZLIB_HEADER] + image.deflate_parts + [struct.pack('>I', image.adler32)]
+    return parts, image.size, image.md5
+
+
+def compress_image(data, level=COMPRESS_LEVEL) -> Tuple[bytes, int, str]:
+    """(zlib stream, size, md5) of image bytes padded like esptool does, also run in worker processes"""
+    data = esptool.pad_to(bytes(data), 4)
+    return zlib.compress(data, level), len(data), hashlib.md5(data).hexdigest()
+
+
+def compressed_stream(esp, address, argfile, args, level=COMPRESS_LEVEL):
+    """(zlib stream parts, size, md5) of an image compressed in chunks as esptool would write it"""
+    md5 = hashlib.md5()
+    compressor = zlib.compressobj(level)
+    compressed = bytearray()
+    size = 0
+    if address == esp.BOOTLOADER_FLASH_OFFSET:
+        # small, and flash parameters in its header may be patched
+        chunks = [prepare_image(esp, address, argfile.read(), args)]
+    else:
+        chunks = iter(lambda: argfile.read(COMPRESS_CHUNK), b'')
+    for chunk in chunks:
+        md5.update(chunk)
+        compressed += compressor.compress(chunk)
+        size += len(chunk)
+    if size % 4:
+        padding = b'\xff' * (4 - size % 4)
+        md5.update(padding)
+        compressed += compressor.compress(padding)
+        size += len(padding)
+    compressed += compressor.flush()
+    argfile.seek(0)
+    return [compressed], size, md5.hexdigest()
+
+
+def print_overwrite(message, last_line=False):
+    """Progress line which the next one overwrites, esptool 2.8 has no print_overwrite"""
+    if hasattr(esptool, 'print_overwrite'):
+        esptool.print_overwrite(message, last_line)
+    else:
+        print('\r' + message, end='\n' if last_line else '')
+
+
+def write_stream(esp, address, parts, size, md5):
+    """Send a zlib stream to flash at address and verify the flash MD5"""
+    compsize = sum(len(part) for part in parts)
+    ratio = size / compsize if compsize else 1.0
+    blocks = esp.flash_defl_begin(size, compsize, address)
+    start = time.time()
+    written = 0
+    for seq, block in enumerate(split_blocks(parts, esp.FLASH_WRITE_SIZE)):
+        print_overwrite('Writing at 0x%08x... (%d %%)' % (
+            address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks))
+        sys.stdout.flush()
+        esp.flash_defl_block(block, seq, timeout=esptool.DEFAULT_TIMEOUT * ratio * 2)
+        written += len(block)
+    elapsed = time.time() - start
+    speed = " (effective %.1f kbit/s)" % (size / elapsed * 8 / 1000) if elapsed > 0 else ""
+    print_overwrite('Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % (
+        size, written, address, elapsed, speed), last_line=True)
+    verify_md5(esp, address, size, md5)
+    return written, elapsed
+
+
+def write_raw(esp, address, argfile, data=None):
+    """Send an image uncompressed and verify the flash MD5, returns (bytes sent, seconds)"""
+    source = argfile if data is None else io.BytesIO(data)
+    size = image_size(source)
+    size += -size % 4
+    blocks = esp.flash_begin(size, address)
+    md5 = hashlib.md5()
+    start = time.time()
+    written = 0
+    for seq in range(blocks):
+        print_overwrite('Writing at 0x%08x... (%d %%)' % (
+            address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks))
+        sys.stdout.flush()
+        block = source.read(esp.FLASH_WRITE_SIZE)
+        if seq == blocks - 1:
+            block = esptool.pad_to(block, 4)
+        md5.update(block)
+        # like esptool, the last block is padded, the stub only writes size bytes
+        esp.flash_block(block + b'\xff' * (esp.FLASH_WRITE_SIZE - len(block)), seq)
+        written += esp.FLASH_WRITE_SIZE
+    argfile.seek(0)
+    elapsed = time.time() - start
+    speed = " (%.1f kbit/s)" % (written / elapsed * 8 / 1000) if elapsed > 0 else ""
+    print_overwrite('Wrote %d bytes at 0x%08x in %.1f seconds%s...' % (
+        size, address, elapsed, speed), last_line=True)
+    verify_md5(esp, address, size, md5.hexdigest())
+    return written, elapsed
+
+
+def verify_md5(esp, address, size, md5):
+    flash_md5 = esp.flash_md5sum(address, size)
+    if flash_md5 != md5:
+        print('File  md5: %s' % md5)
+        print('Flash md5: %s' % flash_md5)
+        raise esptool.FatalError("MD5 of file does not match data in flash!")
+    print('Hash of data verified.')
+
+
+def image_samples(argfile, size) -> bytes:
+    """Up to SAMPLE_COUNT blocks of SAMPLE_SIZE bytes spread evenly over the image"""
+    if size <= SAMPLE_SIZE * SAMPLE_COUNT:
+        sample = argfile.read()
+    else:
+        step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+        parts = []
+        for i in range(SAMPLE_COUNT):
+            argfile.seek(i * step)
+            parts.append(argfile.read(SAMPLE_SIZE))
+        sample = b''.join(parts)
+    argfile.seek(0)
+    return sample
+
+
+def estimate_compression(sample: bytes, levels) -> Dict[int, Tuple[float, float]]:
+    """{level: (compressed / uncompressed size, host compression bytes per second)} measured on sample"""
+    estimates = {}
+    for level in levels:
+        start = time.perf_counter()
+        compressed = len(zlib.compress(sample, level))
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        estimates[level] = (compressed / max(len(sample), 1), len(sample) / elapsed)
+    return estimates
+
+
+# streams of precompress() by cache key, until they are in the compressed cache
+_streams: Dict[Tuple[str, int, int], Future] = {}
+_streams_lock = threading.Lock()
+_pool: Union[None, ProcessPoolExecutor] = None
+
+
+def image_digest(esp, address, argfile, args):
+    """(SHA-256 of the bytes written to flash, those bytes or None), part of the cache keys
+
+    Whole package images have their digest already, other entries (the
+    bootloader, --sparse and --diff slices) are read and hashed.
+    """
+    image = getattr(argfile, 'image', None)
+    if image is not None and image.sha256 and address == image.offset and address != esp.BOOTLOADER_FLASH_OFFSET:
+        return image.sha256, None
+    data = argfile.read()
+    argfile.seek(0)
+    if address == esp.BOOTLOADER_FLASH_OFFSET:
+        data = prepare_image(esp, address, data, args)
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def _store_stream(key, future: Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    cache = get_compressed_cache()
+    cache.put(*key, *future.result())
+    if cache.has(*key):
+        # without a cache the stream stays in memory for the next board
+        with _streams_lock:
+            _streams.pop(key, None)
+
+
+def cached_stream(key):
+    """(zlib stream parts, size, md5) from the compressed cache or precompress(), or None"""
+    cached = get_compressed_cache().get(*key)
+    if cached is not None:
+        return [cached[0]], cached[1], cached[2]
+    with _streams_lock:
+        future = _streams.get(key)
+    if future is None:
+        return None
+    try:
+        # precompress() may still be working on it
+        stream, size, md5 = future.result()
+    except Exception as e:
+        print("Precompressing failed: {}".format(e))
+        return None
+    return [stream], size, md5
+
+
+def compress_entry(esp, address, argfile, args, data, key):
+    """(zlib stream parts, size, md5) compressed at the level of the cache key, stored in the cache"""
+    level = key[1]
+    if data is None:
+        parts, size, md5 = compressed_stream(esp, address, argfile, args, level)
+        compressed = parts[0]
+    else:
+        compressed, size, md5 = compress_image(data, level)
+    get_compressed_cache().put(*key, compressed, size, md5)
+    return [compressed], size, md5
+
+
+def get_pool(workers=None) -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+def precompress(images, workers=None, level=COMPRESS_LEVEL, block_size=STUB_WRITE_SIZE) -> List[Future]:
+    """Compress the images (package or merged) which cannot be passed through in worker processes
+
+    Streams go into the compressed cache, a write which needs one before it
+    is done waits for it instead of compressing the image again. Images
+    cached or being compressed already are skipped, so it can be called for
+    every flashed board. The bootloader is left out, its header depends on
+    the flash size of the chip.
+    """
+    cache = get_compressed_cache()
+    futures = []
+    for image in images:
+        if image.offset == BOOTLOADER_OFFSET or can_pass_through(image, image.offset, BOOTLOADER_OFFSET):
+            continue
+        key = (image.sha256, level, block_size)
+        with _streams_lock:
+            future = _streams.get(key)
+            if future is None:
+                if cache.has(*key):
+                    continue
+                try:
+                    future = get_pool(workers).submit(compress_image, bytes(image.data), level)
+                except (OSError, RuntimeError) as e:
+                    print("Cannot precompress images: {}".format(e))
+                    break
+                future.add_done_callback(partial(_store_stream, key))
+                _streams[key] = future
+                print("Precompressing {} ({} bytes)".format(image.filename, image.size))
+        futures.append(future)
+    return futures
+
+
+class FlashWriter:
+    """Writes addr_filename entries with the stub, choosing per image how to send it
+
+    Zip deflate streams and cached streams cost no host time and are sent
+    as they are. Other images are compressed at the zlib level, or sent
+    uncompressed, with the shortest estimated time: host compression time,
+    from compressing samples of the image, plus the bytes sent at the link
+    rate measured by the previous writes. compression 'none' or a level
+    ('1' to '9') forces the choice. Choices are recorded in metrics as
+    'compression'.
+    """
+
+    def __init__(self, esp, args, compression='auto', metrics=None):
+        self.esp = esp
+        self.args = args
+        self.compression = compression
+        self.metrics = metrics
+        self.choices: List[Dict] = []
+        self._link_baud = None
+        self._link_bytes = 0
+        self._link_time = 0.0
+
+    @property
+    def fallback(self):
+        """Left to esptool.write_flash"""
+        return not self.esp.IS_STUB or not self.args.compress or self.args.encrypt or self.args.erase_all
+
+    @property
+    def levels(self):
+        if self.compression == 'auto':
+            return AUTO_LEVELS
+        if self.compression == 'none':
+            return ()
+        return (int(self.compression),)
+
+    def link_rate(self) -> float:
+        """Data bytes per second over the serial link, from the baud rate until enough was written
+
+        The measured rate includes the time the chip takes to write the
+        flash, which only makes the estimate favour compression.
+        """
+        baud = self.esp._port.baudrate
+        if baud != self._link_baud:
+            self._link_baud = baud
+            self._link_bytes = 0
+            self._link_time = 0.0
+        if self._link_bytes >= LINK_MIN_BYTES and self._link_time > 0:
+            return self._link_bytes / self._link_time
+        return baud / 10 * LINK_EFFICIENCY
+
+    def choose_level(self, argfile, data, size, choice) -> int:
+        """zlib level with the shortest estimated write time, 0 to send uncompressed"""
+        levels = self.levels
+        if len(levels) <= 1:
+            return levels[0] if levels else 0
+        sample = image_samples(argfile if data is None else io.BytesIO(data), size)
+        link = self.link_rate()
+        best_level = 0
+        # uncompressed, the last block is sent padded
+        best_time = -(-size // self.esp.FLASH_WRITE_SIZE) * self.esp.FLASH_WRITE_SIZE / link
+        for level, (ratio, rate) in sorted(estimate_compression(sample, levels).items()):
+            estimate = size / rate + size * ratio / link
+            if estimate < best_time:
+                best_level = level
+                best_time = estimate
+                choice['ratio'] = round(ratio, 3)
+        choice['estimate'] = round(best_time, 3)
+        print("Compression of 0x{:08X}: {} (estimated {:.1f}s at {:.1f} KB/s)".format(
+            choice['offset'], "level {}".format(best_level) if best_level else "none",
+            best_time, link / 1024))
+        return best_level
+
+    def prepare(self, address, argfile, size, choice):
+        """(zlib stream parts, size, md5) to send or None to send it raw, and the image data if it was read"""
+        esp = self.esp
+        stream = None
+        data = None
+        if self.levels:
+            stream = passthrough_stream(esp, address, argfile)
+            choice['method'] = 'passthrough'
+        if stream is None and self.levels:
+            sha256, data = image_digest(esp, address, argfile, self.args)
+            for level in self.levels[::-1]:
+                stream = cached_stream((sha256, level, esp.FLASH_WRITE_SIZE))
+                if stream is not None:
+                    print("Using compressed stream from cache ({} bytes)".format(len(stream[0][0])))
+                    choice.update(method='cached', level=level)
+                    break
+            if stream is None:
+                level = self.choose_level(argfile, data, size, choice)
+                if level:
+                    stream = compress_entry(esp, address, argfile, self.args, data,
+                                            (sha256, level, esp.FLASH_WRITE_SIZE))
+                    choice.update(method='compressed', level=level)
+        return stream, data
+
+    def write(self, address, argfile):
+        if self.fallback:
+            args = copy.copy(self.args)
+            args.addr_filename = [(address, argfile)]
+            esptool.write_flash(self.esp, args)
+            return
+        esp = self.esp
+        size = image_size(argfile)
+        if not size:
+            print('WARNING: File %s is empty' % getattr(argfile, 'name', ''))
+            return
+        choice = {'offset': address, 'size': size, 'link_rate': round(self.link_rate())}
+        stream, data = self.prepare(address, argfile, size, choice)
+        if stream is not None:
+            written, elapsed = write_stream(esp, address, *stream)
+        else:
+            if data is None and address == esp.BOOTLOADER_FLASH_OFFSET:
+                data = prepare_image(esp, address, argfile.read(), self.args)
+                argfile.seek(0)
+            choice['method'] = 'raw'
+            written, elapsed = write_raw(esp, address, argfile, data)
+        self.link_rate()
+        self._link_bytes += written
+        self._link_time += elapsed
+        choice.update(offset='0x{:X}'.format(address), wire_bytes=written, elapsed=round(elapsed, 3))
+        self.choices.append(choice)
+        if self.metrics is not None:
+            self.metrics.set('compression', self.choices)
+
+    def finish(self):
+        if self.fallback:
+            return
+        print('\nLeaving...')
+        # like esptool, do not send flash_finish which would make the ROM loader run user code
+        self.esp.flash_begin(0, 0)
+        self.esp.flash_defl_finish(False)
+
@@ -1,27 +1,28 @@
 # This GUI is a fork of the brilliant https://github.com/marcelstoer/nodemcu-pyflasher
 import io
-import re
 import sys
 import threading
-import io
+import time
+from concurrent.futures import Future
 
 from urllib.parse import urljoin
-from urllib.request import urlopen
 
 import wx
 import wx.adv
 from wx.lib.embeddedimage import PyEmbeddedImage
-import wx.lib.inspection
-import wx.lib.mixins.inspection
 # from wx.lib.wordwrap import wordwrap
 
 from esphomeflasher.__main__ import run_esphomeflasher_kwargs
-from esphomeflasher.helpers import list_serial_ports
-from esphomeflasher.common import fujinet_version_info
+from esphomeflasher.helpers import list_serial_ports, rebase_url
+from esphomeflasher.common import EsphomeflasherError, fujinet_version_info
 
 from esphomeflasher.const import FUJINET_PLATFORMS_URL
 from esphomeflasher.const import __version__
 from esphomeflasher.const import FUJINET_FLASHER_VERSION_URL
+from esphomeflasher.autoBaud import AUTO_BAUD, parse_baud_rate
+from esphomeflasher.console import CONSOLE_MAX_LINES, ConsoleBuffer
+from esphomeflasher.download import get_session
+from esphomeflasher.prefetch import Prefetcher
 from esphomeflasher.remoteFile import RemoteFile, RemoteFileEvent, flush_cache
 import esphomeflasher.fnPlatform as fnPlatform
 import esphomeflasher.fnRelease as fnRelease
@@ -30,7 +31,6 @@ from typing import Union
 from typing import List
 
 
-COLOR_RE = re.compile(r'(?:\033)(?:\[(.*?)[@-~]|\].*?(?:\007|\033\\))')
 COLORS = {
     'black': wx.BLACK,
     'red': wx.RED,
@@ -43,121 +43,71 @@ COLORS = {
 }
 FORE_COLORS = {**COLORS, None: wx.WHITE}
 BACK_COLORS = {**COLORS, None: wx.BLACK}
+CONSOLE_FLUSH_INTERVAL_MS = 50
+VERSION_CHECK_TIMEOUT = 10
 
 
 # See discussion at http://stackoverflow.com/q/41101897/131929
 class RedirectText(io.TextIOBase):
-    def __init__(self, text_ctrl):
+    """stdout sink for the console control
+
+    Output of all threads is collected in a ConsoleBuffer and rendered by a
+    timer in the GUI thread every CONSOLE_FLUSH_INTERVAL_MS, the control
+    keeps the last max_lines lines.
+    """
+
+    def __init__(self, text_ctrl, max_lines=CONSOLE_MAX_LINES):
         self._out = text_ctrl
-        self._i = 0
-        self._line = ''
-        self._bold = False
-        self._italic = False
-        self._underline = False
-        self._foreground = None
-        self._background = None
-        self._secret = False
-
-    def _add_content(self, value):
-        attr = wx.TextAttr()
-        if self._bold:
-            attr.SetFontWeight(wx.FONTWEIGHT_BOLD)
-        attr.SetTextColour(FORE_COLORS[self._foreground])
-        attr.SetBackgroundColour(BACK_COLORS[self._background])
-        wx.CallAfter(self._out.SetDefaultStyle, attr)
-        wx.CallAfter(self._out.AppendText, value)
-
-    def _write_line(self):
-        pos = 0
-        while True:
-            match = COLOR_RE.search(self._line, pos)
-            if match is None:
-                break
-
-            j = match.start()
-            self._add_content(self._line[pos:j])
-            pos = match.end()
-
-            for code in match.group(1).split(';'):
-                code = int(code)
-                if code == 0:
-                    self._bold = False
-                    self._italic = False
-                    self._underline = False
-                    self._foreground = None
-                    self._background = None
-                    self._secret = False
-                elif code == 1:
-                    self._bold = True
-                elif code == 3:
-                    self._italic = True
-                elif code == 4:
-                    self._underline = True
-                elif code == 5:
-                    self._secret = True
-                elif code == 6:
-                    self._secret = False
-                elif code == 22:
-                    self._bold = False
-                elif code == 23:
-                    self._italic = False
-                elif code == 24:
-                    self._underline = False
-                elif code == 30:
-                    self._foreground = 'black'
-                elif code == 31:
-                    self._foreground = 'red'
-                elif code == 32:
-                    self._foreground = 'green'
-                elif code == 33:
-                    self._foreground = 'yellow'
-                elif code == 34:
-                    self._foreground = 'blue'
-                elif code == 35:
-                    self._foreground = 'magenta'
-                elif code == 36:
-                    self._foreground = 'cyan'
-                elif code == 37:
-                    self._foreground = 'white'
-                elif code == 39:
-                    self._foreground = None
-                elif code == 40:
-                    self._background = 'black'
-                elif code == 41:
-                    self._background = 'red'
-                elif code == 42:
-                    self._background = 'green'
-                elif code == 43:
-                    self._background = 'yellow'
-                elif code == 44:
-                    self._background = 'blue'
-                elif code == 45:
-                    self._background = 'magenta'
-                elif code == 46:
-                    self._background = 'cyan'
-                elif code == 47:
-                    self._background = 'white'
-                elif code == 49:
-                    self._background = None
-
-        self._add_content(self._line[pos:])
+        self._buffer = ConsoleBuffer(max_lines)
+        self._attrs = {}
+        self._timer = wx.Timer()
+        self._timer.Bind(wx.EVT_TIMER, lambda event: self.render())
+        self._timer.Start(CONSOLE_FLUSH_INTERVAL_MS)
+
+    def _attr(self, style):
+        attr = self._attrs.get(style)
+        if attr is None:
+            attr = wx.TextAttr(FORE_COLORS[style.foreground], BACK_COLORS[style.background])
+            if style.bold:
+                attr.SetFontWeight(wx.FONTWEIGHT_BOLD)
+            if style.italic:
+                attr.SetFontStyle(wx.FONTSTYLE_ITALIC)
+            if style.underline:
+                attr.SetFontUnderlined(True)
+            self._attrs[style] = attr
+        return attr
+
+    def render(self):
+        """Apply pending output to the control, GUI thread only"""
+        ops, trim = self._buffer.take()
+        if not ops and not trim:
+            return
+        self._out.Freeze()
+        try:
+            for op in ops:
+                if op[0] == 'remove':
+                    end = self._out.GetLastPosition()
+                    self._out.Remove(end - op[1], end)
+                else:
+                    self._out.SetDefaultStyle(self._attr(op[1]))
+                    self._out.AppendText(op[2])
+            if trim:
+                pos = self._out.XYToPosition(0, trim)
+                if pos > 0:
+                    self._out.Remove(0, pos)
+        finally:
+            self._out.Thaw()
+
+    def clear(self):
+        """Empty the console, GUI thread only"""
+        self._buffer.clear()
+        self._out.SetValue("")
+
+    def stop(self):
+        self._timer.Stop()
 
     def write(self, string):
-        for s in string:
-            if s == '\r':
-                current_value = self._out.GetValue()
-                last_newline = current_value.rfind("\n")
-                wx.CallAfter(self._out.Remove, last_newline + 1, len(current_value))
-                # self._line += '\n'
-                self._write_line()
-                self._line = ''
-                continue
-            self._line += s
-            if s == '\n':
-                self._write_line()
-                self._line = ''
-                continue
-        return len(string)
+        return self._buffer.write(string)
 
     def writable(self):
         return True
@@ -181,29 +131,65 @@ class FlashingThread(threading.Thread):
             raise
 
 
+def run_in_background(name, func, on_done):
+    """Run func in a daemon thread and pass its result to on_done in the GUI thread
+
+    on_done gets (result, None) or (None, exception).
+    """
+    def run():
+        try:
+            result, error = func(), None
+        except Exception as e:
+            result, error = None, e
+        wx.CallAfter(on_done, result, error)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def fetch_flasher_version():
+    with get_session().get(rebase_url(FUJINET_FLASHER_VERSION_URL), timeout=VERSION_CHECK_TIMEOUT) as resp:
+        resp.raise_for_status()
+        return resp.content.decode('utf-8').strip()
+
+
+def scan_serial_ports():
+    return [port for port, desc in list_serial_ports()]
+
+
 class MainFrame(wx.Frame):
     EVT_DOWNLOAD_PLATFORMS = wx.NewId()
     EVT_DOWNLOAD_RELEASES = wx.NewId()
-    EVT_DOWNLOAD_FIRMWARE = wx.NewId()
 
-    def __init__(self, parent, title):
+    def __init__(self, parent, title, started=None):
         wx.Frame.__init__(self, parent, -1, title, style=wx.DEFAULT_FRAME_STYLE | wx.NO_FULL_REPAINT_ON_RESIZE)
 
+        # time-to-interactive is measured from here to the first idle event
+        self._started = time.perf_counter() if started is None else started
+        self.time_to_interactive = None
+
         self._firmware = None
         self._port = None
+        self._ports: List[str] = []
         self._upload_baud_rate = 460800
+        self._farm = False
 
         self.platforms: List[fnPlatform.FujiNetPlatform] = []
-        self.platforms_rf = RemoteFile(FUJINET_PLATFORMS_URL, self, self.EVT_DOWNLOAD_PLATFORMS)
+        # FUJINET_FLASHER_BASE_URL may point to a LAN mirror
+        self.platforms_url = rebase_url(FUJINET_PLATFORMS_URL)
+        self.platforms_rf = RemoteFile(self.platforms_url, self, self.EVT_DOWNLOAD_PLATFORMS)
         self.chosen_platform: Union[None, fnPlatform.FujiNetPlatform] = None
         self.releases: List[fnRelease.FujiNetRelease] = []
         self.releases_rf: Union[None, RemoteFile] = None
         self.chosen_release: Union[None, fnRelease.FujiNetRelease] = None
-        self.firmware_rf: Union[None, RemoteFile] = None
+        self.prefetcher = Prefetcher()
+        self.firmware_future: Union[None, Future] = None
 
         self._init_ui()
 
-        sys.stdout = RedirectText(self.console_ctrl)
+        self.console = RedirectText(self.console_ctrl)
+        sys.stdout = self.console
 
         # HiDPI friendly attempt
         w, h = self.GetTextExtent("MMMMMMMMMM")
@@ -214,6 +200,7 @@ class MainFrame(wx.Frame):
         self.SetClientSize((int(725*f),int(650*f)))
         self.SetMinClientSize((int(640*f), int(480*f)))
         self.Centre(wx.BOTH)
+        self.Bind(wx.EVT_IDLE, self._on_first_idle)
         self.Show(True)
 
     def _init_ui(self):
@@ -222,25 +209,27 @@ class MainFrame(wx.Frame):
             self.platforms_rf.cancel()
             if self.releases_rf is not None:
                 self.releases_rf.cancel()
-            if self.firmware_rf is not None:
-                self.firmware_rf.cancel()
+            cancel_firmware_future()
+            self.prefetcher.shutdown()
+            self.console.stop()
             self.Destroy()
 
         def on_reload(event):
-            self.port_choice.SetItems(self._get_serial_ports())
+            self._scan_serial_ports()
 
         def on_flash_btn(event):
-            self.console_ctrl.SetValue("")
+            self.console.clear()
             download_firmware()
 
         def on_logs_clicked(event):
-            self.console_ctrl.SetValue("")
+            self.console.clear()
             worker = FlashingThread(port=self._port, upload_baud_rate=self._upload_baud_rate, show_logs=True)
             worker.start()
 
         def download_platforms():
             # flush cached entries
             flush_cache()
+            self.prefetcher.forget_catalogs()
             # reset platforms
             self.platforms = []
             self.chosen_platform = None
@@ -266,6 +255,9 @@ class MainFrame(wx.Frame):
                 self.platform_choice.Set(["-- Select Platform --"]+[p.name for p in self.platforms])
                 self.platform_choice.SetSelection(0)
                 self.platform_choice.Enable()
+                # releases of all platforms, selecting one then shows its list right away
+                for platform in self.platforms:
+                    self.prefetcher.catalog(rebase_url(urljoin(self.platforms_url, platform.url)))
 
         def on_platform_selected(evt: wx.CommandEvent):
             if self._firmware is not None:
@@ -298,11 +290,11 @@ class MainFrame(wx.Frame):
             self.releases = []
             self.chosen_release = None
             self.flash_btn.Disable()
-            url = urljoin(FUJINET_PLATFORMS_URL, self.chosen_platform.url)
+            url = rebase_url(urljoin(self.platforms_url, self.chosen_platform.url))
             if self.releases_rf is not None:
                 self.releases_rf.cancel()
             self.releases_rf = RemoteFile(url, self, self.EVT_DOWNLOAD_RELEASES)
-            self.releases_rf.get(use_cache=True)
+            self.releases_rf.get(use_cache=True, prefetched=self.prefetcher.catalog(url))
 
         def on_releases_downloaded(evt: RemoteFileEvent):
             if evt.remote_file.status == RemoteFile.STATUS_OK:
@@ -327,51 +319,84 @@ class MainFrame(wx.Frame):
                 # print("firmware version:", self.chosen_release.named_version)
                 update_firmware_info_text(self.chosen_release.info_text)
                 self.flash_btn.Enable()
+                # download and verify now, Flash then starts with the package at hand
+                self.prefetcher.package(firmware_url(), self.chosen_release.sha256)
             else:
                 self.chosen_release = None
                 update_firmware_info_text(None)
                 self.flash_btn.Disable()
 
+        def update_metrics_text(metrics):
+            self.metrics_text.SetLabel("{}: {}".format(metrics.port, metrics.short_text()))
+            self.metrics_text.SetToolTip(metrics.summary_text())
+            self.metrics_text.Wrap(self.GetClientSize().Width - select_label.GetSize().Width - 32)
+            self.Layout()
+
         def update_firmware_info_text(text=None):
             # self.firmware_info_text.SetLabel(wordwrap("\n"*5 if text is None else text, 580, wx.ClientDC(self.firmware_info_text)))
             self.firmware_info_text.SetLabel("\n"*5 if text is None else text)
             self.firmware_info_text.Wrap(self.GetClientSize().Width - select_label.GetSize().Width - 32)
 
+        def flash_kwargs(package):
+            kwargs = dict(port=self._port, upload_baud_rate=self._upload_baud_rate, package=package,
+                          on_metrics=lambda metrics: wx.CallAfter(update_metrics_text, metrics))
+            if self._farm:
+                # all ports from the list, package is loaded once and shared by all workers
+                kwargs.update(farm=True, farm_port=list(self._ports))
+            return kwargs
+
         def download_firmware():
             if self._firmware is not None:
                 print("Installing Custom Firmware")
                 package = open(self._firmware, "rb")
-                worker = FlashingThread(port=self._port, upload_baud_rate=self._upload_baud_rate, package=package)
+                worker = FlashingThread(**flash_kwargs(package))
                 worker.start()
                 self._firmware = None
             else:
                 if self.chosen_platform is None or self.chosen_release is None:
                     return
-                print("Retrieving firmware")
-                url = urljoin(self.releases_rf.url, self.chosen_release.url)
-                if self.firmware_rf is not None:
-                    self.firmware_rf.cancel()
-                self.firmware_rf = RemoteFile(url, self, self.EVT_DOWNLOAD_FIRMWARE)
-                self.firmware_rf.get()
-
-        def on_firmware_downloaded(evt: RemoteFileEvent):
-            if evt.remote_file.status == RemoteFile.STATUS_OK:
-                checksum = self.firmware_rf.sha256
-                ok = self.chosen_release.sha256.lower() == checksum.lower()
-                print("sha256 {} {}".format(checksum, "OK" if ok else "CHECKSUM ERROR"))
-                if not ok:
+                cancel_firmware_future()
+                prefetched = self.prefetcher.package(firmware_url(), self.chosen_release.sha256)
+                if prefetched.done() and prefetched.exception() is None:
+                    print("Using prefetched firmware {}".format(self.chosen_release.sha256))
+                    worker = FlashingThread(**flash_kwargs(prefetched.result()))
+                    worker.start()
                     return
-                package = io.BytesIO(self.firmware_rf.data)
-                worker = FlashingThread(port=self._port, upload_baud_rate=self._upload_baud_rate, package=package)
+                print("Retrieving firmware")
+                # connect the chip while the firmware is downloaded
+                future = self.firmware_future = Future()
+                prefetched.add_done_callback(lambda f: resolve_firmware_future(future, f))
+                worker = FlashingThread(**flash_kwargs(future))
                 worker.start()
 
+        def firmware_url():
+            return rebase_url(urljoin(self.releases_rf.url, self.chosen_release.url))
+
+        def cancel_firmware_future():
+            if self.firmware_future is not None and not self.firmware_future.done():
+                self.firmware_future.set_exception(EsphomeflasherError("Firmware download cancelled"))
+
+        def resolve_firmware_future(future: Future, prefetched: Future):
+            # prefetch worker thread
+            if future.done():
+                return
+            error = prefetched.exception()
+            if error is not None:
+                future.set_exception(EsphomeflasherError("Firmware download failed: {}".format(error)))
+            else:
+                future.set_result(prefetched.result())
+
         def on_select_port(event):
             choice = event.GetEventObject()
             self._port = choice.GetString(choice.GetSelection())
 
+        def on_farm_checked(event):
+            self._farm = event.IsChecked()
+            self.port_choice.Enable(not self._farm)
+
         def on_select_baud(event):
             b = event.GetEventObject()
-            self._upload_baud_rate = int(b.GetString(b.GetSelection()))
+            self._upload_baud_rate = parse_baud_rate(b.GetString(b.GetSelection()))
 
         def on_pick_file(event):
             self._firmware = event.GetPath().replace("'", "")
@@ -379,10 +404,13 @@ class MainFrame(wx.Frame):
             update_firmware_info_text("Custom Firmware File Selected")
             self.platform_info_text.SetLabel("")
 
-        def version_check():
-            f = urlopen(FUJINET_FLASHER_VERSION_URL)
-            current_ver = f.read().decode('utf-8').strip()
-            if __version__ != current_ver:
+        def on_version_checked(current_ver, error):
+            if not self:
+                return
+            if error is not None:
+                self.flasher_ver_text.SetLabel("FujiNet-Flasher Version {} (update check failed)".format(__version__))
+                self.flasher_ver_text.SetToolTip(str(error))
+            elif __version__ != current_ver:
                 self.flasher_ver_text.SetLabel("This version of FujiNet-Flasher is old, Please Update ({}->{})\n at https://fujinet.online/download".format(__version__, current_ver))
             else:
                 self.flasher_ver_text.SetLabel("FujiNet-Flasher Version {}".format(__version__))
@@ -391,15 +419,14 @@ class MainFrame(wx.Frame):
 
         hbox = wx.BoxSizer(wx.HORIZONTAL)
 
-        fgs = wx.FlexGridSizer(10, 2, 10, 10)
+        fgs = wx.FlexGridSizer(11, 2, 10, 10)
 
         # Version check notification
-        self.flasher_ver_text = wx.StaticText(panel)
-        version_check()
+        self.flasher_ver_text = wx.StaticText(panel, label="FujiNet-Flasher Version {}".format(__version__))
 
         # Serial port
         port_label = wx.StaticText(panel, label="Serial port:")
-        self.port_choice = wx.Choice(panel, choices=self._get_serial_ports())
+        self.port_choice = wx.Choice(panel, choices=[""])
         self.port_choice.Bind(wx.EVT_CHOICE, on_select_port)
         bmp = Reload.GetBitmap()
         reload_button = wx.BitmapButton(panel, id=wx.ID_ANY, bitmap=bmp)
@@ -415,10 +442,15 @@ class MainFrame(wx.Frame):
         serial_boxsizer.Add(self.port_choice, 1, wx.ALIGN_CENTER)
         # serial_boxsizer.AddStretchSpacer(0)
         serial_boxsizer.Add(reload_button, 0, wx.EXPAND | wx.LEFT, 4)
+        farm_checkbox = wx.CheckBox(panel, label="All ports")
+        farm_checkbox.SetToolTip("Flash all serial ports in the list at once")
+        farm_checkbox.Bind(wx.EVT_CHECKBOX, on_farm_checked)
+        serial_boxsizer.Add(farm_checkbox, 0, wx.ALIGN_CENTER | wx.LEFT, 8)
 
         # BAUD Rate
         baud_label = wx.StaticText(panel, label="Baud Rate:\n(default 460800)")
         self.baud_choice = wx.Choice(panel, choices=[
+            AUTO_BAUD,
             "921600",
             "576000",
             "460800",
@@ -472,7 +504,6 @@ class MainFrame(wx.Frame):
         release_sizer.Add(platform_get_btn, 0, wx.EXPAND | wx.LEFT, 4)
         self.Connect(self.EVT_DOWNLOAD_PLATFORMS, -1, RemoteFileEvent.event_type, on_platforms_downloaded)
         self.Connect(self.EVT_DOWNLOAD_RELEASES, -1, RemoteFileEvent.event_type, on_releases_downloaded)
-        self.Connect(self.EVT_DOWNLOAD_FIRMWARE, -1, RemoteFileEvent.event_type, on_firmware_downloaded)
 
 
         # Flash firmware
@@ -493,6 +524,10 @@ class MainFrame(wx.Frame):
         self.firmware_info_text = wx.StaticText(panel)
         update_firmware_info_text(None)
 
+        # Timing of the last flash run
+        metrics_label = wx.StaticText(panel, label="Last run:")
+        self.metrics_text = wx.StaticText(panel, label="")
+
         # Log window
         console_label = wx.StaticText(panel, label="Console:")
         self.console_ctrl = wx.TextCtrl(panel, style=wx.TE_MULTILINE | wx.TE_READONLY | wx.HSCROLL)
@@ -523,10 +558,12 @@ class MainFrame(wx.Frame):
             wx.StaticText(panel, label=""), (self.flash_btn, 1, wx.EXPAND),
             # Debug output button
             wx.StaticText(panel, label=""), (logs_button, 1, wx.EXPAND),
+            # Flash timing summary
+            (metrics_label, 0, wx.ALIGN_TOP), (self.metrics_text, 1, wx.EXPAND),
             # Console View (growable)
             (console_label, 1, wx.EXPAND), (self.console_ctrl, 1, wx.EXPAND),
         ])
-        fgs.AddGrowableRow(9, 1)
+        fgs.AddGrowableRow(10, 1)
         fgs.AddGrowableCol(1, 1)
         hbox.Add(fgs, proportion=2, flag=wx.ALL | wx.EXPAND, border=15)
         panel.SetSizer(hbox)
@@ -534,34 +571,57 @@ class MainFrame(wx.Frame):
         # window close event
         self.Bind(wx.EVT_CLOSE, on_close)
 
-        # download list of platforms
-        # TODO: better, stdout redirect to console_ctrl does not work immediately 
-        wx.CallLater(200, download_platforms)
-
-    def _get_serial_ports(self):
-        ports = []
-        for port, desc in list_serial_ports():
-            ports.append(port)
-        if not self._port and ports:
-            self._port = ports[0]
-        if not ports:
-            ports.append("")
-        return ports
+        # the window is shown right away, network and port scans fill it in as they finish
+        run_in_background('version-check', fetch_flasher_version, on_version_checked)
+        self._scan_serial_ports()
+        # console output is buffered, run after __init__ has redirected stdout
+        if self.platforms_url != FUJINET_PLATFORMS_URL:
+            wx.CallAfter(print, "Using firmware server {}".format(self.platforms_url))
+        wx.CallAfter(download_platforms)
+
+    def _on_first_idle(self, event):
+        self.Unbind(wx.EVT_IDLE, handler=self._on_first_idle)
+        self.time_to_interactive = time.perf_counter() - self._started
+        print("Ready in {:.0f} ms".format(self.time_to_interactive * 1000))
+        event.Skip()
+
+    def _scan_serial_ports(self):
+        self.port_choice.Set(["Scanning ports ..."])
+        self.port_choice.SetSelection(0)
+        self.port_choice.Disable()
+        run_in_background('port-scan', scan_serial_ports, self._on_serial_ports)
+
+    def _on_serial_ports(self, ports, error):
+        if not self:
+            return
+        if error is not None:
+            print("Cannot list serial ports: {}".format(error))
+            ports = []
+        self._ports = ports
+        if self._port not in ports:
+            self._port = ports[0] if ports else None
+        self.port_choice.Set(ports or [""])
+        if self._port is not None:
+            self.port_choice.SetStringSelection(self._port)
+        else:
+            self.port_choice.SetSelection(0)
+        self.port_choice.Enable(not self._farm)
 
     # Menu methods
     def _on_exit_app(self, event):
         self.Close(True)
 
     def log_message(self, message):
-        self.console_ctrl.AppendText(message)
+        self.console.write(message)
 
 
-class App(wx.App, wx.lib.mixins.inspection.InspectionMixin):
+class App(wx.App):
     def OnInit(self):
+        started = time.perf_counter()
         wx.SystemOptions.SetOption("mac.window-plain-transition", 1)
         self.SetAppName("fujinet-flasher (Based on esphome/NodeMCU PyFlasher)")
 
-        frame = MainFrame(None, "fujinet-flasher (Based on esphome/NodeMCU PyFlasher)")
+        frame = MainFrame(None, "fujinet-flasher (Based on esphome/NodeMCU PyFlasher)", started)
         frame.Show()
 
         return True
@@ -1,9 +1,12 @@
 from __future__ import print_function
 
+import io
 import os
 import sys
+import threading
+from contextlib import contextmanager
 
-import serial
+from esphomeflasher.const import FUJINET_BASE_URL_ENV, FUJINET_FIRMWARE_BASE_URL
 
 DEVNULL = open(os.devnull, 'w')
 
@@ -23,9 +26,89 @@ def list_serial_ports():
     return result
 
 
+class ThreadOutput(io.TextIOBase):
+    """sys.stdout replacement which lets every thread redirect its own output"""
+
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self._local, 'target', None) or self.default
+
+    def set_target(self, target):
+        """Redirect output of the current thread, None restores the default"""
+        self._local.target = target
+
+    def write(self, string):
+        return self.target.write(string)
+
+    def flush(self):
+        self.target.flush()
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+
+@contextmanager
+def thread_output():
+    """Install ThreadOutput as sys.stdout (unless it is already) for the duration"""
+    orig_sys_stdout = sys.stdout
+    output = orig_sys_stdout if isinstance(orig_sys_stdout, ThreadOutput) else ThreadOutput(orig_sys_stdout)
+    sys.stdout = output
+    try:
+        yield output
+    finally:
+        sys.stdout = orig_sys_stdout
+
+
+class PrefixedOutput(io.TextIOBase):
+    """Prefix every complete line with a tag, lines from different writers never mix"""
+
+    def __init__(self, out, prefix, lock):
+        self._out = out
+        self._prefix = prefix
+        self._lock = lock
+        self._line = ''
+
+    def write(self, string):
+        self._line += string
+        while True:
+            pos = min((p for p in (self._line.find('\n'), self._line.find('\r')) if p >= 0), default=-1)
+            if pos < 0:
+                break
+            line, self._line = self._line[:pos], self._line[pos + 1:]
+            if line:
+                with self._lock:
+                    self._out.write(self._prefix + line + '\n')
+        return len(string)
+
+    def flush(self):
+        if self._line:
+            self.write('\n')
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+
 def prevent_print(func, *args, **kwargs):
+    import serial
+
     orig_sys_stdout = sys.stdout
-    sys.stdout = DEVNULL
+    thread_output = orig_sys_stdout if isinstance(orig_sys_stdout, ThreadOutput) else None
+    if thread_output is not None:
+        # other threads keep printing, mute only this one
+        orig_target = getattr(thread_output._local, 'target', None)
+        thread_output.set_target(DEVNULL)
+    else:
+        sys.stdout = DEVNULL
     try:
         return func(*args, **kwargs)
     except serial.SerialException as err:
@@ -33,5 +116,39 @@ def prevent_print(func, *args, **kwargs):
 
         raise EsphomeflasherError("Serial port closed: {}".format(err))
     finally:
-        sys.stdout = orig_sys_stdout
-        pass
+        if thread_output is not None:
+            thread_output.set_target(orig_target)
+        else:
+            sys.stdout = orig_sys_stdout
+
+
+def configure_ssl_certificates():
+    """Point SSL at the certificates bundled by PyInstaller (needed on macOS)"""
+    bundle_dir = getattr(sys, '_MEIPASS', None)
+    if bundle_dir is not None:
+        os.environ['SSL_CERT_FILE'] = os.path.join(bundle_dir, 'certifi', 'cacert.pem')
+
+
+def firmware_base_url():
+    """Base URL of platforms.json and the packages, FUJINET_FLASHER_BASE_URL overrides it"""
+    base = os.environ.get(FUJINET_BASE_URL_ENV) or FUJINET_FIRMWARE_BASE_URL
+    return base if base.endswith('/') else base + '/'
+
+
+def rebase_url(url):
+    """url on the official server moved to the configured base URL, other URLs unchanged"""
+    base = firmware_base_url()
+    if base != FUJINET_FIRMWARE_BASE_URL and url.startswith(FUJINET_FIRMWARE_BASE_URL):
+        return base + url[len(FUJINET_FIRMWARE_BASE_URL):]
+    return url
+
+
+def user_cache_dir():
+    """Per-user cache directory of the flasher"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'fujinet-flasher')
@@ -0,0 +1,106 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Union
+
+
+class PhaseMetric:
+    """Wall-clock time and bytes moved by one phase of a flash run"""
+
+    def __init__(self, name: str, start: float, nbytes: int = 0):
+        self.name = name
+        self.start = start
+        self.elapsed = 0.0
+        self.bytes = nbytes
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'start': round(self.start, 6),
+            'elapsed': round(self.elapsed, 6),
+            'bytes': self.bytes,
+        }
+
+
+class FlashMetrics:
+    """Per-phase timing of one flash run, phases may be recorded from several threads"""
+
+    def __init__(self, port: Union[None, str] = None):
+        self.port = port
+        self.created = time.time()
+        self._t0 = time.perf_counter()
+        self.phases: List[PhaseMetric] = []
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, nbytes: int = 0):
+        """Time the enclosed block, bytes may be updated on the yielded metric"""
+        metric = PhaseMetric(name, time.perf_counter() - self._t0, nbytes)
+        try:
+            yield metric
+        finally:
+            metric.elapsed = time.perf_counter() - self._t0 - metric.start
+            with self.lock:
+                self.phases.append(metric)
+
+    def set(self, key: str, value):
+        """Record a non-timing value, e.g. the negotiated baud rate"""
+        with self.lock:
+            self.values[key] = value
+
+    def merge(self, other: 'FlashMetrics'):
+        """Add phases of other (e.g. package loading), keeping their wall-clock position"""
+        offset = other._t0 - self._t0
+        with self.lock:
+            for metric in other.phases:
+                copy = PhaseMetric(metric.name, metric.start + offset, metric.bytes)
+                copy.elapsed = metric.elapsed
+                self.phases.append(copy)
+            self.values.update(other.values)
+
+    @property
+    def total(self):
+        with self.lock:
+            return max((m.start + m.elapsed for m in self.phases), default=0.0) - \
+                min((m.start for m in self.phases), default=0.0)
+
+    def as_dict(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda m: m.start)
+            values = dict(self.values)
+        return {
+            'port': self.port,
+            'timestamp': self.created,
+            'total': round(self.total, 6),
+            'values': values,
+            'phases': [m.as_dict() for m in phases],
+        }
+
+    def summary_text(self):
+        lines = ["Timing{}:".format(" ({})".format(self.port) if self.port else "")]
+        for m in sorted(self.phases, key=lambda m: m.start):
+            line = " - {:<20} {:7.2f}s".format(m.name, m.elapsed)
+            if m.bytes:
+                line += " {:9d} bytes {:8.1f} KB/s".format(m.bytes, m.bytes_per_sec / 1024)
+            lines.append(line)
+        lines.append(" - {:<20} {:7.2f}s".format("total", self.total))
+        return "\n".join(lines)
+
+    def short_text(self):
+        return ", ".join("{} {:.1f}s".format(m.name, m.elapsed)
+                         for m in sorted(self.phases, key=lambda m: m.start)) + \
+            " (total {:.1f}s)".format(self.total)
+
+
+def save_metrics_json(path: str, runs: List[FlashMetrics]):
+    import json
+
+    from esphomeflasher.const import __version__
+
+    with open(path, 'w') as f:
+        json.dump({'version': __version__, 'runs': [m.as_dict() for m in runs]}, f, indent=2)
@@ -0,0 +1,243 @@
+"""Local mirror of the firmware catalog
+
+    esphomeflasher mirror DEST [--platform NAME] [--releases N] [--serve]
+
+Downloads platforms.json, the release lists and the packages into DEST
+with the same layout as the firmware server, so stations can use it with
+FUJINET_FLASHER_BASE_URL=http://<mirror>:8000/ (GUI) or --base-url (CLI).
+"""
+import argparse
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import urljoin, urlsplit
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.const import FUJINET_FLASHER_VERSION_URL, FUJINET_PLATFORMS_URL
+from esphomeflasher.helpers import firmware_base_url
+
+MIRROR_WORKERS = 4
+MIRROR_HTTP_PORT = 8000
+# files from other servers than the base URL
+EXTERNAL_DIR = '_ext'
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='esphomeflasher mirror')
+    parser.add_argument('dest', help="Directory of the mirror")
+    parser.add_argument('--base-url',
+                        help="Mirror from this base URL instead of the official server")
+    parser.add_argument('--platform', action='append', default=None,
+                        help="Only mirror this platform (name or build), can be repeated")
+    parser.add_argument('--releases', type=int, default=0,
+                        help="Only mirror the first N releases of each platform (default all)")
+    parser.add_argument('--workers', type=int, default=MIRROR_WORKERS,
+                        help="Parallel downloads (default {})".format(MIRROR_WORKERS))
+    parser.add_argument('--serve', action='store_true',
+                        help="Serve the mirror over HTTP after syncing")
+    parser.add_argument('--no-sync', action='store_true',
+                        help="Only serve the mirror, do not sync it")
+    parser.add_argument('--bind', default='0.0.0.0', help="Address to serve on (default 0.0.0.0)")
+    parser.add_argument('--http-port', type=int, default=MIRROR_HTTP_PORT,
+                        help="Port to serve on (default {})".format(MIRROR_HTTP_PORT))
+    return parser.parse_args(argv)
+
+
+def mirror_path(url: str, base: str) -> str:
+    """Path in the mirror of url, relative with '/' separators"""
+    if url.startswith(base):
+        path = urlsplit(url[len(base):]).path
+    else:
+        parts = urlsplit(url)
+        path = posixpath.join(EXTERNAL_DIR, parts.netloc.replace(':', '_'), parts.path.lstrip('/'))
+    path = posixpath.normpath(path)
+    if path.startswith('..') or posixpath.isabs(path) or path == '.':
+        raise EsphomeflasherError("Cannot mirror {}".format(url))
+    return path
+
+
+def write_file(dest: str, path: str, data: bytes):
+    """Write atomically, stations may be reading the mirror while it is synced"""
+    target = os.path.join(dest, *path.split('/'))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return ''
+    return digest.hexdigest()
+
+
+def relative_url(path: str, start: str) -> str:
+    """URL of mirror path as seen from the catalog file at mirror path start"""
+    return posixpath.relpath(path, posixpath.dirname(start) or '.')
+
+
+class MirrorSync:
+    """Sync the catalog into dest, packages in parallel and verified by their sha256
+
+    Catalog files are written last with URLs relative to the mirror, so a
+    station never sees a release whose package is not there yet.
+    """
+
+    def __init__(self, dest: str, base: str, platforms: List[str] = None, releases: int = 0,
+                 workers: int = MIRROR_WORKERS):
+        self.dest = dest
+        self.base = base
+        self.platforms = [p.lower() for p in platforms or []]
+        self.releases = releases
+        self.workers = workers
+        self.errors: List[str] = []
+        self.downloaded = 0
+        self.up_to_date = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, url: str) -> bytes:
+        import requests
+        from esphomeflasher.download import download
+
+        try:
+            return bytes(download(url).data)
+        except requests.RequestException as e:
+            raise EsphomeflasherError("Cannot get {}: {}".format(url, e))
+
+    def selected(self, platform: Dict) -> bool:
+        if not self.platforms:
+            return True
+        return str(platform.get('name', '')).lower() in self.platforms or \
+            str(platform.get('build', '')).lower() in self.platforms
+
+    def sync_package(self, url: str, sha256: str) -> bool:
+        from esphomeflasher.download import download_resumable
+
+        path = mirror_path(url, self.base)
+        target = os.path.join(self.dest, *path.split('/'))
+        if file_sha256(target) == sha256.lower():
+            with self.lock:
+                self.up_to_date += 1
+            return True
+        try:
+            result = download_resumable(url, sha256)
+        except Exception as e:
+            with self.lock:
+                self.errors.append("{}: {}".format(url, e))
+            print("Failed {}: {}".format(path, e))
+            return False
+        write_file(self.dest, path, result.data)
+        with self.lock:
+            self.downloaded += 1
+            self.bytes += result.size
+        print("Mirrored {} ({}), sha256 OK".format(path, result.stats_text))
+        return True
+
+    def sync_platform(self, platforms_path: str, platforms_url: str, platform: Dict, pool: ThreadPoolExecutor):
+        """Mirror one platform, returns (its entry for platforms.json, releases path, releases data)"""
+        url = urljoin(platforms_url, platform['url'])
+        path = mirror_path(url, self.base)
+        catalog = json.loads(self.fetch(url))
+        releases = catalog.get('releases', [])
+        if self.releases:
+            releases = releases[:self.releases]
+        packages = []
+        for release in releases:
+            if 'url' not in release or 'sha256' not in release:
+                continue
+            package_url = urljoin(url, release['url'])
+            release['url'] = relative_url(mirror_path(package_url, self.base), path)
+            packages.append((release, pool.submit(self.sync_package, package_url, release['sha256'])))
+        # releases whose package failed are left out
+        catalog['releases'] = [release for release, future in packages if future.result()]
+        entry = dict(platform, url=relative_url(path, platforms_path))
+        return entry, path, json.dumps(catalog, indent=2).encode('utf-8')
+
+    def run(self):
+        start = time.time()
+        platforms_url = urljoin(self.base, posixpath.basename(FUJINET_PLATFORMS_URL))
+        platforms_path = mirror_path(platforms_url, self.base)
+        print("Mirroring {} to {}".format(platforms_url, self.dest))
+        catalog = json.loads(self.fetch(platforms_url))
+        platforms = [p for p in catalog.get('platforms', []) if 'url' in p and self.selected(p)]
+        if not platforms:
+            raise EsphomeflasherError("No platforms to mirror")
+        # platforms use the pool for their packages, so they get their own threads
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mirror') as pool, \
+                ThreadPoolExecutor(max_workers=len(platforms), thread_name_prefix='mirror-platform') as lists:
+            futures = [(p, lists.submit(self.sync_platform, platforms_path, platforms_url, p, pool))
+                       for p in platforms]
+            entries = []
+            for platform, future in futures:
+                try:
+                    entry, path, data = future.result()
+                except Exception as e:
+                    self.errors.append("{}: {}".format(platform.get('name'), e))
+                    print("Failed platform {}: {}".format(platform.get('name'), e))
+                    continue
+                write_file(self.dest, path, data)
+                entries.append(entry)
+        catalog['platforms'] = entries
+        write_file(self.dest, platforms_path, json.dumps(catalog, indent=2).encode('utf-8'))
+        # the GUI version check, not essential
+        version_url = urljoin(self.base, posixpath.basename(FUJINET_FLASHER_VERSION_URL))
+        try:
+            write_file(self.dest, mirror_path(version_url, self.base), self.fetch(version_url))
+        except Exception as e:
+            print("Cannot mirror flasher version: {}".format(e))
+        print("{} platform(s), {} package(s) downloaded ({:.1f} MB), {} up to date in {:.1f}s".format(
+            len(entries), self.downloaded, self.bytes / 1e6, self.up_to_date, time.time() - start))
+        return not self.errors
+
+
+class MirrorRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        print("{} - {}".format(self.address_string(), format % args))
+
+
+def serve(dest: str, bind: str, port: int):
+    handler = partial(MirrorRequestHandler, directory=dest)
+    server = ThreadingHTTPServer((bind, port), handler)
+    host = bind if bind != '0.0.0.0' else '<this host>'
+    print("Serving {} at http://{}:{}/".format(dest, host, port))
+    print("Use it with FUJINET_FLASHER_BASE_URL=http://{}:{}/ or --base-url".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_mirror(argv):
+    args = parse_args(argv)
+    base = args.base_url or firmware_base_url()
+    if not base.endswith('/'):
+        base += '/'
+    ok = True
+    if not args.no_sync:
+        ok = MirrorSync(args.dest, base, args.platform, args.releases, args.workers).run()
+    if args.serve or args.no_sync:
+        if not os.path.isdir(args.dest):
+            raise EsphomeflasherError("Mirror directory {} does not exist".format(args.dest))
+        serve(args.dest, args.bind, args.http_port)
+    return 0 if ok else 1
@@ -0,0 +1,288 @@
+import gzip
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Union
+
+import serial
+
+CAPTURE_MAGIC = b'FNRAW001'
+# seconds since capture start, chunk length
+CAPTURE_RECORD = struct.Struct('<dI')
+READ_TIMEOUT = 0.1
+VIEW_INTERVAL = 0.1
+VIEW_BACKLOG = 2000
+# lines shown at once before the rate limit applies, a boot or crash dump fits
+VIEW_BURST = 500
+
+
+class RotatingLog:
+    """Text log which is gzip compressed and rotated when it exceeds max_size
+
+    path.1.gz is the most recent rotated file, at most backup_count are kept.
+    """
+
+    def __init__(self, path: str, max_size: int = 10 * 1024 * 1024, backup_count: int = 5):
+        self.path = path
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+
+    def write(self, text: str):
+        self._file.write(text)
+        self._size += len(text)
+        if self.max_size and self._size >= self.max_size:
+            self.rotate()
+
+    def backup_path(self, index: int) -> str:
+        return "{}.{}.gz".format(self.path, index)
+
+    def rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(self.backup_path(index)):
+                    os.replace(self.backup_path(index), self.backup_path(index + 1))
+            with open(self.path, 'rb') as src, gzip.open(self.backup_path(1), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CaptureWriter:
+    """Raw serial byte stream with receive times, for replay with ReplayPort"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+
+    def write(self, offset: float, data: bytes):
+        self._file.write(CAPTURE_RECORD.pack(offset, len(data)))
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path: str):
+    """Yield (seconds since capture start, bytes) records of a raw capture"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{} is not a raw serial capture".format(path))
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            offset, length = CAPTURE_RECORD.unpack(header)
+            yield offset, f.read(length)
+
+
+class ReplayPort:
+    """Read-only stand-in for a serial port, plays back a raw capture with its timing"""
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self._records = read_capture(path)
+        self._speed = speed
+        self._start = None
+        self._pending = None
+        self._closed = False
+        self.timeout = READ_TIMEOUT
+        self.port = path
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size: int = 1) -> bytes:
+        if self._closed:
+            raise serial.SerialException("Replay finished")
+        if self._start is None:
+            self._start = time.monotonic()
+        if self._pending is None:
+            self._pending = next(self._records, None)
+            if self._pending is None:
+                self._closed = True
+                raise serial.SerialException("Replay finished")
+        offset, data = self._pending
+        delay = self._start + offset / self._speed - time.monotonic()
+        if delay > (self.timeout or 0):
+            time.sleep(self.timeout or 0)
+            return b''
+        if delay > 0:
+            time.sleep(delay)
+        self._pending = None
+        return data
+
+    def close(self):
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SerialMonitor:
+    """Capture device output without falling behind
+
+    A reader thread reads whatever the port has buffered, splits lines and
+    stamps them with a monotonic clock. Log and raw capture files are written
+    by a second thread. The console view (run()) shows a burst of up to
+    VIEW_BURST lines at once and then at most max_lines_per_sec lines per
+    second. Lines wait in a backlog of VIEW_BACKLOG, only lines which
+    overflow it are skipped and counted, the files always get everything.
+    """
+
+    def __init__(self, port, log: Union[None, RotatingLog] = None,
+                 capture: Union[None, CaptureWriter] = None, max_lines_per_sec: int = 100):
+        self.port = port
+        self.log = log
+        self.capture = capture
+        self.max_lines_per_sec = max_lines_per_sec
+        self.lines = 0
+        self.bytes = 0
+        self.error = None
+        self._wall_start = time.time()
+        self._mono_start = time.monotonic()
+        self._partial = bytearray()
+        self._view = deque()
+        self._view_lock = threading.Lock()
+        self._dropped = 0
+        self._files = queue.Queue()
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read_loop, name='serial-reader', daemon=True)
+        self._writer = threading.Thread(target=self._write_loop, name='serial-log-writer', daemon=True)
+
+    def timestamp(self, mono: float) -> datetime:
+        return datetime.fromtimestamp(self._wall_start + mono - self._mono_start)
+
+    def start(self):
+        self.port.timeout = READ_TIMEOUT
+        self._reader.start()
+        self._writer.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reader.is_alive() and self._reader is not threading.current_thread():
+            self._reader.join()
+        self._files.put(None)
+        if self._writer.is_alive():
+            self._writer.join()
+
+    @property
+    def running(self):
+        return self._reader.is_alive()
+
+    def _read_loop(self):
+        try:
+            while not self._stop.is_set():
+                data = self.port.read(max(1, self.port.in_waiting))
+                if data:
+                    self._received(time.monotonic(), data)
+        except (serial.SerialException, OSError) as err:
+            self.error = err
+        if self._partial:
+            self._add_lines(time.monotonic(), [bytes(self._partial)])
+            self._partial.clear()
+
+    def _received(self, now: float, data: bytes):
+        self.bytes += len(data)
+        if self.capture is not None:
+            self._files.put((now, data, None))
+        self._partial += data
+        if b'\n' not in data:
+            return
+        lines = self._partial.split(b'\n')
+        self._partial = bytearray(lines.pop())
+        self._add_lines(now, lines)
+
+    def _add_lines(self, now: float, lines):
+        texts = [line.decode(errors='replace').replace('\r', '') for line in lines]
+        self.lines += len(texts)
+        if self.log is not None:
+            self._files.put((now, None, texts))
+        with self._view_lock:
+            for text in texts:
+                if len(self._view) >= VIEW_BACKLOG:
+                    self._view.popleft()
+                    self._dropped += 1
+                self._view.append((now, text))
+
+    def _write_loop(self):
+        while True:
+            item = self._files.get()
+            if item is None:
+                break
+            now, data, texts = item
+            if data is not None:
+                self.capture.write(now - self._mono_start, data)
+            if texts is not None:
+                stamp = self.timestamp(now).strftime('[%H:%M:%S.%f')[:-3] + '] '
+                self.log.write(''.join(stamp + text + '\n' for text in texts))
+            if self._files.empty():
+                for f in (self.log, self.capture):
+                    if f is not None:
+                        f.flush()
+        for f in (self.log, self.capture):
+            if f is not None:
+                f.close()
+
+    def take_view(self, limit: int):
+        """Up to limit lines for display and the number of lines skipped since the last call
+
+        Lines beyond limit stay queued for the next call.
+        """
+        with self._view_lock:
+            lines = []
+            while self._view and len(lines) < limit:
+                lines.append(self._view.popleft())
+            dropped = self._dropped
+            self._dropped = 0
+        return lines, dropped
+
+    def run(self):
+        """Print lines until the port closes, call from the thread owning the console"""
+        rate = self.max_lines_per_sec
+        # token bucket: bursts are shown in full, a steady flood at rate
+        tokens = float(VIEW_BURST)
+        last = time.monotonic()
+        try:
+            while True:
+                running = self.running
+                tick = time.monotonic()
+                tokens = min(float(VIEW_BURST), tokens + (tick - last) * rate)
+                last = tick
+                # no limit once the port closed, what is left is shown
+                limit = int(tokens) if rate and running else VIEW_BACKLOG
+                lines, dropped = self.take_view(limit)
+                tokens -= len(lines)
+                for now, text in lines:
+                    message = self.timestamp(now).strftime('[%H:%M:%S] ') + text
+                    try:
+                        print(message)
+                    except UnicodeEncodeError:
+                        print(message.encode('ascii', 'backslashreplace'))
+                if dropped:
+                    print("... {} lines not shown{}".format(
+                        dropped, ", see log file" if self.log is not None else ""))
+                if not running and not lines:
+                    break
+                time.sleep(VIEW_INTERVAL)
+        finally:
+            self.stop()
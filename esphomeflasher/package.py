@@ -0,0 +1,420 @@
+import hashlib
+import io
+import json
+import mmap
+import struct
+import sys
+import threading
+import zipfile
+import zlib
+from concurrent.futures import Future
+from typing import List, Tuple, Union
+
+from esphomeflasher.common import EsphomeflasherError, download_firmware, is_url, read_firmware_info
+from esphomeflasher.const import FUJINET_RELEASE_INFO
+from esphomeflasher.flashLayout import FlashLayout
+from esphomeflasher.helpers import ThreadOutput
+from esphomeflasher.metrics import FlashMetrics
+
+# bounded work buffers when inflating, a mostly erased spiffs image compresses 1000:1
+INFLATE_CHUNK = 64 * 1024
+
+
+class MemoryFile(io.RawIOBase):
+    """Read-only file over a buffer (mmap, bytes, memoryview) which does not copy it"""
+
+    def __init__(self, buffer, name: str = ""):
+        self._view = memoryview(buffer).cast('B')
+        self._pos = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def getbuffer(self):
+        return self._view
+
+
+class InflateFile(io.RawIOBase):
+    """Read-only file over a raw deflate stream, inflated as it is read"""
+
+    def __init__(self, raw: memoryview, size: int, name: str = ""):
+        self._raw = raw
+        self._size = size
+        self._pos = 0
+        self._inflate = None
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _restart(self):
+        self._inflate = zlib.decompressobj(-15)
+        self._raw_pos = 0
+        self._tail = b''
+
+    def _inflate_some(self, size):
+        if self._inflate is None:
+            self._restart()
+        out = bytearray()
+        while len(out) < size:
+            data = self._tail
+            if not data:
+                data = self._raw[self._raw_pos:self._raw_pos + INFLATE_CHUNK]
+                self._raw_pos += len(data)
+                if not data:
+                    break
+            out += self._inflate.decompress(data, size - len(out))
+            self._tail = self._inflate.unconsumed_tail
+        self._pos += len(out)
+        return bytes(out)
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        return self._inflate_some(size)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        target = max(0, base + offset)
+        if target >= self._size:
+            # nothing left to read, the stream restarts on a seek back
+            self._pos = target
+            self._inflate = None
+            return self._pos
+        if target < self._pos or self._inflate is None:
+            self._pos = 0
+            self._restart()
+        while self._pos < target:
+            if not self._inflate_some(min(INFLATE_CHUNK, target - self._pos)):
+                break
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class FirmwareImage:
+    """One file from release.json, to be written at offset
+
+    Images of a zip package stay inside the mapped package: data of a
+    stored member is a memoryview into it, a deflated member is inflated
+    while it is read and its deflate stream (raw_deflate) can be sent to
+    the chip as is. md5, sha256 and adler32 are computed once at load time.
+    """
+
+    def __init__(self, filename: str, offset: int, data=None, raw_deflate=None, size: int = 0):
+        self.filename = filename
+        self.offset = offset
+        self._data = data
+        self.raw_deflate = raw_deflate
+        self._size = len(data) if data is not None else size
+        self.md5 = ""
+        self.sha256 = ""
+        self.adler32 = 1
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def kind(self):
+        return self.filename.split(".", 1)[0].lower()
+
+    @property
+    def deflate_parts(self):
+        """Raw deflate stream of the image as a list of buffers, None if it has none"""
+        return [self.raw_deflate] if self.raw_deflate is not None else None
+
+    @property
+    def data(self):
+        """Whole image, inflates deflated images on every access"""
+        if self._data is not None:
+            return self._data
+        return self.open().read()
+
+    def open(self):
+        """New read-only file object of the image, its image attribute refers back here"""
+        if self._data is not None:
+            f = MemoryFile(self._data, self.filename)
+        else:
+            f = InflateFile(self.raw_deflate, self._size, self.filename)
+        f.image = self
+        return f
+
+    def scan(self, crc32=None):
+        """Compute digests in one bounded pass, checking the zip CRC if given"""
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        adler = 1
+        crc = 0
+        f = self.open()
+        for chunk in iter(lambda: f.read(INFLATE_CHUNK), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+            adler = zlib.adler32(chunk, adler)
+            if crc32 is not None:
+                crc = zlib.crc32(chunk, crc)
+        if crc32 is not None and crc != crc32:
+            raise EsphomeflasherError("Invalid package, {} is corrupted (CRC mismatch)".format(self.filename))
+        self.md5 = md5.hexdigest()
+        self.sha256 = sha256.hexdigest()
+        self.adler32 = adler
+
+
+def zip_image(zf: zipfile.ZipFile, buffer: memoryview, filename: str, offset: int) -> FirmwareImage:
+    """FirmwareImage of a zip member, referencing the package buffer instead of extracting it"""
+    try:
+        info = zf.getinfo(filename)
+    except KeyError:
+        raise EsphomeflasherError("Invalid package, {} is missing".format(filename))
+    if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        # encrypted or unusual compression, let zipfile extract it
+        image = FirmwareImage(filename, offset, zf.read(info))
+        image.scan()
+        return image
+    header = bytes(buffer[info.header_offset:info.header_offset + zipfile.sizeFileHeader])
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[0] != zipfile.stringFileHeader:
+        raise EsphomeflasherError("Invalid package, bad zip header of {}".format(filename))
+    # data follows the local header, its file name and extra field
+    start = info.header_offset + zipfile.sizeFileHeader + fields[10] + fields[11]
+    raw = buffer[start:start + info.compress_size]
+    if info.compress_type == zipfile.ZIP_STORED:
+        image = FirmwareImage(filename, offset, raw)
+    else:
+        image = FirmwareImage(filename, offset, raw_deflate=raw, size=info.file_size)
+    image.scan(info.CRC)
+    return image
+
+
+class FirmwarePackage:
+    """Parsed firmware package, read-only and safe to share between flashing threads"""
+
+    def __init__(self, release_info: dict, images: List[FirmwareImage], buffer=None):
+        self.release_info = release_info
+        self.images = images
+        # mapped package, images reference it
+        self.buffer = buffer
+        self.firmware: Union[None, FirmwareImage] = None
+        self.metrics: Union[None, FlashMetrics] = None
+        self.spiffs_start = 0
+        for image in images:
+            if image.kind == 'firmware':
+                self.firmware = image
+            if image.kind == 'spiffs':
+                self.spiffs_start = image.offset
+        # Verify "firmware" magic # and grab flash mode/frequency
+        if self.firmware is None:
+            raise EsphomeflasherError("Invalid release info. Missing firmware file!")
+        self.flash_mode, self.flash_freq = read_firmware_info(self.firmware.open())
+        self.layout = FlashLayout(images)
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.release_info.get('version', "")
+
+    @property
+    def size(self):
+        return sum(image.size for image in self.images)
+
+    def addr_filename(self, merge: bool = False):
+        """Fresh (offset, file) list for esptool, every caller gets its own file objects
+
+        With merge, adjacent images are joined into one write (see FlashLayout).
+        """
+        images = self.layout.writes if merge else self.images
+        return [(image.offset, image.open()) for image in images]
+
+    def region_digests(self, esp, args) -> List[Tuple[int, int, str, str]]:
+        """(offset, size, md5, filename) of every image as it reads back from flash
+
+        Digests come from the scan at load time, only the bootloader, whose
+        header is patched, is hashed again. They are kept per flash
+        parameters, so every board flashed with this release reuses them.
+        """
+        from esphomeflasher.flashPlan import prepare_image
+
+        key = (args.flash_mode, args.flash_freq, args.flash_size)
+        with self._lock:
+            digests = self._digests.get(key)
+            if digests is not None:
+                return digests
+            digests = []
+            for image in self.images:
+                if not image.size:
+                    continue
+                if image.offset == esp.BOOTLOADER_FLASH_OFFSET:
+                    data = prepare_image(esp, image.offset, image.data, args)
+                    digests.append((image.offset, len(data), hashlib.md5(data).hexdigest(), image.filename))
+                elif image.size % 4:
+                    # esptool pads images to 4 bytes with 0xFF
+                    md5 = hashlib.md5(image.data)
+                    md5.update(b'\xff' * (4 - image.size % 4))
+                    digests.append((image.offset, image.size + 4 - image.size % 4, md5.hexdigest(), image.filename))
+                else:
+                    digests.append((image.offset, image.size, image.md5, image.filename))
+            self._digests[key] = digests
+            return digests
+
+    def print_info(self):
+        print("FujiNet Version: {}".format(self.version))
+        print("Version Date: {}".format(self.release_info.get('version_date', "")))
+        print("Git Commit: {}".format(self.release_info.get('git_commit', "")))
+
+
+def map_file(f) -> memoryview:
+    try:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError, AttributeError, io.UnsupportedOperation):
+        # empty file or not a real file
+        return memoryview(f.read())
+
+
+def map_package(path, sha256=None) -> memoryview:
+    """Contents of a package (local file, URL, file object or buffer) without copying it
+
+    Files and cached downloads are memory-mapped, so flashing jobs share
+    one copy of the package in the page cache.
+    """
+    from esphomeflasher.diskCache import get_cache
+
+    if isinstance(path, (bytes, bytearray, memoryview, mmap.mmap)):
+        return memoryview(path)
+    if hasattr(path, 'getbuffer'):
+        return path.getbuffer()
+    if hasattr(path, 'read'):
+        path.seek(0)
+        return map_file(path)
+    if is_url(path):
+        cache = get_cache()
+        mapped = cache.map(sha256) if sha256 else None
+        if mapped is not None:
+            print("Using cached firmware {}".format(sha256))
+            return memoryview(mapped)
+        # mapped from the cache unless it could not take it
+        return memoryview(download_firmware(path, sha256).data)
+    try:
+        with open(path, 'rb') as f:
+            return map_file(f)
+    except IOError as err:
+        raise EsphomeflasherError("Error opening binary '{}': {}".format(path, err))
+
+
+def load_package(path, sha256=None, metrics: Union[None, FlashMetrics] = None) -> FirmwarePackage:
+    """Open package (local file, URL, file object or buffer) and index all files listed in release.json"""
+    if metrics is None:
+        metrics = FlashMetrics()
+    with metrics.phase('download') as phase:
+        if isinstance(path, Future):
+            # package is being downloaded by someone else (GUI)
+            path = path.result()
+        # map local file or download remote file
+        buffer = map_package(path, sha256)
+        phase.bytes = len(buffer)
+
+    images = []
+    # package is zip file
+    with metrics.phase('zip open'):
+        try:
+            zf = zipfile.ZipFile(MemoryFile(buffer), 'r')
+        except zipfile.BadZipFile as err:
+            raise EsphomeflasherError("Invalid package: {}".format(err))
+    with zf:
+        with metrics.phase('release.json parse'):
+            try:
+                release_info = json.loads(zf.read(FUJINET_RELEASE_INFO))
+            except (KeyError, ValueError) as err:
+                raise EsphomeflasherError("Invalid package, cannot read {}: {}".format(FUJINET_RELEASE_INFO, err))
+        # Index all the partition files, nothing is extracted
+        with metrics.phase('unpack') as phase:
+            for file_entry in release_info.get('files', []):
+                file_name = file_entry.get('filename')
+                file_offset = file_entry.get('offset')
+                if file_name is None or file_offset is None:
+                    raise EsphomeflasherError("Invalid release info. Missing mandatory file attributes!")
+                offset = int(file_offset, 16)
+                images.append(zip_image(zf, buffer, file_name, offset))
+                phase.bytes += images[-1].size
+                print("File {}: {}, Offset: 0x{:04X}".format(len(images), file_name, offset))
+
+    package = FirmwarePackage(release_info, images, buffer)
+    package.metrics = metrics
+    with metrics.phase('layout'):
+        writes = package.layout.writes
+    if len(writes) < len(images):
+        print("Layout: {} files in {} writes".format(len(images), len(writes)))
+    return package
+
+
+class PendingPackage:
+    """Package loaded in a background thread, e.g. while the chip is being connected
+
+    Output of the loader is held back and printed by the first result() call,
+    so it does not get mixed into the chip connection output.
+    """
+
+    def __init__(self, path, sha256=None):
+        self._future: Future = Future()
+        self._output = io.StringIO()
+        self._printed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._load, args=(path, sha256))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self, path, sha256):
+        if isinstance(sys.stdout, ThreadOutput):
+            sys.stdout.set_target(self._output)
+        try:
+            self._future.set_result(load_package(path, sha256))
+        except BaseException as e:
+            self._future.set_exception(e)
+
+    def done(self):
+        return self._future.done()
+
+    def result(self) -> FirmwarePackage:
+        if not self._future.done():
+            print("Waiting for firmware package...")
+        self._future.exception()
+        with self._lock:
+            if not self._printed:
+                self._printed = True
+                print(self._output.getvalue(), end='')
+        return self._future.result()
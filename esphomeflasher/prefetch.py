@@ -0,0 +1,91 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Tuple, Union
+
+from esphomeflasher.diskCache import get_cache
+from esphomeflasher.download import DownloadAborted, download_catalog, download_resumable
+
+# catalogs are small, more workers only add load on the server
+PREFETCH_WORKERS = 4
+
+
+class Prefetcher:
+    """Background fetches ahead of user selection
+
+    catalog() and package() return futures and start a download at most
+    once per URL, later calls get the running or completed future. Only
+    the most recently requested package keeps downloading, older ones are
+    cancelled.
+    """
+
+    def __init__(self, workers: int = PREFETCH_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        self._catalogs: Dict[str, Future] = {}
+        # sha256 -> (future, its cancel event)
+        self._packages: Dict[str, Tuple[Future, threading.Event]] = {}
+        self._package_cancel: Union[None, threading.Event] = None
+
+    def catalog(self, url: str) -> Future:
+        """Future of the Download of a catalog file (releases list)"""
+        with self._lock:
+            future = self._catalogs.get(url)
+            if future is None or future.cancelled():
+                future = self._executor.submit(download_catalog, url)
+                self._catalogs[url] = future
+            return future
+
+    def package(self, url: str, sha256: str) -> Future:
+        """Future of the verified package, memory-mapped from the package cache when possible"""
+        key = sha256.lower()
+        with self._lock:
+            future, cancel = self._packages.get(key, (None, None))
+            previous = None
+            if future is not None:
+                if future.done():
+                    if future.exception() is None:
+                        return future
+                elif not cancel.is_set():
+                    return future
+                else:
+                    # cancelled and still running until it ends with DownloadAborted
+                    previous = future
+            if self._package_cancel is not None:
+                self._package_cancel.set()
+            cancel = threading.Event()
+            self._package_cancel = cancel
+            future = self._executor.submit(self._fetch_package, url, key, cancel, previous)
+            self._packages[key] = (future, cancel)
+            return future
+
+    @staticmethod
+    def _fetch_package(url: str, sha256: str, cancel: threading.Event, previous: Union[None, Future] = None):
+        if previous is not None:
+            # the cancelled fetch still writes the part file this one continues
+            wait([previous])
+        cache = get_cache()
+        mapped = cache.map(sha256)
+        if mapped is not None:
+            return mapped
+        if cancel.is_set():
+            raise DownloadAborted("Download aborted")
+        print("Prefetching {}".format(url))
+        # verified once complete, a dropped connection resumes where it stopped
+        result = download_resumable(url, sha256, cancel)
+        print("Prefetched {}, sha256 OK".format(result.stats_text))
+        # mapped from the cache unless it could not take it
+        return result.data
+
+    def forget_catalogs(self):
+        """Next catalog() calls download again, e.g. on reload"""
+        with self._lock:
+            for future in self._catalogs.values():
+                future.cancel()
+            self._catalogs.clear()
+
+    def shutdown(self):
+        self.forget_catalogs()
+        with self._lock:
+            if self._package_cancel is not None:
+                self._package_cancel.set()
+        self._executor.shutdown(wait=False)
@@ -1,33 +1,28 @@
 import threading
-import requests
+from concurrent.futures import Future, TimeoutError
 
-try:
-    # For MacOS so it finds the certificates
-    import os
-    import sys
-    os.environ['SSL_CERT_FILE'] = os.path.join(sys._MEIPASS, 'certifi', 'cacert.pem')
-except:
-    pass
+import requests
 
 from typing import Union, Dict
-# import time  # TODO remove, used for tests with time.sleep
 import hashlib
 
 import wx
 
+from esphomeflasher.download import ChecksumError, DownloadAborted, download, download_catalog
+
 
 class RemoteFileCache:
     """Very simple cache for RemoteFile's url:data"""
 
     def __init__(self):
-        self.entries: Dict[str, bytes] = {}
+        self.entries: Dict[str, Union[bytes, bytearray]] = {}
         self.lock = threading.Lock()
 
     def flush(self):
         with self.lock:
             self.entries.clear()
 
-    def set(self, url: str, data: bytes):
+    def set(self, url: str, data: Union[bytes, bytearray]):
         with self.lock:
             self.entries[url] = data
 
@@ -58,16 +53,21 @@ class RemoteFile:
     STATUS_ERROR = 1
     STATUS_ABORT = 2
 
-    def __init__(self, url: str, window: wx.Window, event_id: int = 0):
+    def __init__(self, url: str, window: wx.Window, event_id: int = 0, expected_sha256: Union[None, str] = None):
         self.status: int = RemoteFile.STATUS_UNKNOWN
         self.window: wx.Window = window
         self.event_id: int = event_id
         self.url: str = url
+        self.expected_sha256 = expected_sha256
         self.use_cache = False
-        self.data: Union[None, bytes] = None
+        self.data: Union[None, bytes, bytearray] = None
+        self._sha256: str = ""
         self.thread: Union[None, RemoteFileThread] = None
+        self.prefetched: Union[None, Future] = None
 
-    def get(self, use_cache=False):
+    def get(self, use_cache=False, prefetched: Union[None, Future] = None):
+        """Download in a thread, or wait for the prefetched Download future instead"""
+        self.prefetched = prefetched
         data = None
         if use_cache:
             self.use_cache = True
@@ -75,6 +75,7 @@ class RemoteFile:
             if data is not None:
                 # print("cache hit")
                 self.data = data
+                self._sha256 = ""
                 self.status = RemoteFile.STATUS_OK
                 wx.PostEvent(self.window, RemoteFileEvent(self, self.event_id))
             else:
@@ -91,7 +92,12 @@ class RemoteFile:
 
     @property
     def sha256(self):
-        return hashlib.sha256(self.data).hexdigest() if self.data is not None else ""
+        if self.data is None:
+            return ""
+        if not self._sha256:
+            # served from memory cache, downloads are hashed while streaming
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
 
 
 class RemoteFileThread(threading.Thread):
@@ -102,32 +108,30 @@ class RemoteFileThread(threading.Thread):
         self.cancel_pending = threading.Event()
 
     def run(self):
-        data = bytes()
-
-        # # TODO remove, simulates busy work
-        # print("Sleeping...")
-        # for s in range(6):
-        #     time.sleep(.5)
-        #     if self.cancel_pending.is_set():
-        #         print("Aborted")
-        #         self.remote_file.status = RemoteFile.STATUS_ABORT
-        #         return
-
-        # real work
-        print("Downloading {}".format(self.remote_file.url))
         try:
-            req = requests.get(self.remote_file.url, stream=True, timeout=10.0)
-            for chunk in req.iter_content(chunk_size=1024):
-                if self.cancel_pending.is_set():
-                    print("Download aborted")
-                    req.close()
-                    self.remote_file.status = RemoteFile.STATUS_ABORT
-                    return
-                if chunk:
-                    data += chunk
-            self.remote_file.data = data
-            req.raise_for_status()
+            if self.remote_file.prefetched is not None:
+                result = self._wait(self.remote_file.prefetched)
+            elif self.remote_file.use_cache and self.remote_file.expected_sha256 is None:
+                # catalog files, revalidated against the copy on disk
+                print("Downloading {}".format(self.remote_file.url))
+                result = download_catalog(self.remote_file.url, self.cancel_pending)
+            else:
+                print("Downloading {}".format(self.remote_file.url))
+                result = download(self.remote_file.url, self.remote_file.expected_sha256, self.cancel_pending)
+            self.remote_file.data = result.data
+            self.remote_file._sha256 = result.sha256
             self.remote_file.status = RemoteFile.STATUS_OK
+            if result.not_modified:
+                print("Not modified, using cached copy")
+            else:
+                print("Downloaded {}".format(result.stats_text))
+        except DownloadAborted:
+            print("Download aborted")
+            self.remote_file.status = RemoteFile.STATUS_ABORT
+            return
+        except ChecksumError as e:
+            self.remote_file.status = RemoteFile.STATUS_ERROR
+            print("Checksum error: {}".format(e))
         except requests.HTTPError as e:
             self.remote_file.status = RemoteFile.STATUS_ERROR
             print("HTTP error: {}".format(e))
@@ -142,8 +146,17 @@ class RemoteFileThread(threading.Thread):
             if self.remote_file.use_cache:
                 # print("cache update")
                 cache.set(self.remote_file.url, self.remote_file.data)
-            wx.PostEvent(self.remote_file.window,
-                         RemoteFileEvent(self.remote_file, self.remote_file.event_id))
+        # failures are posted too, listeners check status
+        wx.PostEvent(self.remote_file.window,
+                     RemoteFileEvent(self.remote_file, self.remote_file.event_id))
+
+    def _wait(self, future: Future):
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except TimeoutError:
+                if self.cancel_pending.is_set():
+                    raise DownloadAborted("Download aborted")
 
     def cancel(self):
         self.cancel_pending.set()
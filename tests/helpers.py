@@ -0,0 +1,51 @@
+"""Packages and isolated caches shared by the tests"""
+import io
+import json
+import os
+import random
+import tempfile
+import zipfile
+
+from esphomeflasher import diskCache
+from esphomeflasher.diskCache import FirmwareCache
+
+
+def package_files(seed=1):
+    """(filename, offset, data) of a small FujiNet style release"""
+    rnd = random.Random(seed)
+    words = [b'wifi', b'sio', b'disk', b'printer', b'\x00\x00\x00\x00']
+    firmware = b''.join(rnd.choice(words) for _ in range(0x8000))[:0x20000]
+    return [
+        ('bootloader.bin', 0x1000, b'\xe9\x03\x02\x20' + bytes(rnd.getrandbits(8) for _ in range(0xffc))),
+        ('partitions.bin', 0x8000, bytes(rnd.getrandbits(8) for _ in range(0xc00))),
+        ('boot_app0.bin', 0xe000, b'\xff' * 0x2000),
+        ('firmware.bin', 0x10000, b'\xe9\x05\x02\x20' + firmware[4:]),
+    ]
+
+
+def make_package(files=None, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    """Release zip with release.json listing files"""
+    files = package_files() if files is None else files
+    release = {
+        'version': 'test',
+        'version_date': '2000-01-01 00:00:00',
+        'git_commit': '0000000',
+        'files': [{'filename': name, 'offset': hex(offset)} for name, offset, _ in files],
+    }
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression) as zf:
+        zf.writestr('release.json', json.dumps(release))
+        for name, _, data in files:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def isolate_caches(test):
+    """Package and compressed caches in a temporary directory for the duration of the test"""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    test.addCleanup(setattr, diskCache, '_cache', diskCache._cache)
+    test.addCleanup(setattr, diskCache, '_compressed_cache', diskCache._compressed_cache)
+    diskCache._cache = FirmwareCache(os.path.join(tmp.name, 'packages'), 16 * 1024 * 1024)
+    diskCache._compressed_cache = None
+    return tmp.name
@@ -0,0 +1,113 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import esptool
+
+from esphomeflasher import autoBaud
+from esphomeflasher.autoBaud import BaudMemory, negotiate_baud
+from esphomeflasher.common import EsphomeflasherError
+
+
+class BaudMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.memory = BaudMemory(os.path.join(self.tmp.name, 'baudrates.json'))
+
+    def test_one_failure_not_skipped(self):
+        self.memory.failed('port', 921600)
+        self.assertFalse(self.memory.skipped('port', 921600))
+
+    def test_repeated_failures_skipped(self):
+        self.memory.failed('port', 921600, now=1000)
+        self.memory.failed('port', 921600, now=1000)
+        self.assertTrue(self.memory.skipped('port', 921600, now=1000))
+        self.assertFalse(self.memory.skipped('other', 921600, now=1000))
+
+    def test_reprobed_after_interval(self):
+        self.memory.failed('port', 921600, now=1000)
+        self.memory.failed('port', 921600, now=1000)
+        self.assertFalse(self.memory.skipped('port', 921600, now=1000 + BaudMemory.REPROBE_INTERVAL))
+
+    def test_success_clears_failures(self):
+        self.memory.failed('port', 921600)
+        self.memory.succeeded('port', 921600)
+        self.memory.failed('port', 921600)
+        self.assertFalse(self.memory.skipped('port', 921600))
+
+    def test_old_file_format(self):
+        with open(self.memory.path, 'w') as f:
+            f.write('{"port": 460800}')
+        self.assertFalse(self.memory.skipped('port', 921600))
+        self.memory.failed('port', 921600)
+
+
+class NegotiateBaudTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patches = [
+            mock.patch.object(autoBaud, 'memory', BaudMemory(os.path.join(self.tmp.name, 'baudrates.json'))),
+            mock.patch.object(autoBaud, 'port_key', lambda port: port),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.probed = []
+
+    def negotiate(self, good):
+        def probe(stub_chip, baud):
+            self.probed.append(baud)
+            return baud in good
+
+        self.probed = []
+        with mock.patch.object(autoBaud, 'probe_baud', probe), contextlib.redirect_stdout(io.StringIO()):
+            return negotiate_baud(None, 'port')
+
+    def test_glitch_does_not_lower_rate(self):
+        self.assertEqual(self.negotiate([460800]), 460800)
+        # one failure, the fastest rate is probed first again
+        self.assertEqual(self.negotiate([921600, 460800]), 921600)
+        self.assertEqual(self.probed, [921600])
+
+    def test_failing_rate_skipped(self):
+        self.negotiate([460800])
+        self.negotiate([460800])
+        self.assertEqual(self.negotiate([460800]), 460800)
+        self.assertEqual(self.probed, [460800])
+
+    def test_skipped_rates_last_resort(self):
+        self.negotiate([115200])
+        self.negotiate([115200])
+        # the faster rates failed twice, they are tried once 115200 fails too
+        self.assertEqual(self.negotiate([921600]), 921600)
+        self.assertEqual(self.probed, [115200, 921600])
+
+    def test_baud_change_failure_falls_back(self):
+        class FakeStub:
+            def change_baud(self, baud):
+                if baud == 921600:
+                    raise esptool.FatalError("Invalid head of packet")
+
+            def read_flash(self, offset, size):
+                return b'\xff' * size
+
+            def flush_input(self):
+                pass
+
+        with mock.patch.object(autoBaud.time, 'sleep'), contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(negotiate_baud(FakeStub(), 'port'), 460800)
+            negotiate_baud(FakeStub(), 'port')
+        self.assertTrue(autoBaud.memory.skipped('port', 921600))
+
+    def test_no_rate(self):
+        with self.assertRaises(EsphomeflasherError):
+            self.negotiate([])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import contextlib
+import io
+import os
+import random
+import tempfile
+import unittest
+
+from esphomeflasher import diskCache
+from esphomeflasher.backup import find_backup, load_backup, run_backup, run_restore
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.diskCache import FirmwareCache
+from esphomeflasher.emulator import EspEmulator
+
+BAUD = ['--upload-baud-rate', '921600']
+
+
+def fill(emu):
+    """Bootloader, some random data and a mostly erased rest"""
+    rnd = random.Random(1)
+    emu.flash.write(0x1000, b'\xe9\x03\x02\x20' + bytes(rnd.getrandbits(8) for _ in range(0x1000)))
+    emu.flash.write(0x9000, bytes(rnd.getrandbits(8) for _ in range(0x3000)))
+    emu.flash.write(0xf0000, b'hello' * 100)
+    return bytes(emu.flash.data)
+
+
+class BackupRestoreTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.addCleanup(setattr, diskCache, '_cache', diskCache._cache)
+        self.addCleanup(setattr, diskCache, '_compressed_cache', diskCache._compressed_cache)
+        diskCache._cache = FirmwareCache(os.path.join(tmp.name, 'cache'), 1024 * 1024)
+        diskCache._compressed_cache = None
+        output = contextlib.redirect_stdout(io.StringIO())
+        output.__enter__()
+        self.addCleanup(output.__exit__, None, None, None)
+
+    def backup(self, flash):
+        with EspEmulator('1MB') as emu:
+            flash.update(data=fill(emu))
+            self.assertEqual(run_backup(['-p', emu.port, '--dir', self.dir] + BAUD), 0)
+        return find_backup(self.dir, '24:0A:C4:00:00:01')
+
+    def test_round_trip(self):
+        flash = {}
+        path = self.backup(flash)
+        info, images = load_backup(path)
+        self.assertEqual(info['mac'].upper(), '24:0A:C4:00:00:01')
+        # erased blocks are not stored
+        self.assertLess(sum(image.size for image in images), 0x40000)
+        with EspEmulator('1MB') as emu:
+            emu.flash.write(0x80000, b'junk' * 1000)
+            self.assertEqual(run_restore([self.dir, '-p', emu.port] + BAUD), 0)
+            self.assertEqual(bytes(emu.flash.data), flash['data'])
+
+    def test_other_chip_refused(self):
+        path = self.backup({})
+        with EspEmulator('1MB', mac='24:0A:C4:00:00:02') as emu:
+            with self.assertRaises(EsphomeflasherError):
+                run_restore([path, '-p', emu.port] + BAUD)
+            emu.reset()
+            self.assertEqual(run_restore([path, '-p', emu.port, '--force'] + BAUD), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+from esphomeflasher.console import DEFAULT_STYLE, ConsoleBuffer, apply_sgr
+
+
+class Screen:
+    """Text control stand-in, applies the batches of a ConsoleBuffer like the GUI does"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.text = ''
+        self.styles = []
+
+    def render(self):
+        ops, trim = self.buffer.take()
+        for op in ops:
+            if op[0] == 'append':
+                self.text += op[2]
+                self.styles.append((op[1], op[2]))
+            else:
+                self.text = self.text[:-op[1]]
+        if trim:
+            self.text = self.text.split('\n', trim)[-1]
+        return self.text
+
+
+class ConsoleBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = ConsoleBuffer()
+        self.screen = Screen(self.buffer)
+
+    def test_plain_lines(self):
+        self.buffer.write("one\ntwo\n")
+        self.assertEqual(self.screen.render(), "one\ntwo\n")
+
+    def test_carriage_return_in_one_batch(self):
+        self.buffer.write("Writing 10 %\rWriting 20 %\rWriting 30 %")
+        self.assertEqual(self.screen.render(), "Writing 30 %")
+
+    def test_carriage_return_across_batches(self):
+        self.buffer.write("done\nWriting 10 %")
+        self.screen.render()
+        self.buffer.write("\rWriting 100 %\n")
+        self.assertEqual(self.screen.render(), "done\nWriting 100 %\n")
+
+    def test_carriage_return_split_over_writes(self):
+        self.buffer.write("first\r")
+        self.buffer.write("second")
+        self.assertEqual(self.screen.render(), "second")
+
+    def test_crlf_keeps_line(self):
+        self.buffer.write("line\r\nnext")
+        self.assertEqual(self.screen.render(), "line\nnext")
+
+    def test_overwrite_longer_line_rendered_in_parts(self):
+        self.buffer.write("abc")
+        self.screen.render()
+        self.buffer.write("def")
+        self.screen.render()
+        self.buffer.write("\rx")
+        self.assertEqual(self.screen.render(), "x")
+
+    def test_colors(self):
+        self.buffer.write("\033[0;32mgreen\033[0m plain")
+        self.assertEqual(self.screen.render(), "green plain")
+        self.assertEqual([style.foreground for style, _ in self.screen.styles], ['green', None])
+
+    def test_escape_split_over_writes(self):
+        self.buffer.write("a\033[3")
+        self.buffer.write("1mred")
+        self.assertEqual(self.screen.render(), "ared")
+        self.assertEqual(self.screen.styles[-1][0].foreground, 'red')
+
+    def test_trim_scrollback(self):
+        buffer = ConsoleBuffer(max_lines=10)
+        screen = Screen(buffer)
+        for i in range(10):
+            buffer.write("line {}\n".format(i))
+        screen.render()
+        # within the slack nothing is dropped
+        buffer.write("line 10\n")
+        self.assertEqual(screen.render().count('\n'), 11)
+        for i in range(11, 20):
+            buffer.write("line {}\n".format(i))
+        text = screen.render()
+        self.assertEqual(text.count('\n'), 10)
+        self.assertTrue(text.startswith("line 10\n"))
+
+    def test_clear(self):
+        self.buffer.write("\033[31mred")
+        self.buffer.clear()
+        self.assertEqual(self.buffer.take(), ([], 0))
+        self.assertEqual(self.buffer.style, DEFAULT_STYLE)
+
+
+class ApplySgrTest(unittest.TestCase):
+    def test_attributes_and_reset(self):
+        style = apply_sgr(DEFAULT_STYLE, '1;4;33;44')
+        self.assertEqual((style.bold, style.underline, style.foreground, style.background),
+                         (True, True, 'yellow', 'blue'))
+        self.assertEqual(apply_sgr(style, '0'), DEFAULT_STYLE)
+        self.assertEqual(apply_sgr(style, ''), DEFAULT_STYLE)
+
+    def test_unknown_codes_ignored(self):
+        self.assertEqual(apply_sgr(DEFAULT_STYLE, '2;7;99'), DEFAULT_STYLE)
+
+    def test_extended_colors_skipped(self):
+        # the arguments of 256 color and RGB sequences are not attributes
+        self.assertEqual(apply_sgr(DEFAULT_STYLE, '38;5;200'), DEFAULT_STYLE)
+        self.assertEqual(apply_sgr(DEFAULT_STYLE, '48;2;1;5;3;1'), DEFAULT_STYLE._replace(bold=True))
+        self.assertEqual(apply_sgr(DEFAULT_STYLE, '38:5:4;5').secret, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
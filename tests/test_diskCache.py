@@ -0,0 +1,153 @@
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+
+from esphomeflasher import diskCache
+from esphomeflasher.diskCache import CompressedCache, FirmwareCache, LruCache
+
+
+class BinCache(LruCache):
+    SUFFIX = '.bin'
+
+    def put(self, name, data):
+        return self._store(os.path.join(self.path, name + self.SUFFIX), data)
+
+
+class LruCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'cache')
+
+    def names(self, cache):
+        return sorted(os.path.basename(path) for path, _, _ in cache._entries())
+
+    def age(self, cache, name, mtime):
+        os.utime(os.path.join(cache.path, name + cache.SUFFIX), (mtime, mtime))
+
+    def test_store_and_size(self):
+        cache = BinCache(self.path, 100)
+        self.assertTrue(cache.put('a', b'x' * 10))
+        self.assertTrue(cache.put('b', b'y' * 20))
+        self.assertEqual(cache.size, 30)
+        self.assertEqual(self.names(cache), ['a.bin', 'b.bin'])
+
+    def test_evicts_least_recently_used(self):
+        cache = BinCache(self.path, 100)
+        cache.put('a', b'x' * 40)
+        cache.put('b', b'x' * 40)
+        self.age(cache, 'a', 1000)
+        self.age(cache, 'b', 2000)
+        cache.put('c', b'x' * 40)
+        self.assertEqual(self.names(cache), ['b.bin', 'c.bin'])
+
+    def test_touch_keeps_entry(self):
+        cache = BinCache(self.path, 100)
+        cache.put('a', b'x' * 40)
+        cache.put('b', b'x' * 40)
+        self.age(cache, 'a', 1000)
+        self.age(cache, 'b', 2000)
+        # storing an existing entry counts as an access
+        cache.put('a', b'x' * 40)
+        cache.put('c', b'x' * 40)
+        self.assertEqual(self.names(cache), ['a.bin', 'c.bin'])
+
+    def test_ignores_other_files(self):
+        cache = BinCache(self.path, 50)
+        cache.put('a', b'x' * 40)
+        with open(os.path.join(self.path, 'other.dat'), 'wb') as f:
+            f.write(b'z' * 100)
+        cache.put('b', b'x' * 40)
+        self.assertEqual(self.names(cache), ['b.bin'])
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'other.dat')))
+
+    def test_clear(self):
+        cache = BinCache(self.path, 100)
+        cache.put('a', b'x')
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+    def test_shared_budget(self):
+        cache = BinCache(self.path, 100)
+        other = BinCache(os.path.join(self.path, 'other'), 100)
+        cache.share_budget(other)
+        other.put('a', b'x' * 40)
+        cache.put('b', b'x' * 40)
+        self.age(other, 'a', 1000)
+        self.age(cache, 'b', 2000)
+        # the oldest entry of either cache goes first
+        cache.put('c', b'x' * 40)
+        self.assertEqual(self.names(other), [])
+        self.assertEqual(self.names(cache), ['b.bin', 'c.bin'])
+        other.put('d', b'x' * 40)
+        self.assertEqual(cache.size + other.size, 80)
+
+
+class FirmwareCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = FirmwareCache(self.tmp.name, 1024)
+
+    def test_put_get(self):
+        data = b'package' * 10
+        sha256 = self.cache.put(data)
+        self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(self.cache.get(sha256.upper()), data)
+        self.assertEqual(bytes(self.cache.map(sha256)), data)
+
+    def test_put_checks_sha256(self):
+        with self.assertRaises(ValueError):
+            self.cache.put(b'data', '0' * 64)
+
+    def test_corrupted_entry_removed(self):
+        sha256 = self.cache.put(b'package')
+        with open(self.cache.entry_path(sha256), 'wb') as f:
+            f.write(b'tampered')
+        self.assertIsNone(self.cache.get(sha256))
+        self.assertFalse(os.path.exists(self.cache.entry_path(sha256)))
+
+    def test_larger_than_cache_not_stored(self):
+        sha256 = self.cache.put(b'x' * 2048)
+        self.assertIsNone(self.cache.get(sha256))
+
+    def test_disabled(self):
+        cache = FirmwareCache(self.tmp.name, 0)
+        sha256 = cache.put(b'package')
+        self.assertIsNone(cache.get(sha256))
+
+    def write_part(self, key, size, mtime):
+        path = self.cache.part_path(key)
+        with open(path, 'wb') as f:
+            f.write(b'p' * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_partial_downloads_count(self):
+        now = time.time()
+        active = self.write_part('a' * 40, 600, now)
+        stale = self.write_part('b' * 40, 300, now - 2 * FirmwareCache.PART_IDLE)
+        sha256 = self.cache.put(b'x' * 400)
+        # the stale part is evicted, the one being downloaded is kept
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(active))
+        self.assertIsNotNone(self.cache.get(sha256))
+
+    def test_compressed_cache_shares_budget(self):
+        self.addCleanup(setattr, diskCache, '_cache', diskCache._cache)
+        diskCache._cache = self.cache
+        compressed = CompressedCache()
+        self.assertEqual(compressed.path, os.path.join(self.tmp.name, 'compressed'))
+        sha256 = self.cache.put(b'x' * 600)
+        os.utime(self.cache.entry_path(sha256), (1000, 1000))
+        compressed.put('c' * 64, 9, 0x4000, b'z' * 500, 600, '0' * 32)
+        self.assertIsNone(self.cache.get(sha256))
+        self.assertIsNotNone(compressed.get('c' * 64, 9, 0x4000))
+        # explicit path and size give an independent cache
+        self.assertEqual(CompressedCache(os.path.join(self.tmp.name, 'other'), 100).shared, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
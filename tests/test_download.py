@@ -0,0 +1,104 @@
+import contextlib
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from esphomeflasher import diskCache
+from esphomeflasher.diskCache import FirmwareCache
+from esphomeflasher.download import ChecksumError, download_resumable
+
+PACKAGE = bytes(range(256)) * 1024
+ETAG = '"v1"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('Range'))
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == ETAG:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(PACKAGE) - 1, len(PACKAGE)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(PACKAGE) - start))
+        self.end_headers()
+        self.wfile.write(PACKAGE[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadResumableTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{}/package.zip'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = FirmwareCache(tmp.name, 1024 * 1024)
+        self.addCleanup(setattr, diskCache, '_cache', diskCache._cache)
+        diskCache._cache = self.cache
+        RangeHandler.requests = []
+        self.sha256 = hashlib.sha256(PACKAGE).hexdigest()
+
+    def download(self, sha256=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return download_resumable(self.url, sha256, retries=0)
+
+    def test_moved_into_cache(self):
+        result = self.download(self.sha256)
+        self.assertIsInstance(result.data, mmap.mmap)
+        self.assertEqual(bytes(result.data), PACKAGE)
+        self.assertEqual(result.sha256, self.sha256)
+        self.assertEqual(os.listdir(self.cache.path), [self.sha256 + '.zip'])
+        self.assertEqual(self.cache.get(self.sha256), PACKAGE)
+
+    def test_unknown_checksum(self):
+        result = self.download()
+        self.assertEqual(result.sha256, self.sha256)
+        self.assertIsNotNone(self.cache.map(self.sha256))
+
+    def test_resumes_part_file(self):
+        part_path = self.cache.part_path(self.sha256)
+        with open(part_path, 'wb') as f:
+            f.write(PACKAGE[:1000])
+        with open(part_path + '.json', 'w') as f:
+            json.dump({'url': self.url, 'etag': ETAG}, f)
+        result = self.download(self.sha256)
+        self.assertEqual(RangeHandler.requests, ['bytes=1000-'])
+        self.assertEqual(bytes(result.data), PACKAGE)
+        self.assertEqual(os.listdir(self.cache.path), [self.sha256 + '.zip'])
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(ChecksumError):
+            self.download('0' * 64)
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+    def test_cache_disabled(self):
+        self.cache.max_size = 0
+        self.cache.enabled = False
+        result = self.download(self.sha256)
+        self.assertEqual(result.data, bytearray(PACKAGE))
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
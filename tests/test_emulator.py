@@ -0,0 +1,58 @@
+import contextlib
+import hashlib
+import io
+import unittest
+import zlib
+
+from esphomeflasher.common import chip_run_stub, detect_chip, read_chip_info
+from esphomeflasher.emulator import EmulatedFlash, EspEmulator
+from esphomeflasher.flashWriter import write_stream
+
+
+class EmulatedFlashTest(unittest.TestCase):
+    def test_write_clears_bits_only(self):
+        flash = EmulatedFlash(0x10000)
+        flash.write(0x10, b'\x0f\xf0')
+        flash.write(0x10, b'\xf0\xff')
+        self.assertEqual(flash.read(0x10, 2), b'\x00\xf0')
+
+    def test_erase_whole_sectors(self):
+        flash = EmulatedFlash(0x10000)
+        flash.write(0x0, b'\x00' * 0x3000)
+        flash.erase(0x1800, 0x10)
+        self.assertEqual(flash.read(0x0fff, 2), b'\x00\xff')
+        self.assertEqual(flash.read(0x1fff, 2), b'\xff\x00')
+
+    def test_outside_flash(self):
+        with self.assertRaises(ValueError):
+            EmulatedFlash(0x1000).read(0xff0, 0x20)
+
+
+class EspEmulatorTest(unittest.TestCase):
+    def connect(self, emu):
+        with contextlib.redirect_stdout(io.StringIO()):
+            chip = detect_chip(emu.port, force_esp32=True)
+            self.addCleanup(chip._port.close)
+            info = read_chip_info(chip)
+            return chip_run_stub(chip), info
+
+    def test_chip_info(self):
+        with EspEmulator('2MB', mac='24:0A:C4:12:34:56') as emu:
+            stub, info = self.connect(emu)
+            self.assertEqual(info.mac, '24:0A:C4:12:34:56')
+            self.assertEqual(stub.flash_id() >> 16, 21)
+
+    def test_compressed_write_and_md5(self):
+        data = bytes(range(256)) * 64
+        with EspEmulator('2MB') as emu:
+            stub, _ = self.connect(emu)
+            stub.erase_region(0x10000, 0x4000)
+            with contextlib.redirect_stdout(io.StringIO()):
+                write_stream(stub, 0x10000, [zlib.compress(data)], len(data), hashlib.md5(data).hexdigest())
+            self.assertEqual(emu.flash.read(0x10000, len(data)), data)
+            self.assertEqual(stub.flash_md5sum(0x10000, len(data)), hashlib.md5(data).hexdigest())
+            self.assertEqual(stub.read_flash(0x10000, 0x100), data[:0x100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import contextlib
+import io
+import json
+import os
+import unittest
+
+from esphomeflasher.__main__ import run_esphomeflasher
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.emulator import EspEmulator
+from tests.helpers import isolate_caches, make_package, package_files
+
+BAUD = ['--upload-baud-rate', '921600']
+
+
+class FlashFarmTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = isolate_caches(self)
+        self.package = os.path.join(self.dir, 'firmware.zip')
+        with open(self.package, 'wb') as f:
+            f.write(make_package())
+
+    def assertFlashed(self, emu):
+        for name, offset, data in package_files():
+            if name == 'bootloader.bin':
+                # flash mode and size in the header are set for the chip
+                offset, data = offset + 4, data[4:]
+            self.assertEqual(emu.flash.read(offset, len(data)), data, name)
+
+    def test_two_ports_verified(self):
+        metrics_json = os.path.join(self.dir, 'metrics.json')
+        with EspEmulator() as a, EspEmulator() as b:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                results = run_esphomeflasher(['esphomeflasher', '--farm', '--farm-port', a.port, '--farm-port', b.port,
+                                              '--verify', '--metrics-json', metrics_json] + BAUD + [self.package])
+            self.assertFlashed(a)
+            self.assertFlashed(b)
+        self.assertEqual([result.success for result in results], [True, True])
+        self.assertIn("2 of 2 port(s) flashed successfully.", out.getvalue())
+        with open(metrics_json) as f:
+            runs = json.load(f)['runs']
+        self.assertEqual(sorted(run['port'] for run in runs), sorted([a.port, b.port]))
+        for run in runs:
+            # verify runs in the background after the writes
+            self.assertIn('verify', [phase['name'] for phase in run['phases']])
+
+    def test_failed_port_does_not_stop_others(self):
+        with EspEmulator() as a:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                with self.assertRaisesRegex(EsphomeflasherError, '1 of 2'):
+                    run_esphomeflasher(['esphomeflasher', '--farm', '--farm-port', a.port,
+                                        '--farm-port', '/nonexistent/tty'] + BAUD + [self.package])
+            self.assertFlashed(a)
+        self.assertIn("1 of 2 port(s) flashed successfully.", out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import hashlib
+import struct
+import unittest
+import zlib
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.flashLayout import RECOMPRESS_MAX, FlashLayout, MergedImage
+from esphomeflasher.flashWriter import ZLIB_HEADER
+from esphomeflasher.package import FirmwareImage
+
+
+def image(filename, offset, data):
+    return FirmwareImage(filename, offset, data=data)
+
+
+def deflated_image(filename, offset, data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    raw = compressor.compress(data) + compressor.flush()
+    return FirmwareImage(filename, offset, raw_deflate=raw, size=len(data))
+
+
+def names(groups):
+    return [[image.filename for image in group] for group in groups]
+
+
+class FlashLayoutTest(unittest.TestCase):
+    def test_sorted_by_offset(self):
+        layout = FlashLayout([image('b', 0x8000, b'b'), image('a', 0x1000, b'a')])
+        self.assertEqual([image.filename for image in layout.images], ['a', 'b'])
+
+    def test_unaligned_offset(self):
+        with self.assertRaises(EsphomeflasherError):
+            FlashLayout([image('a', 0x8100, b'a')])
+
+    def test_negative_offset(self):
+        with self.assertRaises(EsphomeflasherError):
+            FlashLayout([image('a', -0x1000, b'a')])
+
+    def test_overlap(self):
+        with self.assertRaises(EsphomeflasherError):
+            FlashLayout([image('a', 0x8000, b'a' * 0x1001), image('b', 0x9000, b'b')])
+
+    def test_adjacent_images_do_not_overlap(self):
+        FlashLayout([image('a', 0x8000, b'a' * 0x1000), image('b', 0x9000, b'b')])
+
+    def test_check_fit(self):
+        layout = FlashLayout([image('a', 0x3ff000, b'a' * 0x1000)])
+        layout.check_fit(0x400000)
+        with self.assertRaises(EsphomeflasherError):
+            layout.check_fit(0x200000)
+
+
+class GroupsTest(unittest.TestCase):
+    def test_merges_images_sharing_a_sector(self):
+        layout = FlashLayout([
+            image('partitions', 0x8000, b'p' * 0xc00),
+            image('boot_app0', 0x9000, b'\xff' * 0x2000),
+            image('firmware', 0xc000, b'f' * 0x100),
+        ])
+        # 0xb000 is a whole sector between boot_app0 and firmware
+        self.assertEqual(names(layout.groups()), [['partitions', 'boot_app0'], ['firmware']])
+
+    def test_bootloader_alone(self):
+        layout = FlashLayout([image('bootloader', 0x1000, b'b' * 0x6fff), image('partitions', 0x8000, b'p')])
+        self.assertEqual(names(layout.groups()), [['bootloader'], ['partitions']])
+
+    def test_empty_images_skipped(self):
+        layout = FlashLayout([image('a', 0x8000, b'a'), image('empty', 0x9000, b''), image('b', 0xa000, b'b')])
+        self.assertEqual(names(layout.groups()), [['a'], ['b']])
+
+    def test_large_deflated_image_ends_group(self):
+        layout = FlashLayout([
+            deflated_image('boot_app0', 0xe000, b'\xff' * 0x2000),
+            deflated_image('firmware', 0x10000, b'f' * (RECOMPRESS_MAX + 0x1000)),
+            image('next', 0x21000, b'n'),
+        ])
+        # the small deflated image is recompressed in front of the stream of the large one
+        self.assertEqual(names(layout.groups()), [['boot_app0', 'firmware'], ['next']])
+
+    def test_writes(self):
+        layout = FlashLayout([image('a', 0x8000, b'a' * 0x10), image('b', 0x9000, b'b' * 0x10)])
+        writes = layout.writes
+        self.assertEqual(len(writes), 1)
+        self.assertIsInstance(writes[0], MergedImage)
+        self.assertIs(layout.writes, writes)
+
+
+class MergedImageTest(unittest.TestCase):
+    def test_contents(self):
+        a = image('a', 0x8000, b'a' * 0x10)
+        b = deflated_image('b', 0x8020, b'b' * 3)
+        merged = MergedImage([a, b])
+        expected = b'a' * 0x10 + b'\xff' * 0x10 + b'b' * 3
+        self.assertEqual((merged.offset, merged.size, merged.filename), (0x8000, 0x23, 'a+b'))
+        self.assertEqual(merged.data, expected)
+        merged.scan()
+        # b is not padded to 4 bytes, the merged image is recompressed
+        self.assertIsNone(merged.deflate_parts)
+        self.assertEqual(merged.md5, hashlib.md5(expected).hexdigest())
+        self.assertEqual(merged.sha256, hashlib.sha256(expected).hexdigest())
+
+    def test_deflate_stream_passed_through(self):
+        firmware = deflated_image('firmware', 0x10000, bytes(range(256)) * 0x100)
+        merged = MergedImage([deflated_image('boot_app0', 0xe000, b'\xff' * 0x1000), firmware])
+        merged.scan()
+        self.assertIs(merged.deflate_parts[-1], firmware.raw_deflate)
+        stream = ZLIB_HEADER + b''.join(merged.deflate_parts) + struct.pack('>I', merged.adler32)
+        # the checksum at the end covers the whole image
+        self.assertEqual(zlib.decompress(stream), merged.data)
+
+    def test_seek_and_read(self):
+        merged = MergedImage([image('a', 0x8000, b'0123'), image('b', 0x8008, b'4567')])
+        f = merged.open()
+        self.assertIs(f.image, merged)
+        f.seek(2)
+        self.assertEqual(f.read(4), b'23\xff\xff')
+        self.assertEqual(f.read(), b'\xff\xff4567')
+        self.assertEqual(f.read(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
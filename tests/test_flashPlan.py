@@ -0,0 +1,166 @@
+import contextlib
+import io
+import unittest
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.flashPlan import ImageSource, SectionFile, erase_planned, erase_units, invert_ranges, \
+    merge_runs, plan_erase, sparse_extents
+from esphomeflasher.metrics import FlashMetrics
+from esphomeflasher.package import FirmwareImage
+
+
+class FakeEsp:
+    BOOTLOADER_FLASH_OFFSET = 0x1000
+
+
+class MergeRunsTest(unittest.TestCase):
+    def test_touching_and_overlapping(self):
+        self.assertEqual(merge_runs([(0, 10), (10, 20), (15, 30), (40, 50)]), [(0, 30), (40, 50)])
+
+    def test_gap(self):
+        self.assertEqual(merge_runs([(0, 10), (14, 20), (30, 40)], gap=4), [(0, 20), (30, 40)])
+
+    def test_contained(self):
+        self.assertEqual(merge_runs([(0, 100), (10, 20)]), [(0, 100)])
+
+    def test_empty(self):
+        self.assertEqual(merge_runs([]), [])
+
+
+class FakeEraseChip:
+    def __init__(self):
+        self.erased = []
+
+    def erase_region(self, offset, size):
+        self.erased.append((offset, size))
+
+    def erase_flash(self):
+        self.erased.append('chip')
+
+
+class PlanEraseTest(unittest.TestCase):
+    def test_sector_aligned_and_merged(self):
+        regions = [(0x10000, 0x1234), (0x1000, 0x4e00), (0x8000, 0xc00), (0x9000, 0x10)]
+        self.assertEqual(plan_erase(regions), [(0x1000, 0x6000), (0x8000, 0xa000), (0x10000, 0x12000)])
+
+    def test_unaligned_offset(self):
+        self.assertEqual(plan_erase([(0x1800, 0x100)]), [(0x1000, 0x2000)])
+
+    def test_empty_regions_skipped(self):
+        self.assertEqual(plan_erase([(0x1000, 0), (0x2000, 0x10)]), [(0x2000, 0x3000)])
+
+    def test_does_not_fit(self):
+        with self.assertRaises(EsphomeflasherError):
+            plan_erase([(0x3ff000, 0x2000)], 0x400000)
+
+
+class InvertRangesTest(unittest.TestCase):
+    def test_gaps(self):
+        self.assertEqual(invert_ranges([(0x1000, 0x2000), (0x3000, 0x4000)], 0x5000),
+                         [(0, 0x1000), (0x2000, 0x3000), (0x4000, 0x5000)])
+
+    def test_covered(self):
+        self.assertEqual(invert_ranges([(0, 0x5000)], 0x5000), [])
+        self.assertEqual(invert_ranges([], 0x5000), [(0, 0x5000)])
+
+
+class EraseUnitsTest(unittest.TestCase):
+    def test_blocks_and_sectors(self):
+        # 3 head sectors, 2 blocks, 1 tail sector
+        self.assertEqual(erase_units([(0xd000, 0x31000)]), (2, 4))
+
+    def test_small_range_sectors_only(self):
+        self.assertEqual(erase_units([(0x1000, 0x6000)]), (0, 5))
+
+
+class ErasePlannedTest(unittest.TestCase):
+    def test_only_written_regions(self):
+        chip = FakeEraseChip()
+        metrics = FlashMetrics()
+        with contextlib.redirect_stdout(io.StringIO()):
+            erase_planned(chip, [(0x1000, 0x4e00), (0x10000, 0x20000)], 0x400000, metrics=metrics)
+        self.assertEqual(chip.erased, [(0x1000, 0x5000), (0x10000, 0x20000)])
+        erase = metrics.as_dict()['values']['erase']
+        self.assertEqual((erase['ranges'], erase['bytes'], erase['chip_erase']), (2, 0x25000, False))
+        self.assertIn('saved_estimate', erase)
+
+    def test_erase_unused_chip_erase(self):
+        chip = FakeEraseChip()
+        metrics = FlashMetrics()
+        with contextlib.redirect_stdout(io.StringIO()):
+            erase_planned(chip, [(0x1000, 0x4e00)], 0x400000, erase_unused=True, metrics=metrics)
+        self.assertEqual(chip.erased, ['chip'])
+        self.assertTrue(metrics.values['erase']['chip_erase'])
+
+
+class SparseExtentsTest(unittest.TestCase):
+    SECTOR = 0x1000
+
+    def image(self, used):
+        """Image of 16 sectors, the sectors in used hold data"""
+        return b''.join(b'\x00' * self.SECTOR if i in used else b'\xff' * self.SECTOR for i in range(16))
+
+    def test_erased_image(self):
+        self.assertEqual(sparse_extents(self.image([])), [])
+
+    def test_separate_extents(self):
+        self.assertEqual(sparse_extents(self.image([0, 1, 8])), [(0, 0x2000), (0x8000, 0x9000)])
+
+    def test_small_holes_bridged(self):
+        # 2 erased sectors between data are written rather than split
+        self.assertEqual(sparse_extents(self.image([0, 3])), [(0, 0x4000)])
+        self.assertEqual(sparse_extents(self.image([0, 3]), bridge=0), [(0, 0x1000), (0x3000, 0x4000)])
+
+    def test_partial_last_sector(self):
+        image = self.image([]) + b'\x01\x02'
+        self.assertEqual(sparse_extents(image), [(0x10000, 0x10002)])
+        self.assertEqual(sparse_extents(self.image([]) + b'\xff' * 8), [])
+
+    def test_memoryview(self):
+        self.assertEqual(sparse_extents(memoryview(self.image([5]))), [(0x5000, 0x6000)])
+
+
+class SectionFileTest(unittest.TestCase):
+    def test_window(self):
+        f = SectionFile(io.BytesIO(bytes(range(100))), 10, 20)
+        self.assertEqual(f.read(5), bytes(range(10, 15)))
+        self.assertEqual(f.read(), bytes(range(15, 30)))
+        self.assertEqual(f.read(), b'')
+        self.assertEqual(f.seek(0, io.SEEK_END), 20)
+        f.seek(18)
+        self.assertEqual(f.read(10), bytes([28, 29]))
+
+
+class ImageSourceTest(unittest.TestCase):
+    def test_blocks_pad_last_block(self):
+        source = ImageSource(FakeEsp(), 0x10000, io.BytesIO(b'\x01' * 10), None)
+        self.assertEqual(source.size, 10)
+        self.assertEqual(source.padded_size, 12)
+        blocks = [(start, bytes(block)) for start, block in source.blocks(8)]
+        self.assertEqual(blocks, [(0, b'\x01' * 8), (8, b'\x01\x01\xff\xff')])
+
+    def test_sections_of_buffer(self):
+        argfile = io.BytesIO(bytes(range(64)))
+        source = ImageSource(FakeEsp(), 0x10000, argfile, None)
+        section = source.section(16, 32)
+        self.assertEqual(section.read(), bytes(range(16, 32)))
+        # clamped to the image, the write path pads it again
+        self.assertEqual(source.section(48, 80).read(), bytes(range(48, 64)))
+        self.assertEqual(argfile.tell(), 0)
+
+    def test_sections_of_deflated_image(self):
+        import zlib
+
+        data = bytes(range(256)) * 64
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        raw = compressor.compress(data) + compressor.flush()
+        image = FirmwareImage('firmware.bin', 0x10000, raw_deflate=memoryview(raw), size=len(data))
+        image.scan()
+        source = ImageSource(FakeEsp(), 0x10000, image.open(), None)
+        self.assertEqual(b''.join(bytes(block) for _, block in source.blocks(4096)), data)
+        self.assertEqual(source.section(5000, 9000).read(), data[5000:9000])
+        self.assertEqual(source.section(0x3000, 0x4000).read(), data[0x3000:0x4000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+import unittest
+
+from esphomeflasher.const import __version__
+from esphomeflasher.metrics import FlashMetrics, save_metrics_json
+
+
+class FlashMetricsTest(unittest.TestCase):
+    def test_phases_and_values(self):
+        metrics = FlashMetrics('/dev/ttyUSB0')
+        with metrics.phase('write', 100) as phase:
+            phase.bytes += 28
+        metrics.set('baud', 921600)
+        data = metrics.as_dict()
+        self.assertEqual(data['port'], '/dev/ttyUSB0')
+        self.assertEqual(data['values'], {'baud': 921600})
+        self.assertEqual([(p['name'], p['bytes']) for p in data['phases']], [('write', 128)])
+        self.assertGreaterEqual(data['total'], 0)
+
+    def test_phase_recorded_on_error(self):
+        metrics = FlashMetrics()
+        with self.assertRaises(ValueError):
+            with metrics.phase('erase'):
+                raise ValueError()
+        self.assertEqual([m.name for m in metrics.phases], ['erase'])
+
+    def test_merge_keeps_order(self):
+        loading = FlashMetrics()
+        with loading.phase('download'):
+            pass
+        loading.set('package', 'test')
+        metrics = FlashMetrics()
+        with metrics.phase('chip detect'):
+            pass
+        metrics.merge(loading)
+        data = metrics.as_dict()
+        self.assertEqual([p['name'] for p in data['phases']], ['download', 'chip detect'])
+        self.assertEqual(data['values'], {'package': 'test'})
+        self.assertIn('download', metrics.summary_text())
+
+    def test_save_json(self):
+        runs = [FlashMetrics('a'), FlashMetrics('b')]
+        with runs[1].phase('write', 10):
+            pass
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'metrics.json')
+            save_metrics_json(path, runs)
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(data['version'], __version__)
+        self.assertEqual([run['port'] for run in data['runs']], ['a', 'b'])
+        self.assertEqual(data['runs'][1]['phases'][0]['bytes'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import contextlib
+import io
+import unittest
+
+import serial
+
+from esphomeflasher.monitor import VIEW_BACKLOG, SerialMonitor
+
+
+class FakePort:
+    """Returns the given chunks, then reports the port as closed"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.timeout = None
+        self.in_waiting = 0
+
+    def read(self, size=1):
+        if not self.chunks:
+            raise serial.SerialException("closed")
+        return self.chunks.pop(0)
+
+
+def boot_lines(count):
+    return [b'line %d\r' % i for i in range(count)]
+
+
+class SerialMonitorTest(unittest.TestCase):
+    def run_monitor(self, chunks, rate=100):
+        monitor = SerialMonitor(FakePort(chunks), max_lines_per_sec=rate)
+        monitor.start()
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            monitor.run()
+        return out.getvalue().splitlines()
+
+    def test_burst_shown_in_full(self):
+        lines = self.run_monitor([b'\n'.join(boot_lines(30)) + b'\n'])
+        self.assertEqual(len(lines), 30)
+        self.assertTrue(lines[0].endswith('] line 0'))
+        self.assertTrue(lines[-1].endswith('] line 29'))
+
+    def test_partial_line_shown_when_closed(self):
+        lines = self.run_monitor([b'abc\n', b'de', b'f'])
+        self.assertEqual([line.split('] ', 1)[1] for line in lines], ['abc', 'def'])
+
+    def test_backlog_overflow_dropped(self):
+        monitor = SerialMonitor(FakePort([]))
+        monitor._add_lines(0.0, boot_lines(VIEW_BACKLOG + 100))
+        lines, dropped = monitor.take_view(10)
+        self.assertEqual(dropped, 100)
+        self.assertEqual(lines[0][1], 'line 100')
+        # lines beyond the limit are kept for the next call
+        lines, dropped = monitor.take_view(VIEW_BACKLOG)
+        self.assertEqual((len(lines), dropped), (VIEW_BACKLOG - 10, 0))
+        self.assertEqual(monitor.lines, VIEW_BACKLOG + 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
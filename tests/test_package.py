@@ -0,0 +1,85 @@
+import contextlib
+import io
+import mmap
+import os
+import tempfile
+import unittest
+import zipfile
+
+from esphomeflasher.common import EsphomeflasherError
+from esphomeflasher.helpers import thread_output
+from esphomeflasher.package import PendingPackage, load_package, map_package
+from tests.helpers import make_package, package_files
+
+
+def load(data):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return load_package(data)
+
+
+class LoadPackageTest(unittest.TestCase):
+    def test_images(self):
+        for compression in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            package = load(make_package(compression=compression))
+            self.assertEqual(package.version, 'test')
+            self.assertEqual([(image.filename, image.offset, bytes(image.data)) for image in package.images],
+                             package_files())
+            self.assertEqual(package.images[-1].raw_deflate is not None, compression == zipfile.ZIP_DEFLATED)
+
+    def test_corrupted_member_rejected(self):
+        files = [('firmware.bin', 0x10000, b'FIRMWARE' * 0x100)]
+        data = make_package(files, zipfile.ZIP_STORED)
+        pos = data.index(b'FIRMWARE')
+        corrupted = data[:pos] + b'X' + data[pos + 1:]
+        with self.assertRaisesRegex(EsphomeflasherError, 'CRC mismatch'):
+            load(corrupted)
+
+    def test_missing_release_info(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('firmware.bin', b'data')
+        with self.assertRaises(EsphomeflasherError):
+            load(buf.getvalue())
+
+
+class MapPackageTest(unittest.TestCase):
+    def test_buffer_not_copied(self):
+        data = bytearray(make_package())
+        self.assertIs(map_package(data).obj, data)
+
+    def test_file_mapped(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'firmware.zip')
+            with open(path, 'wb') as f:
+                f.write(make_package())
+            view = map_package(path)
+            self.assertIsInstance(view.obj, mmap.mmap)
+            self.assertEqual(bytes(view), make_package())
+            view.release()
+
+    def test_missing_file(self):
+        with self.assertRaises(EsphomeflasherError):
+            map_package('/nonexistent/firmware.zip')
+
+
+class PendingPackageTest(unittest.TestCase):
+    def test_output_held_back(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out, thread_output():
+            pending = PendingPackage(make_package())
+            pending._thread.join(5)
+            print("Connecting...")
+            package = pending.result()
+        self.assertEqual(len(package.images), len(package_files()))
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "Connecting...")
+        self.assertTrue(any(line.startswith("File 1: bootloader.bin") for line in lines[1:]))
+
+    def test_error_raised_by_result(self):
+        with contextlib.redirect_stdout(io.StringIO()), thread_output():
+            pending = PendingPackage(b'not a zip')
+            with self.assertRaises(EsphomeflasherError):
+                pending.result()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import contextlib
+import io
+import threading
+import unittest
+from concurrent.futures import wait
+from unittest import mock
+
+from esphomeflasher import prefetch
+from esphomeflasher.download import DownloadAborted
+from esphomeflasher.prefetch import Prefetcher
+
+
+class FakeCache:
+    def map(self, sha256, verify=True):
+        return None
+
+    def put(self, data, sha256=None, verify=True):
+        return sha256
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+        self.sha256 = 'a' * 64
+        self.stats_text = "test"
+
+
+class PrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.gates = {}
+        self.calls = []
+        patches = [
+            mock.patch.object(prefetch, 'get_cache', FakeCache),
+            mock.patch.object(prefetch, 'download_resumable', self.download),
+            contextlib.redirect_stdout(io.StringIO()),
+        ]
+        for patch in patches:
+            patch.__enter__()
+            self.addCleanup(patch.__exit__, None, None, None)
+        self.prefetcher = Prefetcher()
+        self.addCleanup(self.prefetcher.shutdown)
+
+    def download(self, url, sha256, cancel):
+        self.calls.append(url)
+        gate = self.gates.get(url)
+        if gate is not None:
+            gate.wait(5)
+        if cancel.is_set():
+            raise DownloadAborted("Download aborted")
+        return FakeResult(url.encode())
+
+    def test_same_package_shared(self):
+        first = self.prefetcher.package('http://a', 'A' * 64)
+        self.assertIs(self.prefetcher.package('http://a', 'a' * 64), first)
+        self.assertEqual(first.result(5), b'http://a')
+        self.assertEqual(self.calls, ['http://a'])
+
+    def test_completed_package_kept_after_other_selection(self):
+        first = self.prefetcher.package('http://a', 'a' * 64)
+        first.result(5)
+        self.prefetcher.package('http://b', 'b' * 64).result(5)
+        self.assertIs(self.prefetcher.package('http://a', 'a' * 64), first)
+
+    def test_reselected_while_cancelled_fetch_runs(self):
+        gate = self.gates['http://a'] = threading.Event()
+        stale = self.prefetcher.package('http://a', 'a' * 64)
+        self.prefetcher.package('http://b', 'b' * 64)
+        # A is selected again before its cancelled fetch has noticed
+        again = self.prefetcher.package('http://a', 'a' * 64)
+        self.assertIsNot(again, stale)
+        # the new fetch does not start while the old one owns the part file
+        self.assertFalse(wait([again], 0.2).done)
+        self.assertEqual(self.calls.count('http://a'), 1)
+        gate.set()
+        with self.assertRaises(DownloadAborted):
+            stale.result(5)
+        self.assertEqual(again.result(5), b'http://a')
+
+    def test_failed_package_fetched_again(self):
+        gate = self.gates['http://a'] = threading.Event()
+        stale = self.prefetcher.package('http://a', 'a' * 64)
+        self.prefetcher.package('http://b', 'b' * 64)
+        gate.set()
+        with self.assertRaises(DownloadAborted):
+            stale.result(5)
+        self.assertEqual(self.prefetcher.package('http://a', 'a' * 64).result(5), b'http://a')
+
+
+if __name__ == '__main__':
+    unittest.main()